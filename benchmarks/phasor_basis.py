@@ -0,0 +1,64 @@
+"""Projection of decays onto the cached cos/sin phasor basis (utils/phasor_engine.py) against the np.tile path it
+replaced, on synthetic stacks. Checks that both give the same g and s, then prints their times.
+
+    python benchmarks/phasor_basis.py
+"""
+import math
+import os
+import sys
+import timeit
+
+import numpy as np
+
+# the modules are imported as utils.<module>, from the repository folder
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils.phasor_engine import phasor_basis, project_decays, _phasor_ratios
+
+W = 2 * math.pi * 80e6
+SHAPES = ((256, 128, 128), (256, 256, 256), (64, 512, 512))
+
+
+def tiled_coordinates(data, t_series, w):
+    """g and s as calculated before the phasor basis: cos(wt) and sin(wt) tiled to (T, pixels) matrices"""
+    bin_data = np.reshape(data, (data.shape[0], -1))
+    bin_data_int = bin_data.sum(0)
+    cos = np.tile(np.cos(w * t_series), [bin_data.shape[1], 1]).T
+    sin = np.tile(np.sin(w * t_series), [bin_data.shape[1], 1]).T
+    g = np.nan_to_num(np.divide((bin_data * cos).sum(0), bin_data_int, out=np.zeros_like(bin_data_int), where=bin_data_int != 0))
+    s = np.nan_to_num(np.divide((bin_data * sin).sum(0), bin_data_int, out=np.zeros_like(bin_data_int), where=bin_data_int != 0))
+    return g, s
+
+
+def basis_coordinates(data, t_series, w):
+    """g and s from the cached basis vectors, reduced with a tensordot over the time axis"""
+    cos, sin = phasor_basis(w, t_series)
+    g, s = _phasor_ratios(project_decays(data, cos), project_decays(data, sin), data.sum(0))
+    return g.reshape(-1), s.reshape(-1)
+
+
+def synthetic_stack(shape, seed=0):
+    """Poisson decays of lifetimes from 0.5 to 8 ns (float64 counts, as the decays the tiled path was run on)"""
+    T, X, Y = shape
+    rng = np.random.default_rng(seed)
+    t_series = np.arange(T) * (12.5e-9 / T)
+    tau = rng.uniform(0.5e-9, 8e-9, (1, X, Y))
+    data = rng.poisson(100 * np.exp(-t_series[:, None, None] / tau) + 1).astype(np.float64)
+    return data, t_series
+
+
+def main():
+    for shape in SHAPES:
+        data, t_series = synthetic_stack(shape)
+        g_tiled, s_tiled = tiled_coordinates(data, t_series, W)
+        g_basis, s_basis = basis_coordinates(data, t_series, W)
+        np.testing.assert_allclose(g_basis, g_tiled, rtol=1e-10, atol=1e-14)
+        np.testing.assert_allclose(s_basis, s_tiled, rtol=1e-10, atol=1e-14)
+
+        tiled = min(timeit.repeat(lambda: tiled_coordinates(data, t_series, W), number=1, repeat=3))
+        basis = min(timeit.repeat(lambda: basis_coordinates(data, t_series, W), number=1, repeat=3))
+        print(f"{'x'.join(map(str, shape))}: np.tile {tiled:.3f} s, phasor basis {basis:.3f} s "
+              f"({tiled / basis:.1f}x), g and s equal")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+"""Headless FLIMPA batch analysis, run from the repository folder without starting the GUI:
+
+    python -m flimpa --reference ref.sdt --ref-lifetime 4.0 samples/ -o results/
+"""
+import sys
+import argparse
+
+from utils.batch import BIN_SIZES, find_samples, run_batch
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog="flimpa", description="Phasor analysis of FLIM data without the GUI. "
+                                     "Writes the lifetime maps (ns) of every sample and a lifetime_values.csv table.")
+    parser.add_argument("samples", nargs="+", help="raw data files (.sdt, .ptu, .tif), folders or glob patterns")
+    reference = parser.add_mutually_exclusive_group(required=True)
+    reference.add_argument("--reference", help="reference file of known lifetime")
+    reference.add_argument("--irf", help="IRF file (.sdt or two column .csv) used as a reference of lifetime 0")
+    parser.add_argument("--ref-lifetime", type=float, default=0, help="lifetime of the reference in ns (default: %(default)s)")
+    parser.add_argument("-o", "--output", default="flimpa_results", help="output folder (default: %(default)s)")
+    parser.add_argument("--frequency", type=float, default=40, help="laser frequency in MHz (default: %(default)s)")
+    parser.add_argument("--bins", choices=list(BIN_SIZES), default="3x3", help="spatial binning (default: %(default)s)")
+    parser.add_argument("--min-photons", type=float, default=0, help="minimum photon counts per pixel (default: %(default)s)")
+    parser.add_argument("--max-photons", type=float, default=None, help="maximum photon counts per pixel (default: no limit)")
+    parser.add_argument("--subtract-offset", action="store_true", help="subtract the intensity offset (baseline)")
+    parser.add_argument("--fraction-offset", type=float, default=3.5,
+                        help="percentage of the first time bins used as the baseline (default: %(default)s)")
+    parser.add_argument("--bin-width", default=None, help="time bin width of .tif data in ns (default: estimated from the frequency)")
+    parser.add_argument("--channel", type=int, default=0, help="detection channel of .ptu files (default: %(default)s)")
+    parser.add_argument("--time-binning", type=int, default=1, help="time binning factor of .ptu files (default: %(default)s)")
+    parser.add_argument("--frame-window", type=int, default=None,
+                        help="analyse multi-frame .ptu files per window of this many frames, decoded one frame at a time "
+                             "(writes <file>_<map>_frames.tif stacks, default: sum all frames)")
+    parser.add_argument("--frame-step", type=int, default=None,
+                        help="frames between the starts of consecutive windows (default: the window, without overlap)")
+    parser.add_argument("--masks", default=None, help="folder of manual masks ('<file name> segmentation.tif')")
+    parser.add_argument("--condition", default="None", help="condition name written to the lifetime table (default: %(default)s)")
+    parser.add_argument("--workers", type=int, default=1, help="number of processes analysing files in parallel (default: %(default)s)")
+    parser.add_argument("--memory-budget", type=float, default=256,
+                        help="approximate memory (MB) used to analyse one file, per process (default: %(default)s)")
+    parser.add_argument("--detail-stats", action="store_true",
+                        help="add the pixel count, median, std, quartiles and phasor centroid of each region to the lifetime table")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    samples = find_samples(args.samples)
+    if not samples:
+        print("No .sdt, .ptu or .tif files found.", file=sys.stderr)
+        return 1
+
+    offset_fraction = args.fraction_offset / 100 if args.subtract_offset else None
+    if offset_fraction is not None and args.time_binning > 2:
+        # as in the GUI, too few time bins remain to estimate the baseline
+        print("Offset subtraction is not available for .ptu time binning larger than 2, continuing without it.", file=sys.stderr)
+        offset_fraction = None
+
+    settings = {"frequency": args.frequency, "bins": BIN_SIZES[args.bins], "min_photons": args.min_photons,
+                "max_photons": args.max_photons, "offset_fraction": offset_fraction, "bin_width": args.bin_width,
+                "ptu_channel": args.channel, "ptu_time_binning": args.time_binning, "masks_dir": args.masks,
+                "frame_window": args.frame_window, "frame_step": args.frame_step or args.frame_window,
+                "condition": args.condition, "memory_budget": int(args.memory_budget * 2**20),
+                "detail_stats": args.detail_stats}
+
+    _, failed = run_batch(samples, args.irf or args.reference, 0 if args.irf else args.ref_lifetime, args.output,
+                          settings, irf=bool(args.irf), workers=args.workers)
+
+    print(f"Analysed {len(samples) - len(failed)} of {len(samples)} files, results saved in {args.output}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,28 +1,34 @@
 import sys
 import os
-from PySide6 import QtWidgets
-from PySide6.QtWidgets import QApplication
-from PySide6.QtGui import QIcon, QPixmap
-from utils.dark_theme import get_darkModePalette
-from utils.mainwindow import MainWindow
+import multiprocessing
 
 os.environ["QT_AUTO_SCREEN_SCALE_FACTOR"] = "1"
 
-# Ensure the icon path is correct
-base_path = os.path.abspath(os.path.dirname(__file__))
-icon_path = os.path.join(base_path, 'icon', 'icon_f.ico')
+if __name__ == "__main__":
+    # worker processes of the parallel analysis re-import this module, keep them from starting another GUI
+    multiprocessing.freeze_support()
 
-app = QApplication(sys.argv + ['-platform', 'windows:darkmode=2'])
-app.setStyle('Fusion')
-app.setPalette(get_darkModePalette(app))
+    from PySide6 import QtWidgets
+    from PySide6.QtWidgets import QApplication
+    from PySide6.QtGui import QIcon, QPixmap
+    from utils.dark_theme import get_darkModePalette
+    from utils.mainwindow import MainWindow
 
-# Load the icon and resize it to a smaller size
-icon = QIcon(QPixmap(icon_path))
-app.setWindowIcon(icon)
+    # Ensure the icon path is correct
+    base_path = os.path.abspath(os.path.dirname(__file__))
+    icon_path = os.path.join(base_path, 'icon', 'icon_f.ico')
 
-window = MainWindow(app)
-window.setWindowTitle("FLIMPA (v1.4.2)")
-window.setWindowIcon(icon)  # Set the window icon here
-window.showMaximized()
+    app = QApplication(sys.argv + ['-platform', 'windows:darkmode=2'])
+    app.setStyle('Fusion')
+    app.setPalette(get_darkModePalette(app))
 
-app.exec()
+    # Load the icon and resize it to a smaller size
+    icon = QIcon(QPixmap(icon_path))
+    app.setWindowIcon(icon)
+
+    window = MainWindow(app)
+    window.setWindowTitle("FLIMPA (v1.4.2)")
+    window.setWindowIcon(icon)  # Set the window icon here
+    window.showMaximized()
+
+    app.exec()
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the modules are imported as utils.<module>, from the repository folder
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
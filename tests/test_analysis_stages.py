@@ -0,0 +1,165 @@
+"""Tests of the incremental analysis (utils/analysis_stages.py, LifetimeData.analyse_data): changing a parameter only
+recalculates the stages that depend on it, with the same results as analysing every file again"""
+import copy
+import types
+
+import numpy as np
+import pytest
+
+import utils.mainwindow  # noqa: F401, imported before lifetime_cal as the application does
+from utils import lifetime_cal, shared_data
+from utils.analysis_stages import STAGES, stage_signatures, stale_stages
+from utils.lifetime_cal import LifetimeData
+from utils.shared_data import SharedData
+
+# config value changed, and the work done for the analysed files without and with offset subtraction:
+# "read" the raw data, "bin" the decay projections, "calibrate" the coordinates and "stats" per region
+CHANGES = {
+    "frequency": (80, {"read", "bin", "calibrate", "stats"}, {"read", "calibrate", "stats"}),
+    "min_photons": (40, {"bin", "calibrate", "stats"}, {"read", "calibrate", "stats"}),
+    "max_photons": (300, {"bin", "calibrate", "stats"}, {"read", "calibrate", "stats"}),
+    "bins": ("7x7", {"bin", "calibrate", "stats"}, {"read", "calibrate", "stats"}),
+    "fraction_offset": (10, {"bin", "calibrate", "stats"}, {"read", "calibrate", "stats"}),
+    "ref_lifetime": (3.5, {"calibrate", "stats"}, {"calibrate", "stats"}),
+    "detail_stats": ("True", {"stats"}, {"stats"}),
+    "lifetime_map": ("M", set(), set()),
+    "lifetime_vmax": (5, set(), set()),
+}
+
+
+def decay(seed, tau, shape=(32, 24, 24), scale=50):
+    """Decays rising after 1/8 of the time bins, with a small background"""
+    rng = np.random.default_rng(seed)
+    t = np.arange(shape[0]) / (40e6 * shape[0])
+    curve = np.where(t >= t[shape[0] // 8], np.exp(-(t - t[shape[0] // 8]) / tau), 0) + 0.05
+    cube = rng.uniform(0, scale, shape[1:]) * curve[:, None, None]
+    return rng.poisson(cube).astype(np.float32), t.astype(np.float32)
+
+
+@pytest.fixture
+def shared(monkeypatch):
+    """A new SharedData with a reference and three sample files (one with a manual mask), without a session file"""
+    monkeypatch.setattr(shared_data, "remove_stale_sessions", lambda: None)
+    monkeypatch.setattr(SharedData, "_instance", None)
+
+    def raise_error(parent, title, message):
+        raise AssertionError(message)
+    monkeypatch.setattr(lifetime_cal, "show_error_message", raise_error)
+
+    shared = SharedData()
+    shared.config.update(min_photons=20, max_photons=1000000, ref_file="ref")
+    ref, t = decay(1, 4e-9, scale=200)
+    shared.ref_files_dict["ref"] = {"ref_data": ref, "t_series": t, "bins_ref": ref.shape[0]}
+    mask = np.zeros((24, 24), dtype=np.float32)
+    mask[2:10, 3:12], mask[12:22, 5:20] = 1, 2
+    for i, tau in enumerate([1e-9, 2.5e-9, 3e-9]):
+        data, t = decay(10 + i, tau)
+        shared.raw_data_dict[f"f{i}"] = {"data": data, "t_series": t, "condition": "A" if i < 2 else "B", "file_path": None,
+                                         "mask_arr": mask if i == 0 else None, "analyse": "yes"}
+    return shared
+
+
+@pytest.fixture
+def work(monkeypatch):
+    """Work done by the analyses of a test"""
+    done = set()
+
+    def record(name, function):
+        def wrapper(*args, **kwargs):
+            done.add(name)
+            return function(*args, **kwargs)
+        return wrapper
+
+    monkeypatch.setattr(LifetimeData, "calculate", record("read", LifetimeData.calculate))
+    monkeypatch.setattr(lifetime_cal, "projection_coordinates", record("bin", lifetime_cal.projection_coordinates))
+    monkeypatch.setattr(LifetimeData, "data_lifetimes", record("calibrate", LifetimeData.data_lifetimes))
+    monkeypatch.setattr(lifetime_cal, "file_stats", record("stats", lifetime_cal.file_stats))
+    return done
+
+
+def analyse(work):
+    """Analyse the files, returning the work done"""
+    work.clear()
+    # LifetimeData reads the reference file and lifetime when it is created, as for every analysis in the application
+    lifetime_data = LifetimeData(None, None)
+    # nothing is connected to the progress signals, and emitting them loses a reference to True with some PySide6
+    # versions, which aborts the interpreter after a few thousand emits
+    lifetime_data.progressUpdated = lifetime_data.analysisFinished = types.SimpleNamespace(emit=lambda *args: None)
+    lifetime_data.analyse_data()
+    return set(work)
+
+
+def results(shared):
+    return {filename: {name: copy.deepcopy(result[name]) for name in ("g", "s", "M", "phi", "intensity", "stats")}
+            for filename, result in shared.results_dict.items()}
+
+
+def assert_same_results(result, expected):
+    assert result.keys() == expected.keys()
+    for filename in expected:
+        for name in ("g", "s", "M", "phi", "intensity"):
+            np.testing.assert_array_equal(result[filename][name], expected[filename][name])
+        assert result[filename]["stats"] == expected[filename]["stats"]
+
+
+@pytest.mark.parametrize("offset", ["False", "True"])
+@pytest.mark.parametrize("key", CHANGES)
+def test_changed_setting_recalculates_dependent_stages(shared, work, offset, key):
+    shared.config["subtract_offset"] = offset
+    analyse(work)
+    assert analyse(work) == set()  # nothing changed
+
+    value, work_without_offset, work_with_offset = CHANGES[key]
+    shared.config[key] = value
+    assert analyse(work) == (work_with_offset if offset == "True" else work_without_offset)
+    incremental = results(shared)
+
+    shared.results_dict.clear()
+    assert analyse(work) == {"read", "calibrate", "stats"} | ({"bin"} if offset == "False" else set())
+    assert_same_results(incremental, results(shared))
+
+
+@pytest.mark.parametrize("offset", ["False", "True"])
+def test_changed_inputs_recalculate_dependent_stages(shared, work, offset):
+    shared.config["subtract_offset"] = offset
+    analyse(work)
+
+    shared.raw_data_dict["f1"]["condition"] = "B"
+    assert analyse(work) == {"stats"}
+    mask = np.ones((24, 24), dtype=np.float32)
+    mask[:, 12:] = 2
+    shared.raw_data_dict["f1"]["mask_arr"] = mask
+    assert analyse(work) == ({"read", "calibrate", "stats"} if offset == "True" else {"bin", "calibrate", "stats"})
+    incremental = results(shared)
+
+    shared.results_dict.clear()
+    analyse(work)
+    assert_same_results(incremental, results(shared))
+
+
+def test_switching_offset_subtraction(shared, work):
+    analyse(work)
+    without_offset = results(shared)
+    shared.config["subtract_offset"] = "True"
+    assert analyse(work) == {"read", "calibrate", "stats"}
+    # the decay projections do not depend on the offset, they are kept and binned again
+    shared.config["subtract_offset"] = "False"
+    assert analyse(work) == {"bin", "calibrate", "stats"}
+    assert_same_results(results(shared), without_offset)
+
+
+def test_stale_stages_follow_the_dependencies():
+    config = {key: "a" for _, keys, _ in STAGES.values() for key in keys}
+    inputs = {key: "a" for _, _, keys in STAGES.values() for key in keys}
+    signatures = stage_signatures(config, inputs)
+    assert stale_stages({}, signatures) == set(STAGES)
+
+    def dependents(stage):
+        return {stage} | {name for name, (depends_on, _, _) in STAGES.items() for dependency in depends_on
+                          if dependency == stage for name in dependents(name)}
+
+    for stage, (_, config_keys, input_keys) in STAGES.items():
+        for key in config_keys:
+            assert stale_stages(signatures, stage_signatures(dict(config, **{key: "b"}), inputs)) == dependents(stage)
+        for key in input_keys:
+            assert stale_stages(signatures, stage_signatures(config, dict(inputs, **{key: "b"}))) == dependents(stage)
@@ -0,0 +1,175 @@
+"""Tests of the on-disk caches of phasor results (utils/phasor_cache.py) and .ptu histograms (utils/ptu_cache.py)"""
+import os
+import types
+
+import numpy as np
+
+from utils import ptu_cache
+from utils.flim_dataset import FlimDataset
+from utils.phasor_cache import PhasorCache, evict_lru
+from utils.ptu_cache import PtuCache
+
+T_SERIES = np.arange(16) * 1e-9
+
+
+def write_raw(path, data, mtime_ns=None):
+    """Write data as a raw file, optionally with a given modification time"""
+    data.tofile(path)
+    if mtime_ns is not None:
+        os.utime(path, ns=(mtime_ns, mtime_ns))
+    return FlimDataset.from_file(str(path), 0, data.dtype, data.shape, time_axis=0)
+
+
+def cube(seed, shape=(16, 8, 8)):
+    return np.random.default_rng(seed).poisson(3, shape).astype(np.uint16)
+
+
+def touch(path, ages):
+    """Files of the given sizes (bytes) last used the given seconds ago: {name: (size, age)}"""
+    for name, (size, age) in ages.items():
+        with open(os.path.join(path, name), "wb") as f:
+            f.write(b"\0" * size)
+        os.utime(os.path.join(path, name), (1e9 - age, 1e9 - age))
+
+
+def test_phasor_key_changes_with_the_parameters(tmp_path):
+    cache = PhasorCache(str(tmp_path / "cache"))
+    data = cube(0)
+    mask = np.ones((8, 8), dtype=np.float32)
+    key = cache.key(data, T_SERIES, region_mask=mask, bins=3, min_photons=0)
+
+    assert cache.key(data.copy(), T_SERIES.copy(), region_mask=mask.copy(), min_photons=0, bins=3) == key
+    changed = [cache.key(data, T_SERIES, region_mask=mask, bins=5, min_photons=0),
+               cache.key(data, T_SERIES, region_mask=mask, bins=3, min_photons=1),
+               cache.key(data, T_SERIES, region_mask=mask, bins=3, min_photons=0, offset_fraction=0.05),
+               cache.key(data, T_SERIES * 2, region_mask=mask, bins=3, min_photons=0),
+               cache.key(data, T_SERIES, region_mask=None, bins=3, min_photons=0),
+               cache.key(data, T_SERIES, region_mask=mask.astype(np.int32), bins=3, min_photons=0),
+               cache.key(cube(1), T_SERIES, region_mask=mask, bins=3, min_photons=0)]
+    assert len({key, *changed}) == len(changed) + 1
+
+
+def test_phasor_key_of_a_changed_file(tmp_path):
+    cache = PhasorCache(str(tmp_path / "cache"))
+    path = tmp_path / "data.raw"
+    data = cube(0)
+    key = cache.key(write_raw(path, data, mtime_ns=10**18), T_SERIES)
+    # memory-mapped files are hashed with their layout, so in-memory data of the same content has another key
+    assert cache.key(data, T_SERIES) != key
+    assert cache.key(write_raw(path, data, mtime_ns=10**18), T_SERIES) == key
+    # rewritten with the same content and a new modification time: hashed again, same key
+    assert cache.key(write_raw(path, data, mtime_ns=2 * 10**18), T_SERIES) == key
+
+    # a digest is only recalculated when the size or modification time changes
+    changed = cube(1)
+    assert cache.key(write_raw(path, changed, mtime_ns=2 * 10**18), T_SERIES) == key
+    assert cache.key(write_raw(path, changed, mtime_ns=3 * 10**18), T_SERIES) != key
+    assert cache.key(write_raw(path, cube(0, (16, 8, 4)), mtime_ns=3 * 10**18), T_SERIES) != key
+
+    # the digests of files are kept across sessions
+    assert PhasorCache(str(tmp_path / "cache"))._digests == cache._digests
+
+
+def test_phasor_cache_round_trip_and_eviction(tmp_path):
+    cache = PhasorCache(str(tmp_path / "cache"), max_bytes=10**6)
+    rng = np.random.default_rng(0)
+    arrays = {"g": rng.random(64, dtype=np.float32), "s": rng.random(64, dtype=np.float32)}
+    assert cache.get("a" * 40) is None
+    cache.put("a" * 40, arrays)
+    cached = cache.get("a" * 40)
+    assert cached.keys() == arrays.keys()
+    for name in arrays:
+        np.testing.assert_array_equal(cached[name], arrays[name])
+
+    # entries too large for the cache are evicted right away
+    cache.max_bytes = 0
+    cache.put("b" * 40, arrays)
+    assert cache.get("a" * 40) is None and cache.get("b" * 40) is None
+    assert os.listdir(cache.cache_dir) == []
+
+
+def test_evict_lru_removes_least_recently_used(tmp_path):
+    touch(tmp_path, {"old.npz": (300, 30), "older.npz": (300, 40), "new.npz": (300, 10), "newer.npz": (300, 0),
+                     "oldest.npy": (300, 100), "oldest.tmp.npz": (300, 100)})
+
+    evict_lru(str(tmp_path), 700, ".npz")
+    # only files with the suffix count, temporary files being written are left alone
+    assert sorted(os.listdir(tmp_path)) == ["new.npz", "newer.npz", "oldest.npy", "oldest.tmp.npz"]
+
+    evict_lru(str(tmp_path), 600, ".npz")
+    assert sorted(os.listdir(tmp_path)) == ["new.npz", "newer.npz", "oldest.npy", "oldest.tmp.npz"]
+
+
+def test_evict_lru_keeps_files(tmp_path):
+    touch(tmp_path, {"a.npy": (500, 30), "b.npy": (500, 20), "c.npy": (500, 10)})
+    keep = (os.path.join(str(tmp_path), "a.npy"),)
+
+    evict_lru(str(tmp_path), 1000, ".npy", keep=keep)
+    assert sorted(os.listdir(tmp_path)) == ["a.npy", "c.npy"]
+    # a kept file stays even if it does not fit on its own
+    evict_lru(str(tmp_path), 0, ".npy", keep=keep)
+    assert os.listdir(tmp_path) == ["a.npy"]
+
+
+def test_ptu_histograms_keyed_by_file_channel_and_binning(tmp_path):
+    cache = PtuCache(str(tmp_path / "cache"))
+    path = str(tmp_path / "image.ptu")
+    with open(path, "wb") as f:
+        f.write(b"records")
+    os.utime(path, ns=(10**18, 10**18))
+    histogram = cube(0).astype(np.uint32)
+
+    dataset = cache.put(path, 0, 1, histogram)
+    assert dataset.is_memmap
+    np.testing.assert_array_equal(np.asarray(cache.get(path, 0, 1)), histogram)
+    assert cache.get(path, 1, 1) is None
+    assert cache.get(path, 0, 2) is None
+
+    # the histogram of a changed file (modification time or size) is not used
+    os.utime(path, ns=(2 * 10**18, 2 * 10**18))
+    assert cache.get(path, 0, 1) is None
+    cache.put(path, 0, 1, histogram)
+    with open(path, "ab") as f:
+        f.write(b"more records")
+    os.utime(path, ns=(2 * 10**18, 2 * 10**18))
+    assert cache.get(path, 0, 1) is None
+
+
+def test_ptu_cache_evicts_older_histograms(tmp_path):
+    histogram = cube(0).astype(np.uint32)
+    cache = PtuCache(str(tmp_path / "cache"), max_bytes=histogram.nbytes + 1000)
+    paths = []
+    for name in ("a.ptu", "b.ptu"):
+        paths.append(str(tmp_path / name))
+        with open(paths[-1], "wb") as f:
+            f.write(name.encode())
+    cache.put(paths[0], 0, 1, histogram)
+    os.utime(cache._path(paths[0], 0, 1), (1e9, 1e9))
+
+    cache.put(paths[1], 0, 1, histogram)
+    assert cache.get(paths[0], 0, 1) is None
+    assert cache.get(paths[1], 0, 1) is not None
+    # the histogram just written is kept even if it is larger than the cache
+    cache.max_bytes = 0
+    cache.put(paths[0], 0, 1, histogram)
+    assert cache.get(paths[0], 0, 1) is not None
+    assert cache.get(paths[1], 0, 1) is None
+
+
+def test_ptu_headers_are_read_once(tmp_path, monkeypatch):
+    calls = []
+    monkeypatch.setattr(ptu_cache, "ptu_header", lambda ptu: calls.append(ptu.filepath) or {"shape": [1, 4, 4, 1, 16]})
+    path = str(tmp_path / "image.ptu")
+    with open(path, "wb") as f:
+        f.write(b"records")
+    ptu = types.SimpleNamespace(filepath=path)
+
+    cache = PtuCache(str(tmp_path / "cache"))
+    assert cache.header(ptu) == {"shape": [1, 4, 4, 1, 16]}
+    assert PtuCache(str(tmp_path / "cache")).header(ptu) == {"shape": [1, 4, 4, 1, 16]}
+    assert len(calls) == 1
+
+    with open(path, "ab") as f:
+        f.write(b"more records")
+    cache.header(ptu)
+    assert len(calls) == 2
@@ -0,0 +1,119 @@
+"""Tests of the background loading of raw data files (utils/file_loader.py)"""
+import threading
+import time
+
+import numpy as np
+import pytest
+from tifffile import imwrite
+
+from utils.errors import MaskingError
+from utils.file_loader import PrefetchLoader, load_file
+
+
+def drain(loader, timeout=10):
+    """(index, item, result or error) of every file handed out by the loader, polling ready() as the GUI does"""
+    handed_out = []
+    deadline = time.monotonic() + timeout
+    while not loader.done:
+        assert time.monotonic() < deadline, "loader did not finish"
+        for index, item, future in loader.ready():
+            try:
+                handed_out.append((index, item, future.result()))
+            except Exception as e:
+                handed_out.append((index, item, e))
+        time.sleep(0.001)
+    return handed_out
+
+
+def wait_until(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.001)
+
+
+def test_files_are_handed_out_in_order():
+    # later files finish first
+    items = [0.05, 0.0, 0.03, 0.0, 0.01, 0.0]
+    loader = PrefetchLoader(lambda delay: time.sleep(delay) or f"loaded {delay}", items, workers=3)
+    assert drain(loader) == [(i, delay, f"loaded {delay}") for i, delay in enumerate(items)]
+    assert list(loader.ready()) == []
+
+
+def test_errors_are_raised_by_the_future():
+    def load(item):
+        if item == "bad":
+            raise ValueError(item)
+        return item
+
+    handed_out = drain(PrefetchLoader(load, ["a", "bad", "b"], workers=2))
+    assert [item for _, item, _ in handed_out] == ["a", "bad", "b"]
+    assert isinstance(handed_out[1][2], ValueError)
+    assert handed_out[2][2] == "b"
+
+
+def test_files_loaded_ahead_are_bounded():
+    started = []
+    release = threading.Event()
+
+    def load(item):
+        started.append(item)
+        release.wait(5)
+        return item
+
+    loader = PrefetchLoader(load, range(20), workers=2, max_pending=3)
+    wait_until(lambda: len(started) == 2)
+    time.sleep(0.05)
+    assert sorted(started) == [0, 1]  # two threads, the third file waits for one of them
+    release.set()
+    # only the files the consumer takes make room for new ones
+    wait_until(lambda: len(started) == 3)
+    time.sleep(0.05)
+    assert sorted(started) == [0, 1, 2]
+    assert [result for _, _, result in drain(loader)] == list(range(20))
+
+
+def test_cancel_drops_pending_files():
+    started = []
+    release = threading.Event()
+
+    def load(item):
+        started.append(item)
+        release.wait(5)
+        return item
+
+    loader = PrefetchLoader(load, range(10), workers=2, max_pending=4)
+    wait_until(lambda: len(started) == 2)
+    loader.cancel()
+    release.set()
+    time.sleep(0.05)
+
+    assert loader.done
+    assert list(loader.ready()) == []
+    # the files being loaded when cancelled finish, the queued ones are never loaded
+    assert sorted(started) == [0, 1]
+
+
+@pytest.mark.parametrize("items", [[], iter([])])
+def test_no_files(items):
+    loader = PrefetchLoader(lambda item: item, items)
+    assert loader.done
+    assert list(loader.ready()) == []
+
+
+def test_load_file_with_mask(tmp_path):
+    cube = np.random.default_rng(0).poisson(3, (16, 12, 10)).astype(np.uint16)
+    imwrite(str(tmp_path / "cells.tif"), cube)
+    mask = np.zeros((12, 10), dtype=np.uint8)
+    mask[2:6, 3:8] = 1
+    imwrite(str(tmp_path / "cells segmentation.tif"), mask)
+
+    channels, t_series, mask_arr = load_file(str(tmp_path / "cells.tif"), bin_width=0.5, masks_dir=str(tmp_path))
+    [(_, data)] = channels
+    np.testing.assert_array_equal(np.asarray(data), cube)
+    np.testing.assert_array_equal(data.intensity(), cube.sum(0))
+    np.testing.assert_allclose(t_series, np.arange(16) * 0.5e-9)
+    np.testing.assert_array_equal(mask_arr, mask)
+
+    with pytest.raises(MaskingError, match="cells"):
+        load_file(str(tmp_path / "cells.tif"), masks_dir=str(tmp_path / "missing"))
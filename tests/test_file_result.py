@@ -0,0 +1,59 @@
+"""Tests of the per-file results (utils/file_result.py)"""
+import numpy as np
+import pytest
+
+from utils.file_result import FileResult, derived_map
+
+
+def result():
+    rng = np.random.default_rng(0)
+    M, phi = rng.uniform(1e-9, 4e-9, 64).astype(np.float32), rng.uniform(1e-9, 4e-9, 64).astype(np.float32)
+    return FileResult(M=M, phi=phi, img_shape=(16, 8, 8), condition="A")
+
+
+def test_maps_are_slots():
+    r = result()
+    assert not hasattr(r, "__dict__")
+    assert r["condition"] == "A" and r.condition == "A"
+    r["g"] = np.zeros(64, dtype=np.float32)
+    assert list(r) == ["img_shape", "g", "M", "phi", "condition"]  # stored keys, in the order of the slots
+    assert len(r) == 5
+    assert "g" in r and "s" not in r
+    with pytest.raises(KeyError):
+        r["s"]
+    del r["g"]
+    assert "g" not in r
+    with pytest.raises(KeyError):
+        del r["g"]
+
+
+def test_average_is_derived_when_read():
+    r = result()
+    assert "average" in r
+    assert "average" not in list(r)
+    np.testing.assert_array_equal(r["average"], (r["M"] + r["phi"]) / 2)
+    assert r["average"].dtype == np.float32
+    r["M"] = r["M"] * 2
+    np.testing.assert_array_equal(r["average"], (r["M"] + r["phi"]) / 2)
+    with pytest.raises(KeyError):
+        r["average"] = r["M"]
+
+    del r["phi"]
+    assert "average" not in r
+    with pytest.raises(KeyError):
+        r["average"]
+    with pytest.raises(KeyError):
+        derived_map(r, "M")
+
+
+def test_other_keys():
+    r = result()
+    r["note"] = "dim"
+    assert r["note"] == "dim" and "note" in r
+    assert list(r)[-1] == "note"
+    assert r.get("missing") is None
+    del r["note"]
+    assert "note" not in r
+    with pytest.raises(KeyError):
+        del r["note"]
+    assert list(FileResult(r)) == list(r)
@@ -0,0 +1,90 @@
+"""Tests of the density images of phasor coordinates (utils/phasor_density.py) against binning every point"""
+import numpy as np
+import pytest
+from matplotlib import colors
+
+from utils.phasor_density import (DENSITY_BINS, PHASOR_EXTENT, bin_index, density_alpha, density_image, file_histogram,
+                                  phasor_histogram, phasor_points, sum_histograms)
+
+
+def phasors(seed, n=5000):
+    """Random phasor points across and around the density grid, with background (zero) pixels"""
+    rng = np.random.default_rng(seed)
+    g = rng.uniform(-0.4, 1.4, n).astype(np.float32)
+    s = rng.uniform(-0.1, 0.9, n).astype(np.float32)
+    background = rng.random(n) < 0.2
+    g[background] = s[background] = 0
+    return g, s
+
+
+def brute_force_counts(g, s, weights=None):
+    """Counts (or summed weights) of the points in every density bin, one point at a time"""
+    nx, ny = DENSITY_BINS
+    width, height = (PHASOR_EXTENT[1] - PHASOR_EXTENT[0]) / nx, (PHASOR_EXTENT[3] - PHASOR_EXTENT[2]) / ny
+    counts = np.zeros((ny, nx))
+    for k, (x, y) in enumerate(zip(g.astype(np.float64), s.astype(np.float64))):
+        column, row = int(np.floor((x - PHASOR_EXTENT[0]) / width)), int(np.floor((y - PHASOR_EXTENT[2]) / height))
+        if 0 <= column < nx and 0 <= row < ny:
+            counts[row, column] += 1 if weights is None else weights[k]
+    return counts
+
+
+def test_phasor_histogram_matches_brute_force():
+    g, s = phasor_points(*phasors(0))
+    weights = np.random.default_rng(1).random(g.size)
+    np.testing.assert_array_equal(phasor_histogram(g, s), brute_force_counts(g, s))
+    np.testing.assert_allclose(phasor_histogram(g, s, weights=weights), brute_force_counts(g, s, weights), rtol=1e-12)
+    # the corners of the grid: the upper limits are outside it
+    index = bin_index(np.array([PHASOR_EXTENT[0], PHASOR_EXTENT[1], 0.5, np.nan]),
+                      np.array([PHASOR_EXTENT[2], 0.4, PHASOR_EXTENT[3], 0.4]))
+    np.testing.assert_array_equal(index, [0, -1, -1, -1])
+
+
+def test_file_histogram_matches_brute_force():
+    g, s = phasors(2)
+    histogram = file_histogram(g, s)
+    # background pixels are left out, points outside the grid are counted as points
+    np.testing.assert_array_equal(histogram.dense(), brute_force_counts(*phasor_points(g, s)))
+    assert histogram.points == np.count_nonzero((g != 0) & (s != 0))
+    assert histogram.pixels == g.size
+    assert np.all(histogram.counts > 0)
+    assert histogram.index.dtype == np.int32 and histogram.counts.dtype == np.uint32
+
+
+def test_sum_histograms_matches_all_points():
+    files = [phasors(seed, n) for seed, n in zip(range(3), (5000, 100, 2000))]
+    total = sum_histograms(file_histogram(g, s) for g, s in files)
+    expected = file_histogram(np.concatenate([g for g, _ in files]), np.concatenate([s for _, s in files]))
+    np.testing.assert_array_equal(total.index, expected.index)
+    np.testing.assert_array_equal(total.counts, expected.counts)
+    assert (total.points, total.pixels) == (expected.points, expected.pixels)
+
+    empty = sum_histograms([])
+    assert empty.index.size == 0 and (empty.points, empty.pixels) == (0, 0)
+    assert not empty.dense().any()
+
+
+def test_density_image_composites_layers():
+    layers = [(file_histogram(*phasors(seed)), color) for seed, color in zip(range(3), ("red", "#00ff00", (0, 0, 1)))]
+    image = density_image(layers, alpha=0.5)
+    assert image.shape == (DENSITY_BINS[1], DENSITY_BINS[0], 4)
+
+    # composite every bin of the layers one over the other, as markers of one colour would be drawn
+    expected = np.zeros((DENSITY_BINS[1], DENSITY_BINS[0], 4))
+    for histogram, color in layers:
+        counts = histogram.dense()
+        filled = counts > 0
+        a = density_alpha(counts[filled], 0.5)[:, np.newaxis]
+        under = expected[filled]
+        rgb = (np.asarray(colors.to_rgb(color)) * a + under[:, :3] * under[:, 3:] * (1 - a))
+        alpha = a + under[:, 3:] * (1 - a)
+        expected[filled] = np.hstack((rgb / alpha, alpha))
+    np.testing.assert_allclose(image, expected, rtol=1e-12, atol=1e-15)
+    assert (image[..., 3] > 0).sum() == np.count_nonzero(sum(h.dense() for h, _ in layers))
+
+
+def test_density_alpha():
+    alpha = density_alpha(np.array([1.0, 10.0, 100.0]), 0.5)
+    assert alpha[-1] == pytest.approx(0.5)
+    assert alpha[0] >= 0.125
+    assert np.all(np.diff(alpha) > 0)
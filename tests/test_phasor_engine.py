@@ -0,0 +1,171 @@
+"""Tests of the numerical core of the phasor analysis (utils/phasor_engine.py)"""
+import math
+import tracemalloc
+
+import numpy as np
+import pytest
+from scipy import signal
+from tifffile import imwrite
+
+from utils import phasor_engine
+from utils.batch import analyse_sample
+from utils.flim_dataset import FlimDataset
+from utils.phasor_engine import phasor_coordinates
+
+T, X, Y = 256, 1024, 1024
+W = 2 * math.pi * 80e6
+T_SERIES = np.arange(T) * (12.5e-9 / T)
+BUDGET = 128 * 2**20
+
+
+@pytest.fixture(scope="module")
+def stack(tmp_path_factory):
+    """1024x1024x256 uint16 decays memory-mapped from a file, so only the tiles read by the engine are in memory"""
+    path = str(tmp_path_factory.mktemp("stack") / "stack.raw")
+    decay = np.where(T_SERIES >= T_SERIES[16], np.exp(-(T_SERIES - T_SERIES[16]) / 2.5e-9), 0)
+    amplitude = np.random.default_rng(0).uniform(0, 2, (X, Y, 1))
+    raw = np.memmap(path, dtype=np.uint16, mode="w+", shape=(X, Y, T))
+    for start in range(0, X, 64):
+        raw[start:start + 64] = np.rint(amplitude[start:start + 64] * decay + 1).astype(np.uint16)
+    raw.flush()
+    del raw
+    return FlimDataset.from_file(path, 0, np.uint16, (X, Y, T), time_axis=2)
+
+
+@pytest.mark.parametrize("offset_fraction", [None, 0.05])
+def test_peak_memory_within_budget(stack, offset_fraction):
+    tracemalloc.start()
+    try:
+        g, s, shape, intensity = phasor_coordinates(stack, T_SERIES, W, bins=3, min_photons=20,
+                                                    offset_fraction=offset_fraction, memory_budget=BUDGET)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    assert peak <= BUDGET
+    assert shape == (T, X - 2, Y - 2)
+    assert np.count_nonzero(g) > 0
+
+
+def test_reference_binned_over_whole_height(stack):
+    # a reference is binned with bins = T in 'valid' mode: with offset subtraction its boxes reach 255 rows down
+    tracemalloc.start()
+    try:
+        g, s, shape, intensity = phasor_coordinates(stack, T_SERIES, W, bins=T, offset_fraction=0.05,
+                                                    memory_budget=phasor_engine.MEMORY_BUDGET)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    assert peak <= phasor_engine.MEMORY_BUDGET
+    assert shape == (T, X - T + 1, Y - T + 1)
+    # first output pixel: the decays of the top left T x T box summed, offset subtracted
+    decay = np.asarray(stack.rows(0, T))[:, :, :T].sum(axis=(1, 2), dtype=np.float64)
+    decay = np.clip(decay - decay[:int(0.05 * T)].mean(), 0, None)
+    cos, sin = phasor_engine.phasor_basis(W, T_SERIES)
+    assert g[0] == pytest.approx(decay @ cos / decay.sum(), rel=1e-5)
+    assert s[0] == pytest.approx(decay @ sin / decay.sum(), rel=1e-5)
+
+
+@pytest.mark.parametrize("offset_fraction, budget", [(None, phasor_engine.MEMORY_BUDGET), (0.25, 32 * 2**20)])
+def test_budget_too_small_for_image(tmp_path, offset_fraction, budget):
+    # the whole-image arrays of a 2048x2048 image alone take the budget: 256 MB without offset subtraction (intensity,
+    # projections and binned images), 48 MB with it (masked intensity, g and s)
+    n_time_bins, size = 8, 2048
+    path = str(tmp_path / "large.raw")
+    raw = np.memmap(path, dtype=np.uint16, mode="w+", shape=(n_time_bins, size, size))
+    raw[:] = np.random.default_rng(2).poisson(4, (n_time_bins, 1, size)).astype(np.uint16) + np.arange(size)[:, None] % 3
+    raw.flush()
+    del raw
+    data = FlimDataset.from_file(path, 0, np.uint16, (n_time_bins, size, size), time_axis=0)
+    t_series = T_SERIES[:n_time_bins]
+
+    with pytest.warns(RuntimeWarning, match="one row at a time"):
+        g, s, shape, intensity = phasor_coordinates(data, t_series, W, bins=3, offset_fraction=offset_fraction,
+                                                    memory_budget=budget)
+    expected = phasor_coordinates(data, t_series, W, bins=3, offset_fraction=offset_fraction, memory_budget=2**31)
+    assert shape == expected[2] == (n_time_bins, size - 2, size - 2)
+    for result, reference in zip((g, s, intensity), expected[:2] + expected[3:]):
+        np.testing.assert_allclose(result, reference, rtol=1e-6)
+
+
+def _fftconvolve_coordinates(data, t_series, bins, min_photons, mode_same, region_mask):
+    """g, s and binned shape of the original implementation: mask and bin the whole cube with fftconvolve"""
+    intensity = data.sum(0)
+    keep = (intensity >= min_photons) & (np.ones(intensity.shape, bool) if region_mask is None else region_mask != 0)
+    masked_data = np.where(keep, data, 0).astype(np.float64)
+    # the counts are integers, rounding removes the round-off of the FFT (which would make background pixels nonzero)
+    binned = np.rint(signal.fftconvolve(masked_data, np.ones((1, bins, bins)), mode='same' if mode_same else 'valid'))
+    if mode_same:
+        binned = np.where(masked_data.sum(0) == 0, 0, binned)
+    bin_int = binned.sum(0)
+    g = np.divide(np.tensordot(np.cos(W * t_series), binned, 1), bin_int, out=np.zeros_like(bin_int), where=bin_int != 0)
+    s = np.divide(np.tensordot(np.sin(W * t_series), binned, 1), bin_int, out=np.zeros_like(bin_int), where=bin_int != 0)
+    return g.reshape(-1), s.reshape(-1), binned.shape
+
+
+@pytest.mark.parametrize("bins", [1, 3, 7])
+@pytest.mark.parametrize("mode_same", [False, True])
+@pytest.mark.parametrize("with_mask", [False, True])
+def test_reduce_then_bin_matches_binned_cube(bins, mode_same, with_mask):
+    # the first 4 time bins are empty, so subtracting their offset leaves the decays unchanged and the binned-cube
+    # path of offset subtraction must give the same coordinates as reduce-then-bin
+    n_time_bins, offset_bins = 32, 4
+    t_series = T_SERIES[:n_time_bins]
+    rng = np.random.default_rng(5)
+    data = rng.poisson(rng.uniform(0, 3, (1, 41, 37)) * np.exp(-np.arange(n_time_bins) / 10)[:, None, None])
+    data[:offset_bins] = 0
+    data = data.astype(np.uint16)
+    region_mask = rng.integers(0, 3, (41, 37)).astype(np.float32) if with_mask else None
+    kwargs = dict(bins=bins, min_photons=10, mode_same=mode_same, region_mask=region_mask, memory_budget=2**20)  # tiles of a few rows
+
+    g, s, shape, intensity = phasor_coordinates(data, t_series, W, **kwargs)
+    cube_g, cube_s, cube_shape, cube_intensity = phasor_coordinates(data, t_series, W, offset_fraction=offset_bins / n_time_bins,
+                                                                    **kwargs)
+    ref_g, ref_s, ref_shape = _fftconvolve_coordinates(data, t_series, bins, 10, mode_same, region_mask)
+
+    assert shape == cube_shape == ref_shape
+    np.testing.assert_array_equal(intensity, cube_intensity)
+    assert np.count_nonzero(g) > 0
+    for result in ((g, s), (cube_g, cube_s)):
+        np.testing.assert_array_equal(result[0] != 0, ref_g != 0)
+        np.testing.assert_allclose(result[0], ref_g, rtol=1e-5, atol=1e-6)
+        np.testing.assert_allclose(result[1], ref_s, rtol=1e-5, atol=1e-6)
+
+
+def _analyse_tiff(path, offset_fraction):
+    """Stored results of a .tif file analysed by the batch runner"""
+    settings = {"bin_width": "estimate", "ptu_channel": 0, "ptu_time_binning": 1, "frequency": 80, "masks_dir": None,
+                "bins": 3, "min_photons": 20, "max_photons": None, "offset_fraction": offset_fraction,
+                "memory_budget": BUDGET, "condition": "A"}
+    return analyse_sample(path, settings, 1.1, 0.05)
+
+
+@pytest.mark.parametrize("offset_fraction", [None, 0.05])
+def test_float32_maps_match_float64(tmp_path, monkeypatch, offset_fraction):
+    # decays of lifetimes from 0.5 to 8 ns rising after 8 time bins of background, 256x256 pixels
+    rng = np.random.default_rng(1)
+    t = np.arange(64) * (12.5e-9 / 64)
+    tau = rng.uniform(0.5e-9, 8e-9, (1, 256, 256))
+    decays = np.where(t[:, None, None] >= t[8], 200 * np.exp(-(t[:, None, None] - t[8]) / tau), 0)
+    cube = rng.poisson(decays + 2).astype(np.uint16)
+    path = str(tmp_path / "decays.tif")
+    imwrite(path, cube)
+
+    result = _analyse_tiff(path, offset_fraction)
+    monkeypatch.setattr(phasor_engine, "FLOAT_DTYPE", np.float64)
+    reference = _analyse_tiff(path, offset_fraction)
+
+    maps = ("intensity", "g", "s", "M", "phi")
+    for name in maps:
+        assert result[name].dtype == np.float32
+        assert reference[name].dtype == np.float64
+    np.testing.assert_allclose(result["intensity"], reference["intensity"], rtol=1e-6)
+    for name in ("g", "s"):
+        np.testing.assert_allclose(result[name], reference[name], rtol=1e-5, atol=1e-6)
+    # lifetimes of phasors near the s axis (g ~ 0) are ill-conditioned in any precision
+    conditioned = np.abs(reference["g"]) > 0.01
+    assert conditioned.mean() > 0.99
+    for name in ("M", "phi"):
+        np.testing.assert_allclose(result[name][conditioned], reference[name][conditioned], rtol=1e-5, atol=1e-13)
+    assert sum(result[name].nbytes for name in maps) == pytest.approx(0.5 * sum(reference[name].nbytes for name in maps))
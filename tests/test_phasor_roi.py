@@ -0,0 +1,73 @@
+"""Tests of the phasor ROIs (utils/phasor_roi.py) and the ROI fractions of the statistics table"""
+import numpy as np
+import pandas as pd
+import pytest
+
+from utils.phasor_roi import EllipseROI, PolygonROI, PhasorIndex, apply_rois
+from utils.region_stats import roi_fractions
+
+ROIS = [
+    EllipseROI(0.6, 0.3, 0.25, 0.12),
+    EllipseROI(0.1, 0.05, 0.4, 0.3),  # reaches outside the density grid
+    PolygonROI(((0.2, 0.1), (0.9, 0.15), (0.7, 0.5), (0.45, 0.25), (0.3, 0.55))),  # concave
+    PolygonROI(((-0.5, -0.1), (1.5, -0.1), (0.5, 1.0))),  # larger than the density grid
+]
+
+
+def inside(roi, g, s):
+    """Brute-force test of every point: the ellipse equation, or even-odd ray casting along g for polygons"""
+    if isinstance(roi, EllipseROI):
+        return ((g - roi.x0) / roi.a) ** 2 + ((s - roi.y0) / roi.b) ** 2 <= 1
+    result = np.zeros(g.shape, dtype=bool)
+    vertices = list(roi.vertices)
+    for (x1, y1), (x2, y2) in zip(vertices, vertices[1:] + vertices[:1]):
+        crosses = (y1 > s) != (y2 > s)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            x = x1 + (s - y1) * (x2 - x1) / (y2 - y1)
+        result ^= crosses & (g < x)
+    return result
+
+
+def phasors(seed, n=20000):
+    """Random phasor points across and around the phasor plot, with background (zero) pixels"""
+    rng = np.random.default_rng(seed)
+    g = rng.uniform(-0.4, 1.4, n).astype(np.float32)
+    s = rng.uniform(-0.1, 0.9, n).astype(np.float32)
+    background = rng.random(n) < 0.2
+    g[background] = s[background] = 0
+    return g, s
+
+
+@pytest.mark.parametrize("roi", ROIS)
+def test_phasor_index_matches_brute_force(roi):
+    g, s = phasors(0)
+    np.testing.assert_array_equal(PhasorIndex(g, s).select(roi), inside(roi, g, s))
+
+
+def test_apply_rois_matches_brute_force():
+    results = {f"file{i}": dict(zip("gs", phasors(i))) for i in range(3)}
+    masks = apply_rois(results, ROIS)
+    for name, result in results.items():
+        g, s = result["g"], result["s"]
+        assert masks[name].shape == (len(ROIS), g.size)
+        for mask, roi in zip(masks[name], ROIS):
+            # background pixels are in no ROI
+            np.testing.assert_array_equal(mask, inside(roi, g, s) & (g != 0) & (s != 0))
+
+
+def test_roi_fractions_match_brute_force():
+    g, s = phasors(3, n=100 * 100)
+    labels = np.random.default_rng(4).integers(0, 4, (100, 100)).astype(np.float32)
+    results = {"a": {"g": g, "s": s, "mask": labels}, "b": {"g": g[::-1].copy(), "s": s[::-1].copy(), "mask": None}}
+    df_stats = pd.DataFrame({"sample": ["a", "a", "a", "b"], "condition": "None", "region": [1, 2, 3, 1],
+                             "roi_1": 0.5})  # columns of previous ROIs are replaced
+    table = roi_fractions(df_stats, results, apply_rois(results, ROIS))
+
+    assert list(table.columns) == ["sample", "condition", "region"] + [f"roi_{k + 1}" for k in range(len(ROIS))]
+    for _, row in table.iterrows():
+        result = results[row["sample"]]
+        region = np.ones(g.size, dtype=bool) if result["mask"] is None else result["mask"].reshape(-1) == row["region"]
+        pixels = region & (result["g"] != 0) & (result["s"] != 0)
+        for k, roi in enumerate(ROIS):
+            expected = np.count_nonzero(pixels & inside(roi, result["g"], result["s"])) / np.count_nonzero(pixels)
+            assert row[f"roi_{k + 1}"] == pytest.approx(expected, abs=5e-6)
@@ -0,0 +1,78 @@
+"""Tests of the frame by frame decoding of multi-frame .ptu files (utils/file_readers.py) and of the time-lapse phasor
+coordinates calculated from it (utils/phasor_engine.py)"""
+import math
+
+import numpy as np
+import pytest
+from ptufile import PtuFile, imwrite
+
+from utils import file_readers
+from utils.file_readers import decode_ptu_frames, ptu_frame_segments, ptu_header
+from utils.phasor_engine import phasor_coordinates, time_lapse_coordinates
+
+FRAMES, Y, X, CHANNELS, H = 5, 12, 10, 2, 32
+
+
+@pytest.fixture(scope="module")
+def ptu_path(tmp_path_factory):
+    """T3 image of 5 frames and 2 channels, with a different decay in every frame"""
+    rng = np.random.default_rng(0)
+    t = np.arange(H)
+    rate = np.stack([np.exp(-np.maximum(t - 4, 0) / (3 + 2 * frame)) * (t >= 4) + 0.05 for frame in range(FRAMES)])
+    data = rng.poisson(rate[:, None, None, None, :], (FRAMES, Y, X, CHANNELS, H)).astype(np.uint8)
+    path = str(tmp_path_factory.mktemp("ptu") / "frames.ptu")
+    imwrite(path, data, global_resolution=25e-9, tcspc_resolution=25e-9 / H, has_frames=False)
+    return path
+
+
+@pytest.fixture
+def ptu(ptu_path):
+    with PtuFile(ptu_path) as ptu:
+        yield ptu
+
+
+def frames(ptu, start, stop, channel=0, time_binning=1):
+    """(T, X, Y) histogram of frames start to stop decoded by ptufile from the whole file"""
+    image = ptu.decode_image(dtype=np.uint32)[start:stop, :, :, channel].sum(0)  # (Y, X, H)
+    image = image.reshape(Y, X, -1, time_binning).sum(-1)
+    return np.transpose(image, (2, 1, 0))
+
+
+def test_frame_segments(ptu, monkeypatch):
+    records = ptu.read_records(memmap=True)
+    segments = ptu_frame_segments(ptu, records)
+    assert len(segments) == FRAMES
+    assert all(start < stop for start, stop in segments)
+    assert segments[-1][1] <= records.size
+
+    # markers split across the chunks the records are decoded in
+    monkeypatch.setattr(file_readers, "_PTU_RECORDS_CHUNK", 7)
+    assert ptu_frame_segments(ptu, records) == segments
+
+
+@pytest.mark.parametrize("start, stop, channel, time_binning", [(0, 1, 0, 1), (4, 5, 1, 1), (1, 4, 0, 2), (0, 5, 1, 4)])
+def test_decode_frames_matches_whole_file(ptu, start, stop, channel, time_binning):
+    records = ptu.read_records(memmap=True)
+    segments = ptu_frame_segments(ptu, records)
+    decoded = decode_ptu_frames(ptu, records, segments, start, stop, channel, time_binning)
+    np.testing.assert_array_equal(np.asarray(decoded), frames(ptu, start, stop, channel, time_binning))
+
+
+@pytest.mark.parametrize("window, step, offset_fraction", [(1, 1, None), (3, 1, None), (2, 2, None), (3, 2, 0.1)])
+def test_time_lapse_matches_summed_frames(ptu, window, step, offset_fraction):
+    records = ptu.read_records(memmap=True)
+    segments = ptu_frame_segments(ptu, records)
+    t_series = np.asarray(ptu_header(ptu)["t_series"], dtype=np.float32)
+    w = 2 * math.pi * 40e6
+
+    windows = list(time_lapse_coordinates(lambda start, stop: decode_ptu_frames(ptu, records, segments, start, stop),
+                                          len(segments), t_series, w, 3, window, step, min_photons=2,
+                                          offset_fraction=offset_fraction, mode_same=True))
+    assert [start for start, *_ in windows] == list(range(0, FRAMES - window + 1, step))
+    for start, g, s, img_shape, intensity in windows:
+        expected = phasor_coordinates(frames(ptu, start, start + window), t_series, w, 3, min_photons=2,
+                                      offset_fraction=offset_fraction, mode_same=True)
+        assert img_shape == expected[2]
+        np.testing.assert_allclose(g, expected[0], rtol=1e-5, atol=1e-6)
+        np.testing.assert_allclose(s, expected[1], rtol=1e-5, atol=1e-6)
+        np.testing.assert_allclose(intensity, expected[3], rtol=1e-6)
@@ -0,0 +1,150 @@
+"""Tests of the lifetime statistics per mask region (utils/region_stats.py) against a loop over the regions"""
+import numpy as np
+import pytest
+
+from utils.region_stats import (DETAIL_STATS, LIFETIME_MAPS, PHASOR_STATS, _segment_percentile, file_stats,
+                                region_labels, region_phasor_statistics, region_statistics)
+
+MASKS = {
+    "integer": np.random.default_rng(0).integers(0, 6, (40, 30)).astype(np.float32),
+    "sparse": np.where(np.random.default_rng(1).random((40, 30)) < 0.5, 0, 5000).astype(np.uint16),  # above the size
+    "non-integer": np.random.default_rng(2).choice([0, 0.5, 1.5, 2.25], (40, 30)),
+    "negative": np.random.default_rng(3).choice([-3, -1, 0, 2, 7], (40, 30)).astype(np.int32),
+    "background": np.zeros((40, 30)),
+}
+
+
+def loop_regions(mask):
+    """Boolean (flattened) pixels of every region, as the loop over np.unique of the mask"""
+    return [(mask == region).reshape(-1) for region in np.unique(mask[mask != 0])]
+
+
+def lifetime_map(seed, size=1200):
+    """Lifetimes (s) with background (zero) pixels"""
+    rng = np.random.default_rng(seed)
+    return np.where(rng.random(size) < 0.3, 0, rng.uniform(0.5e-9, 5e-9, size)).astype(np.float32)
+
+
+@pytest.mark.parametrize("name", MASKS)
+def test_region_labels_match_loop(name):
+    mask = MASKS[name]
+    labels, n_regions = region_labels(mask, mask.size)
+    regions = loop_regions(mask)
+
+    assert n_regions == len(regions)
+    assert labels.shape == (mask.size,)
+    np.testing.assert_array_equal(labels == 0, mask.reshape(-1) == 0)
+    for label, region in enumerate(regions, start=1):
+        np.testing.assert_array_equal(labels == label, region)
+
+
+def test_region_labels_without_mask():
+    labels, n_regions = region_labels(None, 12)
+    assert n_regions == 1
+    np.testing.assert_array_equal(labels, np.ones(12))
+
+
+@pytest.mark.parametrize("name", MASKS)
+def test_region_statistics_match_loop(name):
+    mask = MASKS[name]
+    maps = {"M": lifetime_map(4), "phi": lifetime_map(5)}
+    regions = loop_regions(mask)
+    if regions:
+        # a region whose pixels are all background has no statistics
+        maps["M"][regions[0]] = 0
+    labels, n_regions = region_labels(mask, mask.size)
+    statistics = region_statistics(labels, n_regions, maps, percentiles=(10, 25, 75, 100))
+
+    for name, tau_map in maps.items():
+        stats = statistics[name]
+        assert set(stats) == {"count", "mean", "std", "median", "p10", "p25", "p75", "p100"}
+        for index, region in enumerate(regions):
+            values = tau_map[region]
+            values = values[values > 0].astype(np.float64)
+            assert stats["count"][index] == values.size
+            if values.size == 0:
+                assert all(np.isnan(stats[key][index]) for key in stats if key != "count")
+                continue
+            assert stats["mean"][index] == pytest.approx(values.mean(), rel=1e-12)
+            assert stats["std"][index] == pytest.approx(values.std(), rel=1e-9)
+            assert stats["median"][index] == pytest.approx(np.median(values), rel=1e-12)
+            for q in (10, 25, 75, 100):
+                assert stats[f"p{q}"][index] == pytest.approx(np.percentile(values, q), rel=1e-12)
+
+
+def test_region_statistics_without_percentiles():
+    labels, n_regions = region_labels(MASKS["integer"], 1200)
+    stats = region_statistics(labels, n_regions, {"M": lifetime_map(6)}, percentiles=None)["M"]
+    assert set(stats) == {"count", "mean", "std"}
+
+
+@pytest.mark.parametrize("q", [0, 25, 50, 62.5, 100])
+def test_segment_percentile_matches_numpy(q):
+    rng = np.random.default_rng(7)
+    count = np.array([0, 1, 2, 5, 0, 17, 3, 0])
+    segments = [np.sort(rng.random(n)) for n in count]
+    starts = np.concatenate(([0], np.cumsum(count)[:-1]))
+
+    result = _segment_percentile(np.concatenate(segments), starts, count, q)
+    for value, segment in zip(result, segments):
+        if segment.size == 0:
+            assert np.isnan(value)
+        else:
+            assert value == pytest.approx(np.percentile(segment, q), rel=1e-12)
+
+
+def phasor_result(seed, mask):
+    """Results of one file: lifetime maps, phasor coordinates with background pixels and photon counts"""
+    rng = np.random.default_rng(seed)
+    g, s = rng.uniform(0, 1, 1200).astype(np.float32), rng.uniform(0, 0.5, 1200).astype(np.float32)
+    background = rng.random(1200) < 0.2
+    g[background] = s[background] = 0
+    intensity = np.where(rng.random((40, 30)) < 0.1, 0, rng.poisson(50, (40, 30))).astype(np.float32)
+    result = {name: lifetime_map(seed + i) for i, name in enumerate(LIFETIME_MAPS)}
+    result.update(g=g, s=s, intensity=intensity, mask=mask, condition="A")
+    return result
+
+
+@pytest.mark.parametrize("name", MASKS)
+def test_region_phasor_statistics_match_loop(name):
+    mask = MASKS[name]
+    result = phasor_result(8, mask)
+    regions = loop_regions(mask)
+    if regions:
+        # a region without photons has no centroid
+        result["intensity"].reshape(-1)[regions[0]] = 0
+    labels, n_regions = region_labels(mask, mask.size)
+    stats = region_phasor_statistics(labels, n_regions, result["g"], result["s"], result["intensity"])
+
+    assert set(stats) == set(PHASOR_STATS)
+    for index, region in enumerate(regions):
+        pixels = region & (result["g"] != 0) & (result["s"] != 0) & (result["intensity"].reshape(-1) > 0)
+        weights = result["intensity"].reshape(-1)[pixels].astype(np.float64)
+        g, s = result["g"][pixels].astype(np.float64), result["s"][pixels].astype(np.float64)
+        assert stats["photons"][index] == weights.sum()
+        if weights.sum() == 0:
+            assert np.isnan(stats["g_centroid"][index]) and np.isnan(stats["phasor_dispersion"][index])
+            continue
+        g_centroid, s_centroid = np.average(g, weights=weights), np.average(s, weights=weights)
+        dispersion = np.sqrt(np.average((g - g_centroid) ** 2 + (s - s_centroid) ** 2, weights=weights))
+        assert stats["g_centroid"][index] == pytest.approx(g_centroid, rel=1e-9)
+        assert stats["s_centroid"][index] == pytest.approx(s_centroid, rel=1e-9)
+        assert stats["phasor_dispersion"][index] == pytest.approx(dispersion, rel=1e-9)
+
+
+@pytest.mark.parametrize("detail", [False, True])
+def test_file_stats_columns(detail):
+    mask = MASKS["integer"]
+    result = phasor_result(9, mask)
+    rows = file_stats("a", result, detail)
+
+    columns = ["sample", "condition", "region"] + [f"{name}{suffix}" for name in LIFETIME_MAPS for suffix in ("", "_mean")]
+    if detail:
+        columns += ["pixels"] + [f"{name}_{stat}" for name in LIFETIME_MAPS for stat in DETAIL_STATS] + list(PHASOR_STATS)
+    assert [list(row) for row in rows] == [columns] * len(loop_regions(mask))
+    for row, region in zip(rows, loop_regions(mask)):
+        lifetimes = result["M"][region]
+        assert row["M"] == round(float(lifetimes[lifetimes > 0].astype(np.float64).mean()) * 1e9, 3)
+        if detail:
+            assert row["pixels"] == np.count_nonzero(result["average"][region] > 0)
+            assert row["M_median"] == round(float(np.median(lifetimes[lifetimes > 0])) * 1e9, 3)
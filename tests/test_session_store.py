@@ -0,0 +1,97 @@
+"""Tests of the session files (utils/session_store.py)"""
+import os
+import hashlib
+import subprocess
+import sys
+import types
+
+import numpy as np
+import pytest
+
+from utils import session_store
+from utils.file_result import FileResult
+from utils.flim_dataset import FlimDataset
+from utils.session_store import SessionStore, load_session, remove_stale_sessions, save_session
+
+
+@pytest.fixture(autouse=True)
+def session_dir(tmp_path, monkeypatch):
+    """Temporary session files in a folder of the test"""
+    path = tmp_path / "sessions"
+    monkeypatch.setattr(session_store, "SESSION_DIR", str(path))
+    return path
+
+
+def shared_data():
+    """Session state of SharedData with one analysed file, without a session store"""
+    rng = np.random.default_rng(0)
+    cube = FlimDataset(rng.poisson(3, (16, 8, 8)).astype(np.float32), "a.sdt")
+    g, s = rng.random(64, dtype=np.float32), rng.random(64, dtype=np.float32)
+    result = FileResult(intensity=cube.intensity(), g=g, s=s, M=g * 1e-9, phi=s * 1e-9, img_shape=(16, 8, 8),
+                        condition="None", mask=None)
+    return types.SimpleNamespace(
+        session=None, config={"session_cache_files": 1, "lifetime_vmax": 10}, results_dict={"a": result},
+        intensity_img_dict={"a": {"intensity": cube.intensity()}}, ref_files_dict={}, thumbnails={}, df_stats={},
+        raw_data_dict={"a": {"data": cube, "t_series": np.arange(16.0), "condition": "None", "file_path": "a.sdt",
+                             "mask_arr": None, "analyse": "yes"}},
+        phasor_settings={}, ptu_channel=0, ptu_time_binning=1)
+
+
+def digest(path):
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def test_opened_session_file_is_not_changed(tmp_path):
+    path = str(tmp_path / "saved.h5")
+    save_session(shared_data(), path)
+    saved = digest(path)
+
+    shared = shared_data()
+    load_session(shared, path)
+    assert shared.session.temporary and shared.session.path != path
+    shared.results_dict["a"]["g"] = np.zeros(64, dtype=np.float32)
+    del shared.results_dict["a"]["phi"]
+    shared.session.remove_dataset(shared.raw_data_dict["a"]["data"])
+    shared.session.flush()
+    copy = shared.session.path
+    shared.session.close()
+
+    assert digest(path) == saved
+    assert not os.path.exists(copy)
+    reopened = shared_data()
+    load_session(reopened, path)
+    original = shared_data()
+    np.testing.assert_array_equal(reopened.results_dict["a"]["g"], original.results_dict["a"]["g"])
+    np.testing.assert_array_equal(reopened.raw_data_dict["a"]["data"].rows(0, 8), original.raw_data_dict["a"]["data"].rows(0, 8))
+    reopened.session.close()
+
+
+def test_remove_stale_sessions(session_dir):
+    running = subprocess.Popen([sys.executable, "-c", "import time; time.sleep(30)"])
+    finished = subprocess.Popen([sys.executable, "-c", "pass"])
+    finished.wait()
+    try:
+        store = SessionStore()
+        os.makedirs(session_dir, exist_ok=True)
+        names = {"running": f"{running.pid}-a.h5", "finished": f"{finished.pid}-b.h5", "unnamed": "session.h5",
+                 "other": f"{finished.pid}-notes.txt"}
+        for name in names.values():
+            open(session_dir / name, "wb").close()
+
+        remove_stale_sessions()
+        # the sessions of running programs (this one included) and files other than sessions are kept
+        assert sorted(os.listdir(session_dir)) == sorted([os.path.basename(store.path), names["running"], names["other"]])
+        store.close()
+        assert not os.path.exists(store.path)
+    finally:
+        running.kill()
+        running.wait()
+
+    remove_stale_sessions()
+    assert os.listdir(session_dir) == [names["other"]]
+
+
+def test_remove_stale_sessions_without_folder(session_dir):
+    remove_stale_sessions()
+    assert not session_dir.exists()
@@ -0,0 +1,46 @@
+"""Stages of the analysis of a sample file, with the config values and inputs each stage depends on.
+
+A stage is recalculated only when its config values or inputs change, or when a stage it depends on is recalculated.
+Display settings (colour maps, lifetime_map, plot limits) are not part of any stage, so changing them never triggers
+a recalculation."""
+import hashlib
+
+# stage: (stages it depends on, config keys, inputs), in the order the stages run
+STAGES = {
+    "load": ((), (), ("data",)),  # raw data of the file, .ptu channel and time binning are chosen when importing
+    "projection": (("load",), ("frequency",), ()),  # intensity, sum I(t)*cos(wt) and sum I(t)*sin(wt) images of the decays
+    "threshold": (("load",), ("min_photons", "max_photons"), ("mask_arr",)),  # photon count thresholds and manual mask
+    "bin": (("threshold",), ("bins",), ()),
+    "offset": (("bin",), ("subtract_offset", "fraction_offset"), ()),
+    "phasor": (("offset", "projection"), (), ()),  # uncalibrated g and s
+    "calibration": (("phasor",), ("ref_file", "ref_lifetime"), ("reference",)),  # corrected g and s
+    "lifetime": (("calibration",), (), ()),  # modulation, phase and average lifetimes
+    "statistics": (("lifetime",), ("detail_stats",), ("condition",)),  # lifetimes per file and mask region
+}
+
+
+def stage_signatures(config, inputs):
+    """Signature of every stage: a hash of its config values, its inputs and the signatures of the stages it depends on"""
+    signatures = {}
+    for stage, (depends_on, config_keys, input_keys) in STAGES.items():
+        h = hashlib.blake2b(digest_size=16)
+        h.update(repr([signatures[dependency] for dependency in depends_on]).encode())
+        h.update(repr([str(config[key]) for key in config_keys]).encode())
+        h.update(repr([inputs[key] for key in input_keys]).encode())
+        signatures[stage] = h.hexdigest()
+    return signatures
+
+
+def stale_stages(previous, current):
+    """Stages whose signature changed since the previous analysis (all stages if the file was not analysed before)"""
+    return {stage for stage in STAGES if previous.get(stage) != current[stage]}
+
+
+def array_digest(array):
+    """Content hash of a (small) array, e.g. a manual mask, used as a stage input"""
+    if array is None:
+        return None
+    h = hashlib.blake2b(digest_size=16)
+    h.update(repr((array.shape, array.dtype.str)).encode())
+    h.update(array.tobytes())
+    return h.hexdigest()
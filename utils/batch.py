@@ -0,0 +1,194 @@
+"""Headless batch analysis: load -> reference correction -> phasor -> lifetime maps, without the GUI or any Qt event loop"""
+import os
+import glob
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+import math
+
+import numpy as np
+import pandas as pd
+from ptufile import PtuFile
+from tifffile import imwrite, TiffWriter
+
+from utils.file_readers import (read_raw_data, read_irf, read_mask, estimate_t_series, ptu_header, ptu_frame_segments,
+                                decode_ptu_frames)
+from utils.phasor_engine import phasor_coordinates, reference_correction, calibrate_coordinates, time_lapse_coordinates
+from utils.region_stats import lifetime_stats
+from utils.file_result import FileResult
+
+BIN_SIZES = {"None": 1, "3x3": 3, "7x7": 7, "9x9": 9, "12x12": 12}
+RAW_EXTENSIONS = ('.sdt', '.ptu', '.tif', '.tiff')
+
+
+def find_samples(inputs):
+    """Expand files, directories and glob patterns into a sorted list of raw data files (without duplicates)"""
+    samples = []
+    for item in inputs:
+        if os.path.isdir(item):
+            paths = [os.path.join(item, name) for name in os.listdir(item)]
+        else:
+            paths = glob.glob(item) or [item]
+        for path in sorted(paths):
+            if path.lower().endswith(RAW_EXTENSIONS) and path not in samples:
+                samples.append(path)
+    return samples
+
+
+def load_data(file_name, settings):
+    """Read a raw data file, estimating the time series from the laser frequency if it is unknown"""
+    data, t_series = read_raw_data(file_name, settings["bin_width"], settings["ptu_channel"], settings["ptu_time_binning"])
+    if t_series.size == 0:
+        t_series = estimate_t_series(data.shape[0], settings["frequency"])
+    return data, t_series
+
+
+def reference_calibration(file_name, ref_lifetime, settings, irf=False):
+    """Modulation and phase correction from a reference file (lifetime in ns) or an IRF (lifetime 0)"""
+    if irf:
+        ref_data, t_series = read_irf(file_name)
+        bins_ref = 1
+    else:
+        ref_data, t_series = load_data(file_name, settings)
+        bins_ref = ref_data.shape[0]  # as for the GUI, reference bins follow the time channels of the reference file
+
+    w = 2*math.pi*settings["frequency"]*1e6
+    ref_g, ref_s, _, _ = phasor_coordinates(ref_data, t_series, w, bins_ref, min_photons=0, offset_fraction=settings["offset_fraction"],
+                                            mode_same=False, memory_budget=settings["memory_budget"])
+    return reference_correction(ref_g, ref_s, w, ref_lifetime*1e-9)
+
+
+def analyse_sample(file_name, settings, M_ref, phi_ref):
+    """Calculate the phasor coordinates and lifetime maps of one sample file (also the process pool entry point)"""
+    data, t_series = load_data(file_name, settings)
+
+    mask_arr = None
+    if settings["masks_dir"]:
+        mask_arr = read_mask(settings["masks_dir"], Path(file_name).stem)
+
+    w = 2*math.pi*settings["frequency"]*1e6
+    g, s, img_shape, intensity = phasor_coordinates(data, t_series, w, settings["bins"], min_photons=settings["min_photons"],
+                                                    max_photons=settings["max_photons"], offset_fraction=settings["offset_fraction"],
+                                                    mode_same=True, region_mask=mask_arr, memory_budget=settings["memory_budget"])
+    g_data, s_data, M_data, phi_data = calibrate_coordinates(g, s, w, M_ref, phi_ref)
+
+    return FileResult(intensity=intensity, g=g_data, s=s_data, M=M_data, phi=phi_data, img_shape=img_shape,
+                      condition=settings["condition"], mask=mask_arr)
+
+
+def analyse_time_lapse(file_name, settings, M_ref, phi_ref, output_dir, filename):
+    """Calculate the lifetime maps of every frame (or window of frames, see time_lapse_coordinates) of a multi-frame
+    .ptu file. The frames are decoded one at a time and the maps of each window are appended to .tif stacks as soon as
+    they are calculated, so memory use does not grow with the number of frames. Returns the lifetime statistics rows,
+    with the first frame of each window"""
+    ptu = PtuFile(file_name)
+    records = ptu.read_records(memmap=True)
+    segments = ptu_frame_segments(ptu, records)
+    t_series = np.asarray(ptu_header(ptu)["t_series"], dtype=np.float32)[::settings["ptu_time_binning"]]
+
+    mask_arr = None
+    if settings["masks_dir"]:
+        mask_arr = read_mask(settings["masks_dir"], Path(file_name).stem)
+
+    def read_frames(start, stop):
+        return decode_ptu_frames(ptu, records, segments, start, stop, settings["ptu_channel"], settings["ptu_time_binning"])
+
+    w = 2*math.pi*settings["frequency"]*1e6
+    windows = time_lapse_coordinates(read_frames, len(segments), t_series, w, settings["bins"], settings["frame_window"],
+                                     settings["frame_step"], min_photons=settings["min_photons"], max_photons=settings["max_photons"],
+                                     offset_fraction=settings["offset_fraction"], mode_same=True, region_mask=mask_arr,
+                                     memory_budget=settings["memory_budget"])
+    names = ("M", "phi", "average", "g", "s", "intensity")
+    rows = []
+    writers = {name: TiffWriter(os.path.join(output_dir, f"{filename}_{name}_frames.tif")) for name in names}
+    try:
+        for start, g, s, img_shape, intensity in windows:
+            g_data, s_data, M_data, phi_data = calibrate_coordinates(g, s, w, M_ref, phi_ref)
+            result = FileResult(intensity=intensity, g=g_data, s=s_data, M=M_data, phi=phi_data, img_shape=img_shape,
+                                condition=settings["condition"], mask=mask_arr)
+            x_dim, y_dim = img_shape[1:]
+            for name in names:
+                image = result[name].reshape((x_dim, y_dim))
+                writers[name].write((image * 10**9 if name in ("M", "phi", "average") else image).astype(np.float32), contiguous=True)
+            for row in lifetime_stats({filename: result}, settings.get("detail_stats", False)).to_dict('records'):
+                rows.append(dict(row, frame=start))
+    finally:
+        for writer in writers.values():
+            writer.close()
+    return rows
+
+
+def _analyse_sample_safe(file_name, settings, M_ref, phi_ref, output_dir=None, filename=None):
+    """Analyse a sample, returning the error message instead of raising, so one bad file does not stop a batch.
+    Time-lapse .ptu files (with a frame window set) are written to output_dir here and return their statistics rows"""
+    try:
+        if settings.get("frame_window") and file_name.endswith('.ptu'):
+            return analyse_time_lapse(file_name, settings, M_ref, phi_ref, output_dir, filename), None
+        return analyse_sample(file_name, settings, M_ref, phi_ref), None
+    except Exception as e:
+        return None, str(e)
+
+
+def unique_names(samples):
+    """Output names of the samples, duplicate file names are renamed as when importing them in the GUI"""
+    names = []
+    for file_name in samples:
+        filename = base_filename = Path(file_name).stem
+        count = 1
+        while filename in names:
+            filename = f"{base_filename}_{count}"
+            count += 1
+        names.append(filename)
+    return names
+
+
+def write_maps(output_dir, filename, result):
+    """Save the lifetime maps (ns), phasor coordinates and intensity image of a sample as .tif files"""
+    x_dim, y_dim = result['img_shape'][1:]
+    for lifetime_type in ("M", "phi", "average"):
+        imwrite(os.path.join(output_dir, f"{filename}_{lifetime_type}_raw.tif"),
+                (result[lifetime_type].reshape((x_dim, y_dim)) * 10**9).astype(np.float32))
+    for coordinate in ("g", "s"):
+        imwrite(os.path.join(output_dir, f"{filename}_{coordinate}.tif"), result[coordinate].reshape((x_dim, y_dim)).astype(np.float32))
+    imwrite(os.path.join(output_dir, f"{filename}_intensity_raw.tif"), result['intensity'])
+
+
+def run_batch(samples, reference, ref_lifetime, output_dir, settings, irf=False, workers=1, log=print):
+    """Analyse all samples against a reference, write their maps and the lifetime values table to output_dir.
+    Returns the lifetime values DataFrame and a list of (file, error) for the files that could not be analysed."""
+    os.makedirs(output_dir, exist_ok=True)
+
+    log(f"reference analysis: {reference}")
+    M_ref, phi_ref = reference_calibration(reference, ref_lifetime, settings, irf=irf)
+
+    stats = []
+    failed = []
+    filenames = unique_names(samples)
+
+    def collect(file_name, filename, result, error):
+        if error is not None:
+            log(f"[{len(stats) + len(failed) + 1}/{len(samples)}] FAILED {file_name}: {error}")
+            failed.append((file_name, error))
+            return
+        if isinstance(result, list):
+            # time-lapse files are written while they are analysed, only their statistics rows are returned
+            stats.append(pd.DataFrame(result))
+        else:
+            write_maps(output_dir, filename, result)
+            # only the per-region statistics are kept, so memory use does not grow with the number of files
+            stats.append(lifetime_stats({filename: result}, settings.get("detail_stats", False)))
+        log(f"[{len(stats) + len(failed)}/{len(samples)}] {file_name}")
+
+    if workers > 1 and len(samples) > 1:
+        with ProcessPoolExecutor(max_workers=min(workers, len(samples))) as executor:
+            results = executor.map(_analyse_sample_safe, samples, repeat(settings), repeat(M_ref), repeat(phi_ref),
+                                   repeat(output_dir), filenames)
+            for file_name, filename, (result, error) in zip(samples, filenames, results):
+                collect(file_name, filename, result, error)
+    else:
+        for file_name, filename in zip(samples, filenames):
+            collect(file_name, filename, *_analyse_sample_safe(file_name, settings, M_ref, phi_ref, output_dir, filename))
+
+    df_stats = pd.concat(stats, ignore_index=True) if stats else pd.DataFrame()
+    df_stats.drop(columns=['M_mean', 'phi_mean', 'average_mean'], errors='ignore').to_csv(os.path.join(output_dir, "lifetime_values.csv"))
+    return df_stats, failed
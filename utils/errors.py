@@ -1,5 +1,3 @@
-from PySide6.QtWidgets import QMessageBox
-
 class UnsupportedFileFormatError(Exception):
     """Exception raised for unsupported file formats."""
     def __init__(self, message="Only .sdt, .ptu or .tif file formats are currently supported."):
@@ -26,6 +24,7 @@ class MaskingError(Exception):
 
 def show_error_message(parent, title, message):
     """Function to display an error message."""
+    from PySide6.QtWidgets import QMessageBox # imported here so the file readers and batch runner do not need Qt
     msg_box = QMessageBox(parent)
     msg_box.setIcon(QMessageBox.Critical)
     msg_box.setWindowTitle(title)
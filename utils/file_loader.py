@@ -0,0 +1,86 @@
+"""Background loading of raw data files: files are decoded on a pool of threads, a bounded number ahead of the consumer
+(e.g. the GUI drawing the intensity images), so decoding overlaps with displaying the files"""
+import os
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from utils.file_readers import read_raw_channels, read_mask
+from utils.errors import MaskingError
+
+# decoding .ptu files and reading memory-mapped stacks mostly runs outside the GIL, so threads decode files in parallel
+LOADER_THREADS = min(4, os.cpu_count() or 1)
+
+
+class PrefetchLoader:
+    """Run load(item) for the items on a thread pool, with at most max_pending files decoded (or being decoded) ahead of
+    the consumer. Finished files are handed out in the order of the items by ready(), which never blocks.
+
+    cancel() stops queueing new files and drops the pending ones. Files that are already being decoded can not be
+    interrupted, their results are discarded.
+    """
+
+    def __init__(self, load, items, workers=LOADER_THREADS, max_pending=None):
+        self._load = load
+        self._items = enumerate(items)
+        self._pending = deque()  # (index, item, future) in submission order
+        self._max_pending = max_pending or 2 * workers
+        self._cancelled = threading.Event()
+        self._exhausted = False
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="flimpa-loader")
+        self._fill()
+
+    def _fill(self):
+        # bounded queue: the decoded files waiting for the consumer are what holds memory
+        while not self._exhausted and not self._cancelled.is_set() and len(self._pending) < self._max_pending:
+            queued = next(self._items, None)
+            if queued is None:
+                self._exhausted = True
+                self._executor.shutdown(wait=False)
+                break
+            index, item = queued
+            self._pending.append((index, item, self._executor.submit(self._run, item)))
+
+    def _run(self, item):
+        if self._cancelled.is_set():
+            return None
+        return self._load(item)
+
+    def ready(self):
+        """Yield (index, item, future) of the files finished so far, in order, without waiting for the others.
+        future.result() returns the loaded file or raises the error of load"""
+        while self._pending and self._pending[0][2].done() and not self._cancelled.is_set():
+            index, item, future = self._pending.popleft()
+            self._fill()
+            yield index, item, future
+
+    @property
+    def done(self):
+        """True once every file was handed out (or loading was cancelled)"""
+        return self._cancelled.is_set() or (self._exhausted and not self._pending)
+
+    def cancel(self):
+        self._cancelled.set()
+        self._pending.clear()
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+def load_file(file_name, bin_width=None, channel=0, ptu_time_binning=1, masks_dir=None, ptu_cache=None, session=None):
+    """Read a raw data file and its manual mask (if masks_dir is given), returns a list of (channel, dataset), the
+    time series and the mask (see read_raw_channels, channel None loads every channel).
+    The intensity images are calculated here as well, so the consumer only has to display them. With a session
+    (SessionStore), datasets that are not memory mapped are moved to the session file here too"""
+    channels, t_series = read_raw_channels(file_name, bin_width, channel, ptu_time_binning, ptu_cache)
+    mask_arr = None
+    if masks_dir is not None:
+        name = Path(file_name).stem
+        try:
+            mask_arr = read_mask(masks_dir, name)
+        except Exception as e:
+            raise MaskingError(f"Error masking data for file '{name}': {e}")
+    for _, data in channels:
+        data.intensity()
+    if session is not None:
+        channels = [(channel, data if data.is_memmap else session.put_dataset(None, data)) for channel, data in channels]
+    return channels, t_series, mask_arr
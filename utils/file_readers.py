@@ -0,0 +1,275 @@
+"""Readers for raw FLIM data, IRF and mask files"""
+import os
+import numpy as np
+import sdtfile as sdt
+from ptufile import PtuFile
+from skimage.io import imread
+from PIL import Image # load mask files
+
+from utils.errors import UnsupportedFileFormatError, DataProcessingError
+from utils.flim_dataset import FlimDataset, sdt_datasets, tiff_dataset
+
+# records decoded at a time when looking for the frame markers of .ptu files
+_PTU_RECORDS_CHUNK = 2**20
+
+
+def read_raw_data(file_name, bin_width=None, ptu_channel=0, ptu_time_binning=1, ptu_cache=None):
+    """Open a raw .sdt, .ptu or .tif(f) file and return the (T, X, Y) dataset and its time series
+    (the first data block of .sdt files, ptu_channel of .ptu files)"""
+    if file_name.endswith('.sdt'):
+        ptu_channel = 0
+    channels, t_series = read_raw_channels(file_name, bin_width, ptu_channel, ptu_time_binning, ptu_cache)
+    return channels[0][1], t_series
+
+
+def read_raw_channels(file_name, bin_width=None, channel=0, ptu_time_binning=1, ptu_cache=None):
+    """Open a raw .sdt, .ptu or .tif(f) file and return a list of (channel, (T, X, Y) dataset), one per detector
+    channel (channels of .ptu files, data blocks of .sdt files), and their time series.
+    channel selects a single channel, None keeps all of them (decoded in a single pass)"""
+    if file_name.endswith('.sdt'):
+        channels, t_series = read_sdt(file_name, channel)
+    elif file_name.endswith('.ptu'):
+        channels, t_series = read_ptu(file_name, channel=channel, time_binning=ptu_time_binning, cache=ptu_cache)
+    elif file_name.endswith('.tiff') or file_name.endswith('.tif'):
+        data, t_series = read_tiff(file_name, bin_width)
+        channels = [(0, data)]
+    else:
+        raise UnsupportedFileFormatError()
+
+    for _, data in channels:
+        check_flim_dimensions(data)
+    return channels, t_series
+
+
+def check_flim_dimensions(data):
+    """Raise an error if the data is not raw 3D FLIM data"""
+    if data.ndim < 3:
+        raise DataProcessingError(
+            f"Image is not raw 3D FLIM data. Image dimensions should be >= 3, but current dimensions: {data.ndim}"
+        )
+
+
+def select_channels(channels, channel, file_name):
+    """Keep the (channel, data) pair of the selected channel, or all of them if channel is None"""
+    if channel is None:
+        return channels
+    if not 0 <= channel < len(channels):
+        raise DataProcessingError(f"'{os.path.basename(file_name)}' has no channel {channel} ({len(channels)} channels)")
+    return [channels[channel]]
+
+
+def read_sdt(file_name, channel=0):
+    """ read Becker & Hickl .sdt files, one channel per data block (channel None reads all blocks).
+    Data blocks are memory mapped when they are not compressed"""
+    datasets, t_series = sdt_datasets(file_name)
+    if datasets is not None:
+        return select_channels(list(enumerate(datasets)), channel, file_name), t_series
+
+    sdt_file = sdt.SdtFile(file_name)
+    t_series = sdt_file.times[0].astype(np.float32)
+    channels = [(i, data) for i, data in enumerate(sdt_file.data) if data.shape == sdt_file.data[0].shape]
+    channels = select_channels(channels, channel, file_name)
+    return [(i, FlimDataset(np.moveaxis(data, -1, 0).astype(np.float32), file_name)) for i, data in channels], t_series
+
+
+def sdt_channel_count(file_name):
+    """Number of channels (data blocks) of an .sdt file, from the headers"""
+    datasets, _ = sdt_datasets(file_name)
+    if datasets is not None:
+        return len(datasets)
+    with open(file_name, 'rb') as fh:
+        header = np.rec.fromfile(fh, dtype=sdt.sdtfile.FILE_HEADER, shape=1, byteorder='<')[0]
+    return max(int(header.no_of_data_blocks), 1)
+
+
+def read_ptu(file_name, channel=0, time_binning=1, cache=None):
+    """read PicoQuant .ptu files"""
+    print("loading ptu ...")
+    ptu = PtuFile(os.path.join(file_name))
+    try:
+        print(f"Frequency from metadata: {ptu.frequency/1000000} MHz")
+    except:
+        pass
+    return decode_ptu(ptu, channel, time_binning, cache)
+
+
+def decode_ptu(ptu, channel=0, time_binning=1, cache=None):
+    """Decode the image histograms of an open PtuFile, summing all frames. Returns a list of (channel, dataset) for
+    the selected channel, or for every channel if channel is None (all channels are decoded in a single pass).
+    The records are histogrammed straight into time bins of time_binning bins (the slice step of ptufile sums adjacent
+    bins). With a PtuCache the histograms are stored on disk, files opened again are memory mapped from the cache
+    without decoding their records"""
+    header = ptu_header(ptu) if cache is None else cache.header(ptu)
+    initial_t_series = np.asarray(header["t_series"], dtype=np.float32)
+    time_slice = slice(None, None, time_binning)
+    full_selection = (..., time_slice)
+    t_series = initial_t_series[time_slice]
+    channel_ids = list(range(header["shape"][3])) if channel is None else [channel]
+
+    if cache is not None:
+        cached = [(i, cache.get(ptu.filepath, i, time_binning)) for i in channel_ids]
+        if all(data is not None for _, data in cached):
+            print("ptu histogram read from cache ...")
+            return cached, t_series
+
+    print("extracting data ...")
+    # decode image with the specified channel(s) and selection
+    data_array = ptu.decode_image(
+        full_selection,
+        channel=channel,
+        asxarray=False,
+        keepdims=True, # (1, Y, X, C, H), also for a single channel
+        frame=-1, # sums up all time channels
+        dtype=np.uint32 # summed frames and time bins overflow the default uint16
+    )[0]
+
+    channels = []
+    for index, i in enumerate(channel_ids):
+        data = np.transpose(data_array[:, :, index], (2, 1, 0))
+        if cache is not None:
+            data = cache.put(ptu.filepath, i, time_binning, data)
+        else:
+            data = FlimDataset(data, ptu.filepath)
+        channels.append((i, data))
+
+    print("finished loading ptu file ...")
+    return channels, t_series
+
+
+def ptu_frame_segments(ptu, records):
+    """Record ranges (start, stop) of the complete frames of an open multi-frame PtuFile, found from the frame and
+    line markers of its (memory-mapped) records, which are decoded a chunk at a time.
+    Each range starts at the frame marker before its frame, so ptufile decodes (or skips) it as it would for the
+    whole file. Ranges with less line markers than lines per frame (before the first or after the last frame) are left out"""
+    frame_markers, line_markers = [], []
+    for start in range(0, records.size, _PTU_RECORDS_CHUNK):
+        markers = ptu.decode_records(records[start:start + _PTU_RECORDS_CHUNK])['marker']
+        frame_markers.append(np.flatnonzero(markers & ptu.frame_change_mask) + start)
+        line_markers.append(np.flatnonzero(markers & ptu.line_start_mask) + start)
+        del markers
+    frame_markers, line_markers = np.concatenate(frame_markers), np.concatenate(line_markers)
+
+    bounds = np.concatenate(([0], frame_markers, [records.size]))
+    segments = []
+    for start, stop in zip(bounds[:-1], bounds[1:]):
+        stop = min(stop + 1, records.size)  # include the frame marker ending the frame
+        lines = np.searchsorted(line_markers, stop) - np.searchsorted(line_markers, start)
+        if lines >= ptu.lines_in_frame:
+            segments.append((int(start), int(stop)))
+    return segments[:ptu.shape[0]]
+
+
+def decode_ptu_frames(ptu, records, segments, start, stop, channel=0, time_binning=1):
+    """(T, X, Y) histogram of the frames start to stop (summed) of an open PtuFile, decoded from their records only
+    (see ptu_frame_segments)"""
+    data_array = ptu.decode_image(
+        (..., slice(None, None, time_binning)),
+        records=records[segments[start][0]:segments[stop - 1][1]],
+        channel=channel,
+        asxarray=False,
+        keepdims=True,
+        frame=-1,
+        dtype=np.uint32
+    )[0]
+    return FlimDataset(np.transpose(data_array[:, :, 0], (2, 1, 0)), ptu.filepath)
+
+
+def ptu_header(ptu):
+    """Shape (T, Y, X, C, H) and delay-time bins (s) of an open PtuFile, ptufile scans the records to find them"""
+    return {"shape": [int(n) for n in ptu.shape], "t_series": np.asarray(ptu.coords['H'], dtype=np.float64).tolist()}
+
+
+def ptu_time_bin_options(t_series, target_final_shape=50):
+    """Time dimensions, resolutions (ps) and bin factors (powers of 2) available for binning the time axis of .ptu files"""
+    n = t_series.shape[0]
+    final_time_resolution = []
+    final_shapes = []
+    bin_factors = []
+
+    # Do not round the initial resolution
+    initial_time_resolution = (t_series[1] - t_series[0]) * 10**12
+
+    power = 0
+    while True:
+        bin_factor = 2**power
+
+        # Calculate the final shape correctly
+        final_shape = n // bin_factor + min(1, n % bin_factor)
+
+        if final_shape < target_final_shape:
+            break
+
+        final_time_resolution.append(np.round((initial_time_resolution * bin_factor),2))
+        final_shapes.append(final_shape)
+        bin_factors.append(bin_factor)
+        power += 1
+
+    return final_shapes, final_time_resolution, bin_factors
+
+
+def read_tiff(file_name, bin_width=None):
+    """read (T, X, Y) .tif stacks, the time series is built from the bin width (ns).
+    Uncompressed stacks are memory mapped, others are read into memory"""
+    data = tiff_dataset(file_name)
+    if data is None:
+        data = FlimDataset(imread(file_name).squeeze(), file_name)
+
+    if bin_width is not None and bin_width != "estimate":
+        # Accurate manual calculation: bin_width (ns) * 1e-9
+        t_series = np.asarray([i * 1e-9 * float(bin_width) for i in range(data.shape[0])], dtype=np.float32)
+    else:
+        # Mark as empty to trigger frequency estimation in the next step
+        t_series = np.array([], dtype=np.float32)
+
+    return data, t_series
+
+
+def estimate_t_series(n_bins, frequency):
+    """Estimate the time series from the laser frequency (MHz): bin width = 1 / (laser repetition rate x bin number)"""
+    t_resolution = 1 / (float(frequency) * 1e6 * n_bins)
+    return np.linspace(0, (n_bins-1) * t_resolution, n_bins, dtype=np.float32)
+
+
+def read_irf(file_name):
+    """Read an IRF from a .sdt or two column (time, signal) .csv file, returned as (T, 1, 1) data and time series"""
+    if file_name.endswith('.sdt'):
+        sdt_file = sdt.SdtFile(file_name)
+        data = np.moveaxis(sdt_file.data[0], -1, 0).astype(np.float32)
+        data = np.squeeze(data)
+        t_series = sdt_file.times[0].astype(np.float32)
+
+        # Check if the data is one-dimensional
+        if data.ndim != 1:
+            raise DataProcessingError(f"IRF data must be one-dimensional. Current dimensions: {data.shape}")
+
+        # Reshape the data to (data.shape[0], 1, 1)
+        data = data.reshape((data.shape[0], 1, 1)).astype(np.float32)
+
+    elif file_name.endswith('.csv'):
+        # Load the CSV file
+        irf = np.genfromtxt(file_name, delimiter=',', skip_header=0).T
+
+        # Check the number of columns
+        num_columns = irf.shape[0]
+        if num_columns != 2:
+                raise DataProcessingError("Please provide a file with only 2 columns")
+
+        # Extract the IRF data from the selected column
+        data = irf[1]
+        data = data.reshape((data.shape[0], 1, 1)).astype(np.float32)
+        t_series = irf[0]
+    else:
+        raise UnsupportedFileFormatError("Only .sdt and .csv file formats are supported for IRF data.")
+
+    return data, t_series
+
+
+def mask_path(masks_dir, file_name):
+    """Path of the manual mask of a file ('file_name segmentation.tif')"""
+    return os.path.join(masks_dir, file_name.split('.')[0] + ' segmentation.tif')
+
+
+def read_mask(masks_dir, file_name):
+    """Read the manual mask (labelled regions) of a file"""
+    im = Image.open(mask_path(masks_dir, file_name))
+    return np.array(im, dtype=np.float32)
@@ -0,0 +1,84 @@
+"""Per-file results of the lifetime analysis"""
+from collections.abc import MutableMapping
+
+# maps calculated from other maps each time they are read, instead of being kept for every file: name -> (maps, function)
+DERIVED_MAPS = {
+    "average": (("M", "phi"), lambda M, phi: (M + phi) / 2),
+}
+
+
+def derived_map(result, key):
+    """Calculate a derived map of a result (KeyError if key is not a derived map or the result lacks its maps)"""
+    if key not in DERIVED_MAPS:
+        raise KeyError(key)
+    maps, function = DERIVED_MAPS[key]
+    return function(*(result[name] for name in maps))
+
+
+def has_derived_map(result, key):
+    return key in DERIVED_MAPS and all(name in result for name in DERIVED_MAPS[key][0])
+
+
+class FileResult(MutableMapping):
+    """Results of one file, read and updated like a dictionary.
+
+    The values are slots of the object, so no dictionary is kept per file (other keys, if any, go to a separate
+    dictionary). Derived maps such as the average lifetime are calculated when they are read and are not stored.
+    """
+
+    __slots__ = ("projections", "g_raw", "s_raw", "img_shape", "intensity", "g", "s", "M", "phi", "phasor_mask",
+                 "condition", "mask", "stats", "stages", "_extra")
+    _FIELDS = frozenset(__slots__[:-1])
+
+    def __init__(self, *args, **kwargs):
+        self._extra = None
+        self.update(*args, **kwargs)
+
+    def __getitem__(self, key):
+        if key in self._FIELDS:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                raise KeyError(key) from None
+        if self._extra is not None and key in self._extra:
+            return self._extra[key]
+        return derived_map(self, key)
+
+    def __setitem__(self, key, value):
+        if key in DERIVED_MAPS:
+            raise KeyError(f"'{key}' is calculated from other maps and can not be set")
+        if key in self._FIELDS:
+            setattr(self, key, value)
+        else:
+            if self._extra is None:
+                self._extra = {}
+            self._extra[key] = value
+
+    def __delitem__(self, key):
+        if key in self._FIELDS:
+            try:
+                delattr(self, key)
+            except AttributeError:
+                raise KeyError(key) from None
+        elif self._extra is not None and key in self._extra:
+            del self._extra[key]
+        else:
+            raise KeyError(key)
+
+    def __iter__(self):
+        """The stored keys (derived maps are not included)"""
+        for key in self.__slots__[:-1]:
+            if hasattr(self, key):
+                yield key
+        yield from list(self._extra or ())
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __contains__(self, key):
+        if key in self._FIELDS:
+            return hasattr(self, key)
+        return (self._extra is not None and key in self._extra) or has_derived_map(self, key)
+
+    def __repr__(self):
+        return f"<FileResult {sorted(self)}>"
@@ -0,0 +1,171 @@
+"""Lazy access to raw FLIM data: stacks stay on disk (memory-mapped) and are read in tiles of rows when analysed"""
+import numpy as np
+import tifffile
+from sdtfile import sdtfile as sdt_format
+
+# approximate size of the tiles of rows read from a dataset at once
+TILE_BYTES = 64 * 2**20
+
+
+class FlimDataset:
+    """(T, X, Y) FLIM data read on demand.
+
+    A dataset wraps either an in-memory array (e.g. decoded .ptu files), a read-only memory map of the file on disk or
+    a dataset of the session file (see utils/session_store.py), in which case only the tiles that are being analysed
+    are read into memory. Memory-mapped datasets are pickled as their file layout, so worker processes reopen the file
+    instead of receiving a copy of the data.
+    """
+
+    def __init__(self, array, file_name=None, layout=None, intensity=None):
+        self._array = array
+        self.file_name = file_name
+        self._layout = layout  # (offset, dtype, shape, time axis) of memory-mapped files, None for in-memory data
+        self._intensity = intensity
+
+    @classmethod
+    def from_file(cls, file_name, offset, dtype, shape, time_axis):
+        """Memory map raw data of the given shape stored at offset, with time along time_axis"""
+        layout = (int(offset), np.dtype(dtype).str, tuple(int(n) for n in shape), time_axis)
+        return cls(cls._open(file_name, layout), file_name, layout)
+
+    @staticmethod
+    def _open(file_name, layout):
+        offset, dtype, shape, time_axis = layout
+        raw = np.memmap(file_name, dtype=dtype, mode='r', offset=offset, shape=shape)
+        return np.moveaxis(raw, time_axis, 0)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        if self._layout is not None:
+            state['_array'] = None  # reopened from the file when unpickled
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self._layout is not None:
+            self._array = self._open(self.file_name, self._layout)
+
+    @property
+    def shape(self):
+        return self._array.shape
+
+    @property
+    def ndim(self):
+        return self._array.ndim
+
+    @property
+    def dtype(self):
+        return self._array.dtype
+
+    @property
+    def nbytes(self):
+        return self._array.nbytes
+
+    @property
+    def is_memmap(self):
+        return self._layout is not None
+
+    @property
+    def layout(self):
+        return self._layout
+
+    @property
+    def source(self):
+        """The array read from: in-memory array, memory map or HDF5 dataset"""
+        return self._array
+
+    def __array__(self, dtype=None, copy=None):
+        """Read the whole dataset into memory"""
+        return np.array(self._array, dtype=dtype)
+
+    def rows(self, start, stop):
+        """(T, stop-start, Y) array of the rows start to stop"""
+        return np.asarray(self._array[:, start:stop])
+
+    def tiles(self, tile_bytes=TILE_BYTES):
+        """(start, stop) row ranges of tiles holding about tile_bytes of data each"""
+        row_bytes = max(self.nbytes // max(self.shape[1], 1), 1)
+        step = max(int(tile_bytes // row_bytes), 1)
+        for start in range(0, self.shape[1], step):
+            yield start, min(start + step, self.shape[1])
+
+    def intensity(self):
+        """Photon counts per pixel (sum over the time axis), read tile by tile and cached"""
+        if self._intensity is None:
+            self._intensity = np.concatenate([self.rows(start, stop).sum(0) for start, stop in self.tiles()])
+        return self._intensity
+
+
+def as_dataset(data):
+    """Wrap in-memory arrays, so datasets and arrays can be analysed the same way"""
+    return data if isinstance(data, FlimDataset) else FlimDataset(np.asarray(data))
+
+
+def tiff_dataset(file_name):
+    """Memory-mapped dataset of an uncompressed .tif stack (None if its pages are not stored contiguously)"""
+    with tifffile.TiffFile(file_name) as tif:
+        series = tif.series[0]
+        offset = series.dataoffset
+        if offset is None:
+            return None
+        shape = tuple(n for n in series.shape if n != 1)
+        dtype = series.dtype
+
+    if len(shape) < 3:
+        return None
+    return FlimDataset.from_file(file_name, offset, dtype, shape, time_axis=0)
+
+
+def sdt_datasets(file_name):
+    """Memory-mapped datasets of the data blocks of an .sdt file (e.g. one per detector), located from the file and
+    block headers. Only blocks with the shape and time series of the first block are returned.
+    Returns None with the time series for blocks that can not be memory mapped (e.g. compressed data)."""
+    with open(file_name, 'rb') as fh:
+        header = np.rec.fromfile(fh, dtype=sdt_format.FILE_HEADER, shape=1, byteorder='<')[0]
+        measure_dtype = sdt_format.record_dtype(sdt_format.MEASURE_INFO, int(header.meas_desc_block_length))
+        if sdt_format.FileRevision(header.revision).revision >= 15:
+            block_header_dtype = sdt_format.BLOCK_HEADER
+        else:
+            block_header_dtype = sdt_format.BLOCK_HEADER_OLD
+        blocks = []
+        offset = header.data_block_offs
+        for _ in range(max(int(header.no_of_data_blocks), 1)):
+            fh.seek(offset)
+            block = np.rec.fromfile(fh, dtype=block_header_dtype, shape=1, byteorder='<')[0]
+            fh.seek(header.meas_desc_block_offs + int(block.meas_desc_block_no) * int(header.meas_desc_block_length))
+            info = np.rec.fromfile(fh, dtype=measure_dtype, shape=1, byteorder='<')[0]
+            blocks.append((block, info))
+            offset = block.next_block_offs
+
+    datasets = []
+    t_series = None
+    for block, info in blocks:
+        block_type = sdt_format.BlockType(block.block_type)
+        block_t_series, shape = _sdt_block_layout(block, info, block_type.dtype)
+        if t_series is None:
+            t_series, first_shape = block_t_series, shape
+            if block_type.compress or shape is None:
+                return None, t_series
+        elif shape != first_shape or not np.array_equal(block_t_series, t_series):
+            continue  # not an image of the same measurement
+        elif block_type.compress:
+            return None, t_series
+        datasets.append(FlimDataset.from_file(file_name, block.data_offs, block_type.dtype.newbyteorder('<'), shape, time_axis=-1))
+    return datasets, t_series
+
+
+def _sdt_block_layout(block, info, dtype):
+    """Time series and (Y, X, T) shape of an .sdt data block (shape None if it is not an image)"""
+    size = int(block.block_length) // dtype.itemsize
+    adc_re = int(info.adc_re) or 65536
+
+    # time axis as calculated by sdtfile
+    t_series = np.arange(adc_re, dtype=np.float64)
+    if float(info.tac_g) != 0:
+        t_series *= info.tac_r / (float(info.tac_g) * adc_re)
+    t_series = t_series.astype(np.float32)
+
+    for y_dim, x_dim in ((info.scan_y, info.scan_x), (info.image_y, info.image_x)):
+        if int(y_dim) * int(x_dim) * adc_re == size:
+            return t_series, (int(y_dim), int(x_dim), adc_re)
+    return t_series, None
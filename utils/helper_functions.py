@@ -15,7 +15,7 @@ class Helpers:
     def displaySelectedtau(self):
         '''display image file that the user has selected'''
         self.main_window.figure_tau.clear()
-        if self.shared_info.results_dict != {}:
+        if self.shared_info.results_dict:
             self.main_window.plotImages.plot_tau_map(masked_image=None)
             self.main_window.phasor_componets.plot_phasor_coordinates(cmap="gist_rainbow_r")
     
@@ -40,20 +40,23 @@ class Helpers:
 
         # Delete the entries from the dictionary
         for filename in filenames_to_delete:
-            del self.shared_info.raw_data_dict[filename]
+            data = self.shared_info.raw_data_dict.pop(filename)["data"]
             # Also delete from results_dict if present
             if filename in self.shared_info.results_dict:
                 del self.shared_info.results_dict[filename]
             if filename in self.shared_info.intensity_img_dict:
                 del self.shared_info.intensity_img_dict[filename]
+            self.shared_info.thumbnails.pop(filename, None)
+            self.shared_info.phasor_histograms.pop(filename, None)
+            self.shared_info.roi_masks.pop(filename, None)
+            if self.shared_info.session:
+                self.shared_info.session.remove_dataset(data)
     
     def update_data_with_roi(self,  inside_ellipse):
         # highlight areas selected by ROI tool
         if self.main_window.tau_disp != None:
-           tau_map = self.shared_info.results_dict.get(self.shared_info.config["selected_file"])[self.shared_info.config["lifetime_map"]]
-           M_mask = np.zeros_like(tau_map)
-           M_mask[inside_ellipse] = tau_map[inside_ellipse]
-           self.main_window.plotImages.plot_tau_map( masked_image=M_mask)
+           # only the ROI layer of the lifetime map is drawn again
+           self.main_window.plotImages.show_roi(inside_ellipse)
 
     def resizeIntensity(self):
         # resize your figures based on the current window size
@@ -177,17 +180,21 @@ class Helpers:
         grouping_option = self.main_window.tab_settings.widget_dict.get("table_Group by").currentText()
 
         # Regenerate the DataFrame based on the grouping option
+        # fractions of the pixels in the phasor ROIs of the gallery plots, if any
+        roi_columns = {column: 'mean' for column in self.shared_info.df_stats.columns if column.startswith('roi_')}
         if grouping_option == "Condition":
             grouped_df = self.shared_info.df_stats.groupby('condition').agg({
                 'M': 'mean',
                 'phi': 'mean',
-                'average': 'mean'
+                'average': 'mean',
+                **roi_columns
             }).reset_index()
         elif grouping_option == "Sample":
             grouped_df = self.shared_info.df_stats.groupby(['sample', 'condition']).agg({
                 'M_mean': 'mean',
                 'phi_mean': 'mean',
-                'average_mean': 'mean'
+                'average_mean': 'mean',
+                **roi_columns
             }).reset_index()
         elif grouping_option == "None":
             grouped_df = self.shared_info.df_stats.drop(columns=['M_mean', 'phi_mean', 'average_mean'], errors='ignore')
@@ -1,17 +1,24 @@
 import numpy as np
-import pandas as pd
-import sdtfile as sdt
-from ptufile import PtuFile
-from skimage.io import imread
-from scipy import signal # for image binning
 from PySide6.QtCore import QObject, Signal
 from PySide6.QtWidgets import QApplication, QInputDialog
 
 from utils.mainwindow import *
 from utils.shared_data import SharedData 
+from utils.phasor_engine import (phasor_coordinates, decay_projections, projection_coordinates, call_with_shared_data,
+                                 to_shared_memory, reference_correction, calibrate_coordinates)
+from utils.file_readers import ptu_header, read_irf, ptu_time_bin_options
+from utils.region_stats import lifetime_stats, file_stats
+from utils.analysis_stages import stage_signatures, stale_stages, array_digest
+from utils.file_result import FileResult
+from utils.phasor_cache import PhasorCache
+from utils.ptu_cache import PtuCache
 import math
-from PIL import Image # load mask files
 import os
+import multiprocessing
+from collections import deque
+from contextlib import closing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import TimeoutError as FuturesTimeoutError
 from utils.errors import (
     UnsupportedFileFormatError,
     FileLoadingError,
@@ -20,6 +27,25 @@ from utils.errors import (
     show_error_message
 )
 
+# channel selection importing every channel of multi-channel files
+ALL_CHANNELS = "all"
+
+# names of the arrays stored in the phasor cache, per calculation reading the raw data
+CACHED_ARRAYS = {decay_projections: ("intensity", "intensity_cos", "intensity_sin"),
+                 phasor_coordinates: ("g", "s", "img_dim", "intensity")}
+
+
+def _to_arrays(result, names):
+    return {name: np.asarray(value) for name, value in zip(names, result)}
+
+
+def _from_arrays(arrays, names):
+    result = [arrays[name] for name in names]
+    if "img_dim" in names:
+        index = names.index("img_dim")
+        result[index] = tuple(int(n) for n in result[index])
+    return tuple(result)
+
 class LifetimeData(QObject):
     progressUpdated = Signal(int, str)
     analysisFinished = Signal()
@@ -39,140 +65,69 @@ class LifetimeData(QObject):
 
 
     # --- Image loading and lifetime calculation --- #
-    def load_raw_data(self, file_name, bin_width, data_type="sample", sample_count = 0):
-        """Function for loading raw data files."""
-        try:
-            if file_name.endswith('.sdt'):
-                """ read Becker & Hickl .sdt files"""
-                sdt_file = sdt.SdtFile(file_name)
-                data = np.moveaxis(sdt_file.data[0], -1, 0).astype(np.float32)
-                t_series = sdt_file.times[0].astype(np.float32)
-
-                # check if x and y dimentions are equal
-                if data.shape[1] != data.shape[2]:
-                    if data_type == "reference":
-                        # reference files with unequal space dimentions can not be anlysed, raise error
-                        raise DataProcessingError(f"Reference file must have identical x and y dimensions. \nCurrent dimensions are: {data.shape[1]}x{data.shape[2]}")
-                    elif data_type == "sample":
-                        if sample_count == 0: 
-                            show_error_message(self.main_window, "File Error", f"For best visualisation results we recommend files having identical x and y dimensions. \nCurrent dimensions are: {data.shape[1]}x{data.shape[2]}")
-
-            elif file_name.endswith('.ptu'):
-                """read PicoQuant .ptu files"""
-                print("loading ptu ...")
-                ptu = PtuFile(os.path.join(file_name))
-                try:
-                    print(f"Frequency from metadata: {ptu.frequency/1000000} MHz")
-                except:
-                    pass
-
-                # check if x and y dimentions are equal
-                if ptu.shape[1] != ptu.shape[2]:
-                    if data_type == "reference":
-                        # reference files with unequal space dimentions can not be anlysed, raise error
-                        raise DataProcessingError(f"Reference file must have identical x and y dimensions. \nCurrent dimensions are: {ptu.shape[1]}x{ptu.shape[2]}")
-                    elif data_type == "sample":
-                        if sample_count == 0: 
-                            show_error_message(self.main_window, "File Error", f"For best visualisation results we recommend files having identical x and y dimensions. \nCurrent dimensions are: {ptu.shape[1]}x{ptu.shape[2]}")
-
-                num_channels = ptu.shape[3]
-                # Prepare the list of channels
-                items = [f"Channel {i}" for i in range(num_channels)]
-                if self.shared_info.ptu_channel is None:
-                    items = [f"Channel {i}" for i in range(num_channels)]
-                    item, ok = QInputDialog.getItem(
-                        self.main_window, "Select Channel", 
-                        "Select a channel to analyse: \n(this will be applied to all the images imported)", 
-                        items, 0, False)
-                    self.shared_info.ptu_channel = items.index(item)
-                    if not ok:
-                        raise DataProcessingError("Channel selection cancelled by user.")   
-
-                # check if file time dimentions are larger than 100
-                initial_t_series = np.asarray(ptu.coords['H'], dtype=np.float32)
-                if self.shared_info.ptu_time_binning == None:
-                    if initial_t_series.shape[0] > 100:
-                        # get options for binning time dimentions
-                        final_shapes, final_time_resolution, bin_factors = self.ptu_select_time_bins(t_series=initial_t_series)
-                        # combine final time dimentions and resolutions into a list of options
-                        items = [
-                            f"Time dimensions: {final_shape}, resolution: {resolution} ps, "
-                            for resolution, final_shape in zip(final_time_resolution, final_shapes)
-                        ]
-                        item, ok = QInputDialog.getItem(
-                            self.main_window, "Bin time dimentions", 
-                            "Select a bin factor: \n(this will be applied to all the images imported)\n\n Note: binning time dimentions will result to faster analysis  \nhowever, it can reduce the accuracy of the analysis.", 
-                            items, 0, False)
-                        if not ok:
-                            raise DataProcessingError("Channel selection cancelled by user.")   
-                        self.shared_info.ptu_time_binning = bin_factors[items.index(item)]
-
-                print("extracting data ...")
-                time_slice = slice(None, None, self.shared_info.ptu_time_binning)
-                full_selection = (..., time_slice)
-                if self.shared_info.ptu_time_binning >2:
-                    # disable temporal offset subtraction (baseline correction)
-                    # large time binning (factor > 2) merges the electronic noise floor with the signal's rising edge
-                    # this leads to over-subtraction and distortion of the decay curve
-                    self.shared_info.config["subtract_offset"] = False 
-                    # update parameters box in main window
-                    self.main_window.parameters_data.update_offset(enable_offset=False)
-                    
-
-                # decode image with the specified channel and selection
-                data_array = ptu.decode_image(
-                    full_selection,
-                    channel=self.shared_info.ptu_channel,
-                    asxarray=False,
-                    keepdims=False,
-                    frame=-1 # sums up all time channels
-                )
-
-                data = np.transpose(data_array, (2, 1, 0))
-                t_series = initial_t_series[time_slice]
-
-                print("finished loading ptu file ...")
-            
-            elif file_name.endswith('.tiff') or file_name.endswith('.tif'):
-                data = imread(file_name)
-                data = data.squeeze()
-            
-                # check if x and y dimentions are equal
-                if data.shape[1] != data.shape[2]:
-                    if data_type == "reference":
-                        # reference files with unequal space dimentions can not be anlysed, raise error
-                        raise DataProcessingError(f"Reference file must have identical x and y dimensions. \nCurrent dimensions are: {data.shape[1]}x{data.shape[2]}")
-                    elif data_type == "sample":
-                        if sample_count == 0: 
-                            show_error_message(self.main_window, "File Error", f"For best visualisation results we recommend files having identical x and y dimensions. \nCurrent dimensions are: {data.shape[1]}x{data.shape[2]}")
-
-                if bin_width is not None and bin_width != "estimate":
-                    # Accurate manual calculation: bin_width (ns) * 1e-9
-                    t_series = np.asarray([i * 1e-9 * float(bin_width) for i in range(data.shape[0])], dtype=np.float32)
-
-                else:
-                    # Mark as empty to trigger frequency estimation in the next step
-                    t_series = np.array([], dtype=np.float32)
-
-            else:
-                raise UnsupportedFileFormatError()
-
-            # Check the dimensions of the data
-            if data.ndim < 3:
-                raise DataProcessingError(
-                    f"Image is not raw 3D FLIM data. Image dimensions should be >= 3, but current dimensions: {data.ndim}"
-                )
-
-            return data, t_series
-        
-        # error messages if the files can not be loaded properly
-        except UnsupportedFileFormatError as e:
+    def select_ptu_options(self, ptu, data_type="sample"):
+        """Ask for the channel and time binning of .ptu files, once per import (applied to all the files imported)"""
+        cache = self.ptu_cache()
+        header = ptu_header(ptu) if cache is None else cache.header(ptu)
+        if self.shared_info.ptu_channel is None:
+            self.select_channel(header["shape"][3], data_type)
+
+        # check if file time dimentions are larger than 100
+        initial_t_series = np.asarray(header["t_series"], dtype=np.float32)
+        if self.shared_info.ptu_time_binning == None:
+            if initial_t_series.shape[0] > 100:
+                # get options for binning time dimentions
+                final_shapes, final_time_resolution, bin_factors = ptu_time_bin_options(initial_t_series)
+                # combine final time dimentions and resolutions into a list of options
+                items = [
+                    f"Time dimensions: {final_shape}, resolution: {resolution} ps, "
+                    for resolution, final_shape in zip(final_time_resolution, final_shapes)
+                ]
+                item, ok = QInputDialog.getItem(
+                    self.main_window, "Bin time dimentions", 
+                    "Select a bin factor: \n(this will be applied to all the images imported)\n\n Note: binning time dimentions will result to faster analysis  \nhowever, it can reduce the accuracy of the analysis.", 
+                    items, 0, False)
+                if not ok:
+                    raise DataProcessingError("Channel selection cancelled by user.")   
+                self.shared_info.ptu_time_binning = bin_factors[items.index(item)]
+
+        if (self.shared_info.ptu_time_binning or 1) >2:
+            # disable temporal offset subtraction (baseline correction)
+            # large time binning (factor > 2) merges the electronic noise floor with the signal's rising edge
+            # this leads to over-subtraction and distortion of the decay curve
+            self.shared_info.config["subtract_offset"] = False 
+            # update parameters box in main window
+            self.main_window.parameters_data.update_offset(enable_offset=False)
+
+    def select_channel(self, num_channels, data_type="sample"):
+        """Ask for the detector channel (.ptu channel or .sdt data block) to analyse, once per import.
+        Samples with several channels can be imported with all of them, decoded once and added as one file per channel"""
+        items = [f"Channel {i}" for i in range(num_channels)]
+        if data_type == "sample" and num_channels > 1:
+            items.append("All channels")
+        item, ok = QInputDialog.getItem(
+            self.main_window, "Select Channel", 
+            "Select a channel to analyse: \n(this will be applied to all the images imported)", 
+            items, 0, False)
+        if not ok:
+            raise DataProcessingError("Channel selection cancelled by user.")   
+        self.shared_info.ptu_channel = ALL_CHANNELS if item == "All channels" else items.index(item)
+
+    def ptu_cache(self):
+        """Cache of decoded .ptu histograms (None if switched off in the config)"""
+        if self.shared_info.config["ptu_cache"] == "False":
+            return None
+        return PtuCache(max_bytes=int(float(self.shared_info.config["ptu_cache_size"]) * 2**20))
+
+    def show_loading_error(self, file_name, e):
+        """Error message for files that can not be loaded properly"""
+        if isinstance(e, UnsupportedFileFormatError):
             show_error_message(self.main_window, "File Error", str(e))
-            raise
-        except DataProcessingError as e:
+        elif isinstance(e, DataProcessingError):
             show_error_message(self.main_window, "Processing Error", str(e))
-            raise
-        except Exception as e:
+        elif isinstance(e, MaskingError):
+            show_error_message(self.main_window, "Masking Error", str(e))
+        else:
             # tiff loading error
             error_msg = str(e)
 
@@ -193,70 +148,21 @@ class LifetimeData(QObject):
                     f"An unexpected error occurred while loading the file:\n{e}"
                 )
 
-            raise FileLoadingError(f"Error loading file '{file_name}': {e}")
-
        
-    def ptu_select_time_bins(self, t_series):
-        """Select time bins and resolution for binning time dimentions of large files (time dimentions > 512)"""
-        n = t_series.shape[0]
-        final_time_resolution = []
-        final_shapes = []
-        bin_factors = []
-        target_final_shape = 50
-        
-        # Do not round the initial resolution
-        initial_time_resolution = (t_series[1] - t_series[0]) * 10**12
-
-        power = 0
-        while True:
-            bin_factor = 2**power
-            
-            # Calculate the final shape correctly
-            final_shape = n // bin_factor + min(1, n % bin_factor)
-            
-            if final_shape < target_final_shape:
-                break
-
-            final_time_resolution.append(np.round((initial_time_resolution * bin_factor),2))
-            final_shapes.append(final_shape)
-            bin_factors.append(bin_factor)
-            power += 1
-
-        return final_shapes, final_time_resolution, bin_factors
+    def check_xy_dimensions(self, x_dim, y_dim, data_type, sample_count):
+        """check if x and y dimentions are equal"""
+        if x_dim != y_dim:
+            if data_type == "reference":
+                # reference files with unequal space dimentions can not be anlysed, raise error
+                raise DataProcessingError(f"Reference file must have identical x and y dimensions. \nCurrent dimensions are: {x_dim}x{y_dim}")
+            elif data_type == "sample":
+                if sample_count == 0: 
+                    show_error_message(self.main_window, "File Error", f"For best visualisation results we recommend files having identical x and y dimensions. \nCurrent dimensions are: {x_dim}x{y_dim}")
 
         
     def load_irf(self, file_name):
         try:
-            if file_name.endswith('.sdt'):
-                sdt_file = sdt.SdtFile(file_name)
-                data = np.moveaxis(sdt_file.data[0], -1, 0).astype(np.float32)
-                data = np.squeeze(data)
-                t_series = sdt_file.times[0].astype(np.float32)
-                
-                # Check if the data is one-dimensional
-                if data.ndim != 1:
-                    raise DataProcessingError(f"IRF data must be one-dimensional. Current dimensions: {data.shape}")
-                
-                # Reshape the data to (data.shape[0], 1, 1)
-                data = data.reshape((data.shape[0], 1, 1)).astype(np.float32)
-
-            elif file_name.endswith('.csv'):
-                # Load the CSV file
-                irf = np.genfromtxt(file_name, delimiter=',', skip_header=0).T
-
-                # Check the number of columns
-                num_columns = irf.shape[0]
-                if num_columns != 2:
-                        raise DataProcessingError("Please provide a file with only 2 columns")
-
-                # Extract the IRF data from the selected column
-                data = irf[1]
-                data = data.reshape((data.shape[0], 1, 1)).astype(np.float32)
-                t_series = irf[0]  
-            else:
-                raise UnsupportedFileFormatError("Only .sdt and .csv file formats are supported for IRF data.")
-            
-            return data, t_series
+            return read_irf(file_name)
 
         except UnsupportedFileFormatError as e:
             show_error_message(self.main_window, "File Error", str(e))
@@ -268,19 +174,6 @@ class LifetimeData(QObject):
             show_error_message(self.main_window, "Loading Error", f"An unexpected error occurred while loading the file: {e}")
             raise FileLoadingError(f"Error loading file '{file_name}': {e}")
 
-    
-    def mask_data(self, masks_dir, file_name, data):
-        """Mask data based on manual masks provided"""
-        try:
-            im = Image.open(os.path.join(masks_dir, file_name.split('.')[0] + ' segmentation.tif'))
-            mask_arr = np.array(im, dtype=np.float32)
-            # Create a masked version of the data
-            masked_data = np.where(mask_arr == 0, np.zeros_like(data), data)
-            return masked_data, mask_arr
-        except Exception as e:
-            show_error_message(self.main_window, "Masking Error", f"Error masking data for file '{file_name}': {e}")
-            raise MaskingError(f"Error masking data for file '{file_name}': {e}")
-        
 
     def calc_w(self):
         """ Calculate w (angular frequeny) """
@@ -290,70 +183,33 @@ class LifetimeData(QObject):
     
 
 
-    def calc_Coordinates(self, data, t_series, bins, min_photons, offset_type="subtract_offset", max_photons_t=False, mode_same=False):
+    def calc_Coordinates(self, data, t_series, bins, min_photons, offset_type="subtract_offset", max_photons_t=False, mode_same=False, region_mask=None):
         """Import data, mask based on minimum photon counts per pixel threshold,
         bin data and calculate s and g coordinates """
 
-        intensity = data.sum(0)  # sum along the time channels to reduce the matrix to 2 dimensions (x and y only), where the values of x and y are the photon counts at each pixel
+        return phasor_coordinates(data, t_series, self.calc_w(), bins, min_photons=int(min_photons), mode_same=mode_same,
+                                  region_mask=region_mask, **self.coordinate_settings(offset_type, max_photons_t))
 
-        # Create intensity mask, masking out pixels with less photons than the threshold value
-        masked_data = np.where(intensity < int(min_photons), 0, data)
+    def coordinate_settings(self, offset_type="subtract_offset", max_photons_t=False):
+        """Maximum photon threshold, offset fraction (None when not used) and memory budget passed on to the phasor calculation"""
+        max_photons = None
         if max_photons_t and self.shared_info.config["max_photons"] != "None":
-            masked_data = np.where(intensity > int(self.shared_info.config["max_photons"]), 0, masked_data)
-
-        kernel = np.ones((1, bins, bins))
-        if mode_same:
-            binData = signal.fftconvolve(masked_data, kernel, mode='same', axes=None)
-        else:
-            binData = signal.fftconvolve(masked_data, kernel, mode='valid', axes=None)
-
-        img_dim = binData.shape
-        if mode_same:
-            # because of binning some background pixels may have been assigned lifetime values
-            # set background pixels back to zero
-            binData = np.where(masked_data.sum(0) == 0, 0, binData)
-        binData = np.reshape(binData, (data.shape[0], -1))  # reshape array stacking x and y dimensions
+            max_photons = int(self.shared_info.config["max_photons"])
 
         # subtract offset of the decay curve
+        offset_fraction = None
         if self.shared_info.config[offset_type] != "False":
             offset_fraction = float(self.shared_info.config["fraction_offset"])/100
-            num_offset_bins = int(offset_fraction * binData.shape[0])
-            # get the average photon counts in the first time-bins and subtract this from the rest of the time bins
-            binData = binData - np.mean(binData[:num_offset_bins], axis=0)
-            # set negative values to zero
-            binData = binData.clip(min=0)
-
-        binData_int = binData.sum(0)  # sum along time-channels, to get photon counts per pixel
-        binData_int = np.reshape(binData_int, (-1))  # reshape to match binData dimensions
-
-        # Calculate g = (I(t)*cos(wt))/I(t) and s= (I(t)*sin(wt))/I(t) ) coordinates for the reference data (!!! need to understand better)
-        # calculates cos(wt) and sin(wt) and reconstruct matrices so that they have the same dimensions as binData
-        cos = np.tile(np.cos(self.calc_w() * t_series), [binData.shape[1], 1]).T
-        sin = np.tile(np.sin(self.calc_w() * t_series), [binData.shape[1], 1]).T
-        # Calculate the s and g
-        # background pixels have been set to zero, but these need to be included in order to visualize the lifetime maps later on in the analysis
-        g = np.divide((binData * cos).sum(0), binData_int, out=np.zeros_like(binData_int), where=binData_int != 0)
-        g = np.nan_to_num(g)  # replace NaN with zero, to maintain background pixels
-        s = np.divide((binData * sin).sum(0), binData_int, out=np.zeros_like(binData_int), where=binData_int != 0)
-        s = np.nan_to_num(s)  # replace NaN with zero, to maintain background pixels
-
-        return g, s, img_dim, masked_data
+
+        # memory used by the phasor calculation of one file, MB to bytes
+        memory_budget = int(float(self.shared_info.config["memory_budget"]) * 2**20)
+
+        return {"max_photons": max_photons, "offset_fraction": offset_fraction, "memory_budget": memory_budget}
     
     def ref_lifetimes(self, ref_g, ref_s,):
         """Correct reference sample modulation and phase lifetimes based on the expected reference lifetime value """
 
-        # remove zeros values from arrays
-        gRef_m = np.mean(ref_g[ref_g != 0])
-        sRef_m = np.mean(ref_s[ref_s != 0])
-
-        mod_exp = 1/np.sqrt(1 +((self.ref_lifetime*self.calc_w())**2))  # Expected modulation value based on expected lifetime of reference (1/sqrt(1+w^2*lifetime^2))
-        phase_exp = math.atan(self.calc_w()*self.ref_lifetime) # Expected phase value based on expected lifetime of reference (tan^-1(w*lifetime))
-
-        # Calculate the modulation and phase correction from the reference sample
-        mod_Cor = mod_exp/np.sqrt((gRef_m**2)+(sRef_m**2))
-        phase_Cor = phase_exp - math.atan2(sRef_m,gRef_m)
-
-        return mod_Cor, phase_Cor
+        return reference_correction(ref_g, ref_s, self.calc_w(), self.ref_lifetime)
 
     def ref_correction(self):
         '''Load reference file and calculate modulation and phase correction'''
@@ -383,22 +239,7 @@ class LifetimeData(QObject):
     def data_lifetimes(self, g_data, s_data, M_Cor, phi_Cor):
         """ Calculate corrected g and s coordinates and modulation and phase lifetimes of the data using the corrected reference lifetimes """
 
-        # correct g and s coordinates based on reference lifetime
-        G_dd = (g_data*np.cos(phi_Cor) - s_data*np.sin(phi_Cor))*M_Cor
-        S_dd = (g_data*np.sin(phi_Cor) + s_data*np.cos(phi_Cor))*M_Cor
-
-        #Phase lifetime check
-        phase_lifetime=self.calc_w()**(-1)*np.divide(S_dd, G_dd, out=np.zeros_like(G_dd), where=G_dd!=0)
-
-        #Mod lifetime check
-        phi=np.arctan(np.divide(S_dd, G_dd, out=np.zeros_like(G_dd), where=G_dd!=0))
-        M=G_dd/np.cos(phi)
-
-        # ignore zero values
-        with np.errstate(invalid='ignore'):
-            mod_lifetime = np.sqrt(np.maximum(np.divide(1, M, out=np.zeros_like(M), where=M!=0)**2 - 1, 0)) / self.calc_w()
-
-        return G_dd, S_dd, mod_lifetime, phase_lifetime
+        return calibrate_coordinates(g_data, s_data, self.calc_w(), M_Cor, phi_Cor)
     
             
 
@@ -418,12 +259,11 @@ class LifetimeData(QObject):
         
         return data_bins
 
-    def lifetime_parameters(self, filename, M_ref, phi_ref):
-        '''Load sample files, apply masks and calculate coordinates'''
+    def sample_input(self, filename):
+        '''Get the data, time series and manual mask (if available) of a sample file'''
         raw_data= self.shared_info.raw_data_dict[filename]['data']
         t_series= self.shared_info.raw_data_dict[filename]['t_series']
-        condition= self.shared_info.raw_data_dict[filename]['condition']
-        mask_data= self.shared_info.raw_data_dict[filename]['masked_data']
+        mask_arr= self.shared_info.raw_data_dict[filename]['mask_arr']
 
         t_series = np.asarray(t_series)
 
@@ -433,20 +273,167 @@ class LifetimeData(QObject):
             t_series = np.linspace(0, (raw_data.shape[0]-1) * t_resolution, raw_data.shape[0], dtype=np.float32)
             self.shared_info.raw_data_dict[filename]['t_series'] = t_series
             print("bin width estimated as:", t_resolution*10**9, "ns")
-  
-        # analyse manually masked data if availabe
-        if mask_data is not None:
-            data = mask_data
+
+        return raw_data, t_series, mask_arr
+
+    def stage_inputs(self, filename, M_ref, phi_ref):
+        '''Inputs of the analysis stages of a file besides the config values (see utils/analysis_stages.py)'''
+        file_info = self.shared_info.raw_data_dict[filename]
+        return {"data": (file_info.get("file_path"), file_info.get("data_id", id(file_info["data"]))),
+                "mask_arr": array_digest(file_info["mask_arr"]),
+                "reference": (float(M_ref), float(phi_ref)),
+                "condition": file_info["condition"]}
+
+    def cube_settings(self):
+        '''Calculation reading the raw data of the files and its settings. Without offset subtraction this is only the decay
+        projections (thresholds, masks and binning are applied to them afterwards), otherwise the phasor coordinates'''
+        settings = self.coordinate_settings(offset_type="subtract_offset", max_photons_t=True)
+        if settings["offset_fraction"] is None:
+            return decay_projections, {"w": self.calc_w(), "memory_budget": settings["memory_budget"]}
+        return phasor_coordinates, dict(w=self.calc_w(), bins=self.get_bins(), min_photons=int(self.shared_info.config["min_photons"]),
+                                        mode_same=True, **settings)
+
+    def calculation_input(self, filename, function, settings):
+        '''Data, time series and keyword arguments of the calculation of a file, the manual mask is passed on to the
+        phasor calculation (the decay projections are not masked)'''
+        data, t_series, mask_arr = self.sample_input(filename)
+        if function is phasor_coordinates:
+            settings = dict(settings, region_mask=mask_arr)
+        return data, t_series, settings
+
+    def calculate(self, filename, function, settings):
+        '''Run the calculation of cube_settings on one file'''
+        data, t_series, kwargs = self.calculation_input(filename, function, settings)
+        return function(data, t_series, **kwargs)
+
+    def cube_results(self, filenames, workers):
+        '''Yield (filename, result of cube_settings) in the order of filenames. Results are read from the phasor cache when
+        the same data was analysed with the same parameters before, the others are calculated (in a process pool if requested)'''
+        function, settings = self.cube_settings()
+        names = CACHED_ARRAYS[function]
+        cache, keys, cached = None, {}, {}
+
+        if self.shared_info.config["phasor_cache"] != "False":
+            cache = PhasorCache(max_bytes=int(float(self.shared_info.config["cache_size"]) * 2**20))
+            # the memory budget changes how the data is read, not the results
+            params = {name: value for name, value in settings.items() if name != "memory_budget"}
+            for filename in filenames:
+                if self.should_stop:
+                    return
+                data, t_series, kwargs = self.calculation_input(filename, function, settings)
+                keys[filename] = cache.key(data, t_series, region_mask=kwargs.get("region_mask"), function=function.__name__, **params)
+                arrays = cache.get(keys[filename])
+                if arrays is not None:
+                    cached[filename] = _from_arrays(arrays, names)
+
+        missing = [filename for filename in filenames if filename not in cached]
+        if workers > 1 and len(missing) > 1:
+            computed = self.parallel_calculation(missing, min(workers, len(missing)), function, settings)
         else:
-            data = raw_data
-
-        # calculate sample g and s coordinates
-        g, s, img_shape, out_data = self.calc_Coordinates( data, t_series, bins = self.get_bins(), min_photons= self.shared_info.config["min_photons"],
-                                                           offset_type="subtract_offset",max_photons_t = True, mode_same = True)
-        # correct g and s coordinates & modulation and phase lifetimes based on reference sample
-        g_data, s_data, M_data, phi_data  = self.data_lifetimes(g, s,  M_ref,  phi_ref)
-        return  out_data, g_data, s_data, M_data, phi_data, img_shape, condition
-    
+            computed = ((filename, self.calculate(filename, function, settings)) for filename in missing)
+
+        with closing(computed):
+            for filename in filenames:
+                if filename in cached:
+                    yield filename, cached[filename]
+                    continue
+                filename, result = next(computed, (None, None))
+                if result is None:
+                    return  # calculation stopped
+                if cache is not None:
+                    cache.put(keys[filename], _to_arrays(result, names))
+                yield filename, result
+
+    def parallel_calculation(self, filenames, workers, function, settings):
+        '''Run the calculation of cube_settings on the files in a pool of worker processes.
+        Memory-mapped files are reopened by the workers, in-memory data is handed to them through shared memory.
+        Results are yielded in the order of filenames'''
+        executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+        pending = deque()  # (filename, shared memory block, future) in submission order
+        queued = iter(filenames)
+
+        def submit_next():
+            filename = next(queued, None)
+            if filename is None:
+                return
+            data, t_series, kwargs = self.calculation_input(filename, function, settings)
+            if getattr(data, "is_memmap", False):
+                pending.append((filename, None, executor.submit(function, data, t_series, **kwargs)))
+                return
+            data = np.asarray(data)
+            shm = to_shared_memory(data)
+            try:
+                future = executor.submit(call_with_shared_data, function, shm.name, data.shape, data.dtype, t_series, **kwargs)
+            except Exception:
+                shm.close()
+                shm.unlink()
+                raise
+            pending.append((filename, shm, future))
+
+        try:
+            # keep a bounded number of files in shared memory, so memory use does not grow with the batch size
+            for _ in range(2 * workers):
+                submit_next()
+
+            while pending:
+                filename, shm, future = pending[0]
+                while True:
+                    if self.should_stop:
+                        return
+                    try:
+                        result = future.result(timeout=0.2)
+                        break
+                    except FuturesTimeoutError:
+                        continue
+                pending.popleft()
+                if shm is not None:
+                    shm.close()
+                    shm.unlink()
+                submit_next()
+                yield filename, result
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+            for _, shm, _ in pending:
+                if shm is not None:
+                    shm.close()
+                    shm.unlink()
+
+    def update_results(self, filename, stale, cube_result, M_ref, phi_ref, signatures):
+        '''Recalculate the stale stages of a file from the new cube result (None if the raw data was not read again) or
+        from the results of the earlier stages kept in the results dictionary'''
+        result = self.shared_info.results_dict.setdefault(filename, FileResult())
+        file_info = self.shared_info.raw_data_dict[filename]
+        self.shared_info.thumbnails.pop(filename, None)
+        self.shared_info.phasor_histograms.pop(filename, None)
+        offset = self.coordinate_settings(offset_type="subtract_offset")["offset_fraction"] is not None
+
+        if "projection" in stale and offset:
+            result.pop('projections', None)  # out of date, read again when offset subtraction is switched off
+
+        if "phasor" in stale:
+            if offset:
+                g, s, img_shape, intensity = cube_result
+            else:
+                # photon thresholds, manual mask and binning are applied to the decay projections
+                projections = result['projections'] = cube_result if cube_result is not None else result['projections']
+                settings = self.coordinate_settings(offset_type="subtract_offset", max_photons_t=True)
+                g, s, img_shape, intensity = projection_coordinates(
+                    projections, file_info['data'].shape[0], self.get_bins(), int(self.shared_info.config["min_photons"]),
+                    settings["max_photons"], mode_same=True, region_mask=file_info['mask_arr'])
+            # the uncalibrated coordinates are kept, so a new reference only needs the reference correction
+            result.update({'g_raw': g, 's_raw': s, 'img_shape': img_shape, 'intensity': intensity})
+
+        if "calibration" in stale or "lifetime" in stale:
+            g_data, s_data, M_data, phi_data = self.data_lifetimes(result['g_raw'], result['s_raw'], M_ref, phi_ref)
+            # the average lifetime is calculated from M and phi when it is used
+            result.update({'g': g_data, 's': s_data, 'M': M_data, 'phi': phi_data, 'phasor_mask': None})
+
+        result['condition'] = file_info['condition']
+        result['mask'] = file_info['mask_arr']
+        if "statistics" in stale:
+            result['stats'] = file_stats(filename, result, self.shared_info.config["detail_stats"] == "True")
+        result['stages'] = signatures
+
     def analyse_data(self):
     
         try:
@@ -454,72 +441,56 @@ class LifetimeData(QObject):
 
             # Initiate dictionary
             M_ref, phi_ref = self.ref_correction()
+            offset = self.coordinate_settings(offset_type="subtract_offset")["offset_fraction"] is not None
 
-            total_files = len(self.shared_info.raw_data_dict)
-            files_exclude = 0
-
-            # Determine the number of files to exclude
+            # stages to recalculate per file, files with all stages up to date are skipped
+            stale, signatures = {}, {}
             for filename, file_info in self.shared_info.raw_data_dict.items():
-                condition = file_info['condition']
-                if file_info['analyse'] == 'no' or (filename in self.shared_info.results_dict and self.shared_info.results_dict[filename]['condition'] == condition) or (filename in self.shared_info.ref_files_dict.keys()):
-                    files_exclude += 1
+                if file_info['analyse'] == 'no' or file_info['data'] is None or filename in self.shared_info.ref_files_dict.keys():
+                    continue
+                signatures[filename] = stage_signatures(self.shared_info.config, self.stage_inputs(filename, M_ref, phi_ref))
+                previous = self.shared_info.results_dict.get(filename, {}).get('stages', {})
+                changed = stale_stages(previous, signatures[filename])
+                if changed:
+                    stale[filename] = changed
 
-            total_files -= files_exclude
+            total_files = len(stale)
 
             if total_files == 0:
                 # If there are no files to analyze, set progress bar to 100% and emit analysisFinished signal
                 self.progressUpdated.emit(100, "")
-                return
+                return self.shared_info.results_dict
 
             processed_files = 0
             total_files +=1
-            # Loop through files in directory
-            for filename, file_info in self.shared_info.raw_data_dict.items():
-                if self.should_stop:
-                    return self.shared_info.results_dict  # Exit if stop flag is set
-                condition = file_info['condition']
-                # Check if the filename and condition are already in self.results_dict
-                if filename in self.shared_info.results_dict and self.shared_info.results_dict[filename]['condition'] == condition or (filename in self.shared_info.ref_files_dict.keys()):
-                    continue  # Skip this file if it is already processed
+            # the raw data is only read again for files whose phasor coordinates can not be updated from their decay projections
+            cube_files = [filename for filename, changed in stale.items() if "phasor" in changed and
+                          (offset or "projection" in changed or 'projections' not in self.shared_info.results_dict.get(filename, {}))]
+
+            # reuse cached results, spread the other files across a process pool if requested
+            cube_results = self.cube_results(cube_files, int(self.shared_info.config["workers"]))
+
+            with closing(cube_results):
+                for filename, changed in stale.items():
+                    cube_result = None
+                    if filename in cube_files:
+                        _, cube_result = next(cube_results, (None, None))
+                    if self.should_stop or (filename in cube_files and cube_result is None):
+                        return self.shared_info.results_dict  # Exit if stop flag is set
 
-                if file_info['analyse'] == 'yes':
                     # Emit progress signal
                     processed_files += 1
                     progress_percentage = int((processed_files / total_files) * 100)
                     self.progressUpdated.emit(progress_percentage, filename)
 
-                    # Extract the lifetime parameters for each sample
-                    sample_data, g_data, s_data, M_data, phi_data, img_shape, condition = self.lifetime_parameters(filename, M_ref, phi_ref)
-                    # Save coordinates and lifetimes in results dictionary
-                    self.shared_info.results_dict[filename] = {
-                        'sample_data': sample_data, 'g': g_data, 's': s_data, 'M': M_data,
-                        'phi': phi_data, 'average': (M_data + phi_data) / 2, 'phasor_mask': None,
-                        'img_shape': img_shape, 'condition': condition, 'mask': self.shared_info.raw_data_dict[filename]['mask_arr']
-                    }
+                    # Update the coordinates and lifetimes of the stale stages in the results dictionary
+                    self.update_results(filename, changed, cube_result, M_ref, phi_ref, signatures[filename])
 
             
             # Save key output parameters into a pandas df format
-            lifetime_means_dict = []
-            for sample_name, sample_data in self.shared_info.results_dict.items():
-                condition = sample_data['condition']
-                for region_index, (M_value, phi_value, average_value) in enumerate(zip(
-                    get_tau_roi(mask=sample_data['mask'], tau_map=sample_data['M']),
-                    get_tau_roi(mask=sample_data['mask'], tau_map=sample_data['phi']),
-                    get_tau_roi(mask=sample_data['mask'], tau_map=sample_data['average']))):
-                    lifetime_means_dict.append({
-                        'sample': sample_name,
-                        'condition': condition,
-                        'region': region_index + 1,  # Adjust based on your region numbering
-                        'M': M_value,
-                        'M_mean': round(np.asarray(sample_data['M'][sample_data['M'] >0]*1e9).mean(), 3),
-                        'phi': phi_value,
-                        'phi_mean': round(np.asarray(sample_data['phi'][sample_data['phi'] >0]*1e9).mean(), 3),
-                        'average': average_value,
-                        'average_mean': round(np.asarray(sample_data['average'][sample_data['average'] >0]*1e9).mean(), 3),
-                    })
-
-            # Convert the list of dictionaries directly into a DataFrame
-            self.shared_info.df_stats = pd.DataFrame(lifetime_means_dict)
+            self.shared_info.df_stats = lifetime_stats(self.shared_info.results_dict,
+                                                       self.shared_info.config["detail_stats"] == "True")
+            self.shared_info.roi_masks = {}
 
             processed_files += 1
             progress_percentage = int((processed_files / total_files) * 100)
@@ -531,32 +502,4 @@ class LifetimeData(QObject):
         except Exception as e:
             show_error_message(self.main_window, "Analysis Error", f"An error occurred during data analysis: {str(e)}")
 
-                
-def get_tau_roi(mask, tau_map):
-    """ Get lifetime mean for each region of interest in the manual mask"""
-
-    # Initialize an empty list to hold the tau values for each region of interest
-    tau_roi = []
-    if mask is not None:
-        # Identify unique regions (excluding 0 for background)
-        regions = np.unique(mask[mask != 0])
-        
-        # Iterate over each region to extract the tau values
-        for region in regions:
-            # Create a boolean mask for the current region
-            region_mask = (mask == region)
-            
-            # Flatten the mask to match the flattened tau array structure, if necessary
-            region_mask_flattened = region_mask.reshape(-1)
-            
-            # Use the mask to select tau values for the current region
-            tau_region = tau_map[region_mask_flattened]
-            tau_region = tau_region[tau_region > 0]  # Filter out zero values
-
-            # Store mean of each tau roi, rounded to 3 decimal places
-            tau_roi.append(round(float(tau_region.mean()) * 1e9, 3))
-    
-    else:
-        tau_roi.append(round(np.asarray(tau_map[tau_map >0]*1e9).mean(), 3))
 
-    return tau_roi
\ No newline at end of file
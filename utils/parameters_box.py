@@ -9,6 +9,7 @@ class ParameterWidgets():
         self.main_window = main_window
         self.ref_file_combobox = None  # Specific reference for the "Reference file" combobox
         self.subtract_offset_combobox = False # Initial setting for substarct offset
+        self.input_widgets = {}  # input widget of each parameter
         self.shared_info = SharedData()
         
 
@@ -58,6 +59,7 @@ class ParameterWidgets():
                                        color: white; }""")
             h_layout_parameters.addWidget(input_widget)
 
+        self.input_widgets[param_id] = input_widget
         return h_layout_parameters
 
 
@@ -88,6 +90,18 @@ class ParameterWidgets():
             self.ref_file_combobox.addItems(ref_filenames)
             print("Updated reference files:", ref_filenames)
     
+    def refresh_parameters(self):
+        '''Show the config values in the input widgets, e.g. after a session was opened'''
+        for param_id, input_widget in self.input_widgets.items():
+            input_widget.blockSignals(True)
+            if isinstance(input_widget, QLineEdit):
+                input_widget.setText(str(self.shared_info.config.get(param_id, "")))
+            else:
+                index = input_widget.findText(str(self.shared_info.config.get(param_id, "")))
+                if index >= 0:
+                    input_widget.setCurrentIndex(index)
+            input_widget.blockSignals(False)
+
     def update_offset(self, enable_offset: bool):
         # Determine the string value to set
         new_value = "True" if enable_offset else "False"
@@ -116,5 +130,11 @@ class ParameterWidgets():
         grid_parameters.addLayout(self.parameter_input(param_name="Number of bins", input_type="combobox", items=["3x3", "7x7", "9x9", "12x12", "None"], param_id="bins"), 2, 1)
         grid_parameters.addLayout(self.parameter_input(param_name="Baseline correction", input_type="combobox", items=["False", "True"], param_id="subtract_offset"), 3, 0)
         grid_parameters.addLayout(self.parameter_input(param_name="% time bins (baseline corr.)", param_id="fraction_offset"), 3, 1)
+        grid_parameters.addLayout(self.parameter_input(param_name="Parallel processes", param_id="workers",
+                                                       tooltip="Number of files analysed at the same time (1 analyses them one after the other)"), 4, 0)
+        grid_parameters.addLayout(self.parameter_input(param_name="Memory per file (MB)", param_id="memory_budget",
+                                                       tooltip="Approximate memory used to analyse one file, large files are analysed in tiles"), 4, 1)
+        grid_parameters.addLayout(self.parameter_input(param_name="Detailed statistics", input_type="combobox", items=["False", "True"], param_id="detail_stats",
+                                                       tooltip="Add the pixel count, median, std, quartiles and phasor centroid of each region to the lifetime values"), 5, 0)
 
         return grid_parameters
\ No newline at end of file
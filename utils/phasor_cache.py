@@ -0,0 +1,125 @@
+"""On-disk cache of analysis results (phasor coordinates, decay projections), keyed by the content of the raw data and
+the parameters of the analysis"""
+import os
+import json
+import hashlib
+
+import numpy as np
+
+from utils.flim_dataset import FlimDataset
+
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".flimpa", "phasor_cache")
+# increase when the phasor calculation changes, so results of older versions are not reused
+CACHE_VERSION = 2
+_HASH_CHUNK = 16 * 2**20
+
+
+class PhasorCache:
+    """Compressed .npz files of analysis results (e.g. phasor coordinates or decay projections) in a cache directory,
+    evicting the least recently used entries once the directory grows larger than max_bytes.
+
+    Files are hashed by content. The digests of memory-mapped files are remembered by path, size and modification
+    time, so a file is only read again when it has changed.
+    """
+
+    def __init__(self, cache_dir=CACHE_DIR, max_bytes=2 * 2**30):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+        self._digests_path = os.path.join(cache_dir, "digests.json")
+        try:
+            with open(self._digests_path) as f:
+                self._digests = json.load(f)
+        except (OSError, ValueError):
+            self._digests = {}
+
+    def key(self, data, t_series, region_mask=None, **params):
+        """Cache key of the results calculated from data with these parameters (e.g. w, bins, photon thresholds)"""
+        h = hashlib.blake2b(digest_size=20)
+        h.update(self.data_digest(data).encode())
+        h.update(np.ascontiguousarray(t_series, dtype=np.float64).tobytes())
+        if region_mask is not None:
+            region_mask = np.ascontiguousarray(region_mask)
+            h.update(repr((region_mask.shape, region_mask.dtype.str)).encode())
+            h.update(region_mask.tobytes())
+        h.update(repr((CACHE_VERSION, sorted(params.items()))).encode())
+        return h.hexdigest()
+
+    def data_digest(self, data):
+        """Content hash of raw data, memory-mapped files are hashed from disk"""
+        if isinstance(data, FlimDataset) and data.is_memmap:
+            return self._file_digest(data.file_name) + repr(data.layout)
+
+        h = hashlib.blake2b(digest_size=20)
+        data = data if isinstance(data, FlimDataset) else FlimDataset(np.asarray(data))
+        h.update(repr((data.shape, data.dtype.str)).encode())
+        for start, stop in data.tiles():
+            h.update(np.ascontiguousarray(data.rows(start, stop)).tobytes())
+        return h.hexdigest()
+
+    def _file_digest(self, file_name):
+        stat = os.stat(file_name)
+        file_id = f"{os.path.abspath(file_name)}|{stat.st_size}|{stat.st_mtime_ns}"
+        digest = self._digests.get(file_id)
+        if digest is None:
+            h = hashlib.blake2b(digest_size=20)
+            with open(file_name, 'rb') as f:
+                for chunk in iter(lambda: f.read(_HASH_CHUNK), b''):
+                    h.update(chunk)
+            digest = self._digests[file_id] = h.hexdigest()
+            self._save_digests()
+        return digest
+
+    def _save_digests(self):
+        tmp_path = self._digests_path + f".{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(self._digests, f)
+        os.replace(tmp_path, self._digests_path)
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + ".npz")
+
+    def get(self, key):
+        """Cached arrays (dictionary), or None"""
+        path = self._path(key)
+        try:
+            with np.load(path) as f:
+                arrays = {name: f[name] for name in f.files}
+        except (OSError, KeyError, ValueError):
+            return None
+        os.utime(path)  # mark as recently used
+        return arrays
+
+    def put(self, key, arrays):
+        """Store a dictionary of arrays and evict the least recently used entries above the size limit"""
+        path = self._path(key)
+        tmp_path = path[:-len(".npz")] + f".{os.getpid()}.tmp.npz"
+        np.savez_compressed(tmp_path, **arrays)
+        os.replace(tmp_path, path)
+        self.evict()
+
+    def evict(self):
+        """Remove the least recently used entries until the cache fits within max_bytes"""
+        evict_lru(self.cache_dir, self.max_bytes, ".npz")
+
+
+def evict_lru(cache_dir, max_bytes, suffix, keep=()):
+    """Remove the least recently used (by modification time) files ending with suffix from cache_dir until they fit
+    within max_bytes, files in keep (e.g. the entry just written) are not removed"""
+    entries = []
+    for entry in os.scandir(cache_dir):
+        if entry.name.endswith(suffix) and ".tmp" not in entry.name:
+            stat = entry.stat()
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        if path in keep:
+            continue
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total -= size
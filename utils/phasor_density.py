@@ -0,0 +1,171 @@
+"""Density images of phasor coordinates, drawn instead of one marker per pixel"""
+import math
+from typing import NamedTuple
+
+import numpy as np
+from matplotlib import colormaps, colors
+
+# g and s range of the density images (the zoom limits of the phasor plot) and their number of bins along g and s
+PHASOR_EXTENT = (-0.2, 1.2, -0.02, 0.8)
+DENSITY_BINS = (700, 410)
+# the phasor plot draws a marker per pixel up to this number of points, density images above it
+POINT_LIMIT = 50000
+# bins across the g range of the contour plots
+CONTOUR_BINS = 50
+
+
+class FileHistogram(NamedTuple):
+    """Counts of the phasor points of a file (or condition) in the density bins, kept for the bins with points only"""
+    index: np.ndarray  # flat density bin index (row along s, column along g)
+    counts: np.ndarray
+    points: int  # pixels with phasor coordinates (also those outside the density grid)
+    pixels: int  # pixels of the image
+
+    def dense(self, bins=DENSITY_BINS):
+        """(s bins, g bins) array of the counts"""
+        counts = np.zeros(bins[0] * bins[1], dtype=np.float64)
+        counts[self.index] = self.counts
+        return counts.reshape(bins[1], bins[0])
+
+
+def valid_phasors(g, s):
+    """Boolean array of the pixels with phasor coordinates (background pixels are zero)"""
+    return (g != 0) & (s != 0)
+
+
+def phasor_points(g, s):
+    """g and s of the pixels with phasor coordinates"""
+    keep = valid_phasors(g, s)
+    return g[keep], s[keep]
+
+
+def bin_index(g, s, bins=DENSITY_BINS, extent=PHASOR_EXTENT):
+    """Flat index (row along s, column along g) of the density bin of every point, -1 outside the extent"""
+    nx, ny = bins
+    with np.errstate(invalid='ignore'):
+        x = np.floor((np.asarray(g, dtype=np.float64) - extent[0]) * (nx / (extent[1] - extent[0])))
+        y = np.floor((np.asarray(s, dtype=np.float64) - extent[2]) * (ny / (extent[3] - extent[2])))
+        inside = (x >= 0) & (x < nx) & (y >= 0) & (y < ny)
+    return np.where(inside, y * nx + x, -1).astype(np.intp)
+
+
+def phasor_histogram(g, s, weights=None, bins=DENSITY_BINS, extent=PHASOR_EXTENT):
+    """(s bins, g bins) counts of the points in the density bins, or sums of their weights if given.
+    Drawn with imshow(origin='lower', extent=extent)"""
+    index = bin_index(g, s, bins, extent)
+    inside = index >= 0
+    if weights is not None:
+        weights = np.asarray(weights, dtype=np.float64)[inside]
+    return np.bincount(index[inside], weights=weights, minlength=bins[0] * bins[1]).reshape(bins[1], bins[0])
+
+
+def file_histogram(g, s):
+    """FileHistogram of the phasor coordinates of a file"""
+    g_points, s_points = phasor_points(g, s)
+    counts = phasor_histogram(g_points, s_points).reshape(-1)
+    index = np.flatnonzero(counts)
+    return FileHistogram(index.astype(np.int32), counts[index].astype(np.uint32), g_points.size, np.size(g))
+
+
+def sum_histograms(histograms):
+    """FileHistogram of the points of several files together (e.g. of a condition)"""
+    histograms = list(histograms)
+    if not histograms:
+        return FileHistogram(np.empty(0, np.int32), np.empty(0, np.uint32), 0, 0)
+    index, inverse = np.unique(np.concatenate([h.index for h in histograms]), return_inverse=True)
+    counts = np.bincount(inverse.reshape(-1), weights=np.concatenate([h.counts for h in histograms]), minlength=index.size)
+    return FileHistogram(index.astype(np.int32), counts.astype(np.uint32), sum(h.points for h in histograms),
+                         sum(h.pixels for h in histograms))
+
+
+def density_alpha(counts, alpha=0.5):
+    """Opacity of the bins with points: log scaled counts, at least a quarter of alpha"""
+    peak = counts.max() if counts.size else 0
+    return alpha * (0.25 + 0.75 * np.log1p(counts) / np.log1p(max(peak, 1)))
+
+
+def density_image(layers, alpha=0.5, bins=DENSITY_BINS):
+    """RGBA image of density layers [(FileHistogram, colour)], each drawn over the previous ones as markers of one
+    colour would be (alpha compositing), so many files are drawn as a single image. Only the bins with points of a
+    layer are composited"""
+    image = np.zeros((bins[0] * bins[1], 4))  # colours premultiplied by their opacity while compositing
+    for histogram, color in layers:
+        filled = histogram.index
+        a = density_alpha(histogram.counts.astype(np.float64), alpha)[:, np.newaxis]
+        image[filled, :3] = np.asarray(colors.to_rgb(color)) * a + image[filled, :3] * (1 - a)
+        image[filled, 3:] = a + image[filled, 3:] * (1 - a)
+    return _straight_alpha(image).reshape(bins[1], bins[0], 4)
+
+
+def histogram_bins(n_pixels):
+    """Bins across the g range of the histogram of n_pixels pixels (sqrt(n_pixels)/2)"""
+    return int(math.sqrt(n_pixels) / 2)
+
+
+def pooling_factor(histogram, n_bins, bins=DENSITY_BINS, extent=PHASOR_EXTENT):
+    """Density bins per side of a block about as wide as n_bins bins across the g range of the points"""
+    if histogram.index.size == 0:
+        return 1
+    columns = histogram.index % bins[0]
+    return max(1, int(round((int(columns.max()) - int(columns.min()) + 1) / max(int(n_bins), 1))))
+
+
+def pooled_blocks(counts, factor, extent=PHASOR_EXTENT):
+    """Counts summed over blocks of factor x factor density bins and the extent of the blocks"""
+    ny, nx = counts.shape
+    by, bx = -(-ny // factor), -(-nx // factor)
+    padded = np.zeros((by * factor, bx * factor), dtype=counts.dtype)
+    padded[:ny, :nx] = counts
+    blocks = padded.reshape(by, factor, bx, factor).sum(axis=(1, 3))
+    width, height = (extent[1] - extent[0]) / nx, (extent[3] - extent[2]) / ny
+    return blocks, (extent[0], extent[0] + bx * factor * width, extent[2], extent[2] + by * factor * height)
+
+
+def pooled_histogram(counts, factor):
+    """Counts summed over blocks of factor x factor density bins, every bin of a block holding the block sum"""
+    if factor <= 1:
+        return counts
+    blocks, _ = pooled_blocks(counts, factor)
+    return np.repeat(np.repeat(blocks, factor, axis=0), factor, axis=1)[:counts.shape[0], :counts.shape[1]]
+
+
+def histogram_image(layers, cmap='jet', alpha=0.75, bins=DENSITY_BINS):
+    """RGBA image of histograms [(FileHistogram, number of bins across its g range)] on the density grid, each through
+    the colour map on its own logarithmic scale (as hist2d with LogNorm) and drawn over the previous ones"""
+    cmap = colormaps.get_cmap(cmap)
+    image = np.zeros((bins[0] * bins[1], 4))
+    for histogram, n_bins in layers:
+        counts = pooled_histogram(histogram.dense(bins), pooling_factor(histogram, n_bins, bins)).reshape(-1)
+        filled = np.flatnonzero(counts)
+        if filled.size == 0:
+            continue
+        values = counts[filled]
+        rgb = cmap(colors.LogNorm(values.min(), values.max())(values))[:, :3]
+        image[filled, :3] = rgb * alpha + image[filled, :3] * (1 - alpha)
+        image[filled, 3] = alpha + image[filled, 3] * (1 - alpha)
+    return _straight_alpha(image).reshape(bins[1], bins[0], 4)
+
+
+def contour_grid(histogram, n_bins=CONTOUR_BINS):
+    """Counts of a FileHistogram in blocks about as wide as n_bins bins across its g range, and the extent of the
+    blocks (for ax.contour)"""
+    return pooled_blocks(histogram.dense(), pooling_factor(histogram, n_bins))
+
+
+def _straight_alpha(image):
+    """Divide the premultiplied colours of a flattened RGBA image by their opacity"""
+    opaque = image[:, 3] > 0
+    image[opaque, :3] /= image[opaque, 3:]
+    return image
+
+
+def value_image(g, s, values, cmap, vmin, vmax, alpha=0.5):
+    """RGBA image of points coloured by a value (e.g. lifetime): the mean value of every bin through the colour map,
+    with the opacity of its density"""
+    counts = phasor_histogram(g, s)
+    sums = phasor_histogram(g, s, weights=values)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = sums / counts
+    image = colormaps.get_cmap(cmap)(colors.Normalize(vmin, vmax)(np.ma.masked_invalid(mean)))
+    image[..., 3] = np.where(counts > 0, density_alpha(counts, alpha), 0)
+    return image
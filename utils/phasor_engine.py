@@ -0,0 +1,418 @@
+"""Numerical core of the phasor analysis"""
+import math
+import warnings
+from collections import deque
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from utils.flim_dataset import as_dataset
+
+# dtype policy of the analysis: decays, decay projections, phasor coordinates, intensity images and lifetime maps are
+# float32, as they are kept for every file of a session. Sums over many pixels or time bins (box sums, reference and
+# region means) accumulate in float64
+FLOAT_DTYPE = np.float32
+
+# memory (bytes) the phasor calculation of one file may use, unless set otherwise
+MEMORY_BUDGET = 256 * 2**20
+# whole-image 2D arrays (intensity, projections, binned images, g, s and temporaries) held besides the tiles, counted
+# in float64 images
+_IMAGE_COPIES = 8
+
+# cos(wt) and sin(wt) vectors, keyed by (angular frequency, time series)
+_basis_cache = {}
+_BASIS_CACHE_SIZE = 16
+
+
+def phasor_basis(w, t_series):
+    """Return the cos(wt) and sin(wt) vectors used to project decays onto the phasor plot.
+
+    The vectors are cached, so a batch of files acquired with the same settings computes them only once.
+    """
+    t_series = np.ascontiguousarray(t_series)
+    key = (float(w), t_series.dtype.str, t_series.tobytes())
+    basis = _basis_cache.get(key)
+    if basis is None:
+        wt = float(w) * t_series.astype(np.float64)
+        basis = (np.cos(wt), np.sin(wt))
+        for vector in basis:
+            vector.flags.writeable = False  # shared between calls, must not be modified in place
+
+        if len(_basis_cache) >= _BASIS_CACHE_SIZE:
+            _basis_cache.pop(next(iter(_basis_cache)))  # drop the oldest entry
+        _basis_cache[key] = basis
+    return basis
+
+
+def project_decays(data, basis_vector):
+    """Reduce decays (time along the first axis) against a basis vector: sum_t I(t)*v(t) for every pixel"""
+    if data.dtype.kind == 'f':
+        basis_vector = basis_vector.astype(data.dtype, copy=False)  # avoid upcasting a float32 cube to float64
+    return np.tensordot(basis_vector, data, axes=(0, 0))
+
+
+def bin_pixels(data, bins, mode_same=False, dtype=None):
+    """Sum every pixel with its neighbours in a bins x bins box (spatial binning).
+
+    Equivalent to convolving each time plane of (T, X, Y) data (or a single (X, Y) image) with np.ones((bins, bins)),
+    with the same output sizes as the 'same' and 'valid' modes of scipy.signal.fftconvolve. The box sums are taken
+    from running (cumulative) sums along x and then y, so the cost does not depend on the bin size.
+    The sums are returned as dtype (FLOAT_DTYPE if None).
+    """
+    data = np.asarray(data)
+    planes = data[np.newaxis] if data.ndim == 2 else data
+    binned = _bin_planes(planes, _box_window(planes.shape[-2], bins, mode_same), _box_window(planes.shape[-1], bins, mode_same), dtype)
+    return binned[0] if data.ndim == 2 else binned
+
+
+def _bin_planes(planes, row_window, col_window, dtype=None):
+    """Box sums of every (X, Y) plane of a stack, over the given row and column windows (FLOAT_DTYPE if dtype is None)"""
+    binned = np.empty((planes.shape[0], row_window[0].size, col_window[0].size), dtype=dtype or FLOAT_DTYPE)
+    for i, plane in enumerate(planes):
+        # accumulate in float64 per plane, so large photon counts are summed exactly
+        binned[i] = _box_sum(_box_sum(plane, col_window, axis=1), row_window, axis=0)
+    return binned
+
+
+def _box_window(n, bins, mode_same):
+    """Lower and upper cumulative-sum indices of the box covered by every output pixel along one axis"""
+    if mode_same:
+        start, size = (bins - 1) // 2, n
+    else:
+        # as fftconvolve, a box larger than the image gives bins-n+1 positions that each cover the whole axis
+        start, size = min(n, bins) - 1, abs(n - bins) + 1
+    # position j of the full convolution sums the input from j-bins+1 to j (clipped to the image)
+    j = np.arange(start, start + size)
+    return np.maximum(j - bins + 1, 0), np.minimum(j, n - 1) + 1
+
+
+def _box_sum(plane, window, axis):
+    """Box sums along one axis of a 2D plane, taken as differences of its cumulative sum"""
+    lower, upper = window
+    shape = list(plane.shape)
+    shape[axis] += 1
+    csum = np.zeros(shape, dtype=np.float64)
+    np.cumsum(plane, axis=axis, dtype=np.float64, out=csum[1:] if axis == 0 else csum[:, 1:])
+    return csum.take(upper, axis=axis) - csum.take(lower, axis=axis)
+
+
+def photon_mask(intensity, min_photons=0, max_photons=None):
+    """Boolean image of the pixels whose photon counts lie within the threshold values"""
+    keep = intensity >= min_photons
+    if max_photons is not None:
+        keep &= intensity <= max_photons
+    return keep
+
+
+def phasor_coordinates(data, t_series, w, bins, min_photons=0, max_photons=None, offset_fraction=None, mode_same=False,
+                       region_mask=None, memory_budget=None):
+    """Mask (T, X, Y) data by photon counts per pixel (and by a manual mask of labelled regions, if given), bin it and
+    calculate the flattened g and s coordinates.
+
+    The data is read in tiles of rows sized to stay within memory_budget (bytes), so memory-mapped datasets are never
+    read into memory as a whole. Binning and the phasor sums are both linear, so without offset subtraction the decays
+    are first reduced to three images (intensity, sum I(t)*cos(wt), sum I(t)*sin(wt)) and only these are binned
+    ("reduce-then-bin"). Offset subtraction clips negative counts per time bin, which is not linear, so in that case
+    every tile is binned as a cube (see _binned_offset_phasor).
+    Returns g, s, the binned image dimensions and the masked intensity image.
+    """
+    data = as_dataset(data)
+    budget = MEMORY_BUDGET if memory_budget is None else memory_budget
+
+    if offset_fraction is None:
+        return projection_coordinates(decay_projections(data, t_series, w, budget), data.shape[0], bins, min_photons, max_photons,
+                                      mode_same=mode_same, region_mask=region_mask)
+
+    cos, sin = phasor_basis(w, t_series)
+    return _binned_offset_phasor(data, cos, sin, bins, mode_same, (min_photons, max_photons, region_mask),
+                                 int(offset_fraction * data.shape[0]), budget)
+
+
+def decay_projections(data, t_series, w, memory_budget=None):
+    """Intensity, sum I(t)*cos(wt) and sum I(t)*sin(wt) images of the (unmasked) decays, read in tiles of rows.
+
+    This is the only pass over the whole cube without offset subtraction. Photon thresholds, manual masks and binning
+    are applied to these images afterwards (projection_coordinates), so they can change without reading the data again.
+    """
+    data = as_dataset(data)
+    cos, sin = phasor_basis(w, t_series)
+    budget = MEMORY_BUDGET if memory_budget is None else memory_budget
+    T, X, Y = data.shape
+    intensity, intensity_cos, intensity_sin = (np.empty((X, Y), dtype=FLOAT_DTYPE) for _ in range(3))
+
+    step = _rows_per_tile(budget, row_bytes=4*T*Y, image_bytes=8*X*Y)
+    for start in range(0, X, step):
+        stop = min(start + step, X)
+        tile = _float_rows(data, start, stop)
+        intensity[start:stop] = tile.sum(0)
+        intensity_cos[start:stop] = project_decays(tile, cos)
+        intensity_sin[start:stop] = project_decays(tile, sin)
+        del tile
+
+    return intensity, intensity_cos, intensity_sin
+
+
+def projection_coordinates(projections, n_time_bins, bins, min_photons=0, max_photons=None, mode_same=False, region_mask=None):
+    """Phasor coordinates without offset subtraction, from the images of decay_projections: mask the pixels by photon
+    counts (and manual mask), then bin the masked images. Returns g, s, the binned image dimensions and the masked
+    intensity image, as phasor_coordinates."""
+    intensity, intensity_cos, intensity_sin = projections
+    # mask out pixels with less (or more) photons than the threshold values
+    # the projections are per pixel, so masking them is the same as masking the decays
+    keep = _keep_mask(intensity, min_photons, max_photons, region_mask)
+    masked_intensity = np.where(keep, intensity, 0).astype(FLOAT_DTYPE, copy=False)
+
+    bin_int = bin_pixels(masked_intensity, bins, mode_same=mode_same)
+    bin_cos = bin_pixels(np.where(keep, intensity_cos, 0), bins, mode_same=mode_same)
+    bin_sin = bin_pixels(np.where(keep, intensity_sin, 0), bins, mode_same=mode_same)
+    img_dim = (n_time_bins,) + bin_int.shape
+    if mode_same:
+        # because of binning some background pixels may have been assigned lifetime values
+        # set background pixels back to zero
+        bin_int = np.where(masked_intensity == 0, 0, bin_int)
+
+    g, s = _phasor_ratios(bin_cos, bin_sin, bin_int)
+    return g.reshape(-1), s.reshape(-1), img_dim, masked_intensity
+
+
+def time_lapse_coordinates(read_frames, n_frames, t_series, w, bins, window=1, step=1, min_photons=0, max_photons=None,
+                           offset_fraction=None, mode_same=False, region_mask=None, memory_budget=None):
+    """Phasor coordinates of a time-lapse, for every window of `window` consecutive frames starting every `step`
+    frames. read_frames(start, stop) returns the (T, X, Y) decays of frames start to stop summed (e.g. decoded from
+    the records of these frames only), so the frames are never held together.
+
+    Without offset subtraction and with overlapping windows, every frame is read once and only reduced to its three
+    projection images (decay_projections), which are summed per window. Otherwise every window is read as a whole.
+    Yields the first frame of each window and its g, s, binned image dimensions and masked intensity image, as
+    phasor_coordinates.
+    """
+    starts = range(0, n_frames - window + 1, step)
+    if offset_fraction is not None or step >= window:
+        for start in starts:
+            yield (start,) + phasor_coordinates(read_frames(start, start + window), t_series, w, bins, min_photons, max_photons,
+                                                offset_fraction, mode_same, region_mask, memory_budget)
+        return
+
+    # projections of the frames of the current window, the oldest frame is dropped as the window slides
+    projections = deque(maxlen=window)
+    n_time_bins = None
+    for frame in range(starts[-1] + window if starts else 0):
+        data = as_dataset(read_frames(frame, frame + 1))
+        n_time_bins = data.shape[0]
+        projections.append(decay_projections(data, t_series, w, memory_budget))
+        del data
+        start = frame + 1 - window
+        if start >= 0 and start % step == 0:
+            summed = [np.sum(images, axis=0, dtype=FLOAT_DTYPE) for images in zip(*projections)]
+            yield (start,) + projection_coordinates(summed, n_time_bins, bins, min_photons, max_photons, mode_same, region_mask)
+
+
+def _binned_offset_phasor(data, cos, sin, bins, mode_same, masks, num_offset_bins, budget):
+    """Phasor coordinates with offset subtraction, binning the decays of one tile of output rows at a time"""
+    T, X, Y = data.shape
+    row_window = _box_window(X, bins, mode_same)
+    col_window = _box_window(Y, bins, mode_same)
+    out_rows, out_cols = row_window[0].size, col_window[0].size
+
+    # the whole-image arrays are the masked intensity, g and s (float32)
+    masked_intensity = np.empty((X, Y), dtype=FLOAT_DTYPE)
+    g = np.empty((out_rows, out_cols), dtype=FLOAT_DTYPE)
+    s = np.empty((out_rows, out_cols), dtype=FLOAT_DTYPE)
+    image_bytes = 12*X*Y
+
+    # a tile of output rows binned as a cube needs the input rows its bins reach into (halo of bins-1 rows), which is
+    # cheaper than running sums as long as the tiles are at least as tall as their halo. Per row: the decays read and
+    # masked, and the binned decays with their temporaries
+    halo_bytes, row_bytes = 8*T*Y*(bins - 1), 8*T*(Y + out_cols)
+    if image_bytes + halo_bytes + max(bins - 1, 1) * row_bytes <= budget:
+        step = _rows_per_tile(budget, row_bytes, fixed_bytes=image_bytes + halo_bytes)
+        tiles = _halo_tiles(data, row_window, col_window, masks, masked_intensity, step)
+    else:
+        # per row of a tile: the decays read and masked, their cumulative sums along the columns and the running sums
+        step = _rows_per_tile(budget, row_bytes=8*T*(2*Y + 4*out_cols), fixed_bytes=image_bytes + 16*T*out_cols)
+        tiles = _running_sum_tiles(data, row_window, col_window, masks, masked_intensity, step)
+
+    for start, stop, binned in tiles:
+        if mode_same:
+            binned[:, masked_intensity[start:stop] == 0] = 0
+        g[start:stop], s[start:stop] = _offset_phasor(binned, cos, sin, num_offset_bins)
+        del binned
+
+    return g.reshape(-1), s.reshape(-1), (T, out_rows, out_cols), masked_intensity
+
+
+def _halo_tiles(data, row_window, col_window, masks, masked_intensity, step):
+    """Binned decays of every tile of output rows, from the input rows of the tile and its halo"""
+    row_lower, row_upper = row_window
+    for start in range(0, row_lower.size, step):
+        stop = min(start + step, row_lower.size)
+        lo, hi = int(row_lower[start]), int(row_upper[stop - 1])
+        masked = _masked_rows(data, lo, hi, masks, masked_intensity)
+        binned = _bin_planes(masked, (row_lower[start:stop] - lo, row_upper[start:stop] - lo), col_window)
+        del masked
+        yield start, stop, binned
+
+
+def _running_sum_tiles(data, row_window, col_window, masks, masked_intensity, step):
+    """Binned decays of every tile of output rows, as differences of two running sums of the rows: one reading ahead
+    of the boxes and one behind them. The rows a box reaches into are read twice instead of being held in memory (a
+    reference binned over its whole height would otherwise keep bins-1 rows of the cube)"""
+    row_lower, row_upper = row_window
+    ahead = _RowSums(data, col_window, masks, masked_intensity, step)
+    behind = _RowSums(data, col_window, masks, masked_intensity, step)
+    for start in range(0, row_lower.size, step):
+        stop = min(start + step, row_lower.size)
+        yield start, stop, (ahead.above(row_upper[start:stop]) - behind.above(row_lower[start:stop])).astype(FLOAT_DTYPE)
+
+
+class _RowSums:
+    """Running sum of the masked, column-binned rows of a dataset, read forward in tiles of at most step rows"""
+
+    def __init__(self, data, col_window, masks, masked_intensity, step):
+        self.data, self.col_window, self.masks, self.masked_intensity = data, col_window, masks, masked_intensity
+        self.step = step
+        self.row = 0  # the rows above this one are summed in total
+        self.total = np.zeros((data.shape[0], 1, col_window[0].size), dtype=np.float64)
+
+    def above(self, rows):
+        """(T, rows, columns) sums of the rows above each of the given rows (non-decreasing, and not above the rows of
+        the previous call)"""
+        first, last = int(rows[0]), int(rows[-1])
+        while self.row < first:
+            # rows before the first one only add to the total
+            stop = min(self.row + self.step, first)
+            self.total += self._binned_rows(self.row, stop).sum(axis=1, keepdims=True)
+            self.row = stop
+        sums = np.empty((self.total.shape[0], last - first + 1, self.total.shape[2]), dtype=np.float64)
+        sums[:, :1] = self.total
+        np.cumsum(self._binned_rows(first, last), axis=1, out=sums[:, 1:])
+        sums[:, 1:] += self.total
+        self.total, self.row = sums[:, -1:].copy(), last
+        return sums[:, np.asarray(rows) - first]
+
+    def _binned_rows(self, start, stop):
+        masked = _masked_rows(self.data, start, stop, self.masks, self.masked_intensity)
+        T, rows, Y = masked.shape
+        csum = np.zeros((T, rows, Y + 1), dtype=np.float64)
+        np.cumsum(masked, axis=2, dtype=np.float64, out=csum[:, :, 1:])
+        del masked
+        lower, upper = self.col_window
+        return csum[:, :, upper] - csum[:, :, lower]
+
+
+def _offset_phasor(binned, cos, sin, num_offset_bins):
+    """g and s of binned decays, after subtracting their offset (average counts in the first time bins)"""
+    # get the average photon counts in the first time-bins and subtract this from the rest of the time bins
+    binned -= np.mean(binned[:num_offset_bins], axis=0)
+    np.clip(binned, 0, None, out=binned)  # set negative values to zero
+    return _phasor_ratios(project_decays(binned, cos), project_decays(binned, sin), binned.sum(0))
+
+
+def _phasor_ratios(bin_cos, bin_sin, bin_int):
+    """g = sum(I(t)*cos(wt))/sum(I(t)) and s = sum(I(t)*sin(wt))/sum(I(t))"""
+    # background pixels stay zero, they are needed to visualise the lifetime maps later on in the analysis
+    g = np.nan_to_num(np.divide(bin_cos, bin_int, out=np.zeros_like(bin_int), where=bin_int != 0))
+    s = np.nan_to_num(np.divide(bin_sin, bin_int, out=np.zeros_like(bin_int), where=bin_int != 0))
+    return g, s
+
+
+def _rows_per_tile(budget, row_bytes, image_bytes=0, fixed_bytes=0):
+    """Rows per tile that keep a tile, the fixed size buffers and the whole-image 2D arrays (intensity, projections,
+    binned images and their temporaries) within the memory budget. The budget is a target: if not even a tile of one
+    row fits, tiles of one row are used and a RuntimeWarning is issued"""
+    available = budget - _IMAGE_COPIES * image_bytes - fixed_bytes
+    if available < row_bytes:
+        needed = math.ceil((budget - available + row_bytes) / 2**20)
+        warnings.warn(f"A memory budget of {budget / 2**20:g} MB is too small for a {image_bytes // 8} pixel image "
+                      f"({needed} MB are needed), it is analysed one row at a time", RuntimeWarning, stacklevel=2)
+        return 1
+    return int(available // row_bytes)
+
+
+def _float_rows(data, start, stop):
+    """Rows start to stop of a dataset as floating point decays (integer counts are converted to float32)"""
+    tile = data.rows(start, stop)
+    return tile if tile.dtype.kind == 'f' else tile.astype(FLOAT_DTYPE)
+
+
+def _masked_rows(data, start, stop, masks, masked_intensity):
+    """Copy of the rows start to stop with the masked pixels set to zero, also storing their masked intensity"""
+    tile = data.rows(start, stop)
+    intensity = tile.sum(0, dtype=FLOAT_DTYPE)
+    keep = _keep_mask(intensity, *masks, start, stop)
+    masked_intensity[start:stop] = np.where(keep, intensity, 0)
+    return np.where(keep, tile, FLOAT_DTYPE(0))
+
+
+def _keep_mask(intensity, min_photons, max_photons, region_mask=None, start=0, stop=None):
+    """Photon mask of the rows start to stop, restricted to the labelled regions of the manual mask if given"""
+    keep = photon_mask(intensity, min_photons, max_photons)
+    if region_mask is not None:
+        keep &= np.asarray(region_mask)[start:stop] != 0
+    return keep
+
+
+def reference_correction(ref_g, ref_s, w, ref_lifetime):
+    """Modulation and phase correction from the reference coordinates and the expected reference lifetime (in s)"""
+
+    # remove zeros values from arrays
+    gRef_m = np.mean(ref_g[ref_g != 0], dtype=np.float64)
+    sRef_m = np.mean(ref_s[ref_s != 0], dtype=np.float64)
+
+    mod_exp = 1/np.sqrt(1 +((ref_lifetime*w)**2))  # Expected modulation value based on expected lifetime of reference (1/sqrt(1+w^2*lifetime^2))
+    phase_exp = math.atan(w*ref_lifetime) # Expected phase value based on expected lifetime of reference (tan^-1(w*lifetime))
+
+    # Calculate the modulation and phase correction from the reference sample
+    mod_Cor = mod_exp/np.sqrt((gRef_m**2)+(sRef_m**2))
+    phase_Cor = phase_exp - math.atan2(sRef_m,gRef_m)
+
+    return mod_Cor, phase_Cor
+
+
+def calibrate_coordinates(g_data, s_data, w, M_Cor, phi_Cor):
+    """Corrected g and s coordinates and the modulation and phase lifetimes, using the reference corrections"""
+    # the maps are FLOAT_DTYPE, the corrections are applied as Python floats so they do not upcast them to float64
+    g_data = np.asarray(g_data, dtype=FLOAT_DTYPE)
+    s_data = np.asarray(s_data, dtype=FLOAT_DTYPE)
+    w, M_Cor = float(w), float(M_Cor)
+    cos_phi, sin_phi = math.cos(phi_Cor), math.sin(phi_Cor)
+
+    # correct g and s coordinates based on reference lifetime
+    G_dd = (g_data*cos_phi - s_data*sin_phi)*M_Cor
+    S_dd = (g_data*sin_phi + s_data*cos_phi)*M_Cor
+
+    #Phase lifetime check
+    phase_lifetime=w**(-1)*np.divide(S_dd, G_dd, out=np.zeros_like(G_dd), where=G_dd!=0)
+
+    #Mod lifetime check
+    phi=np.arctan(np.divide(S_dd, G_dd, out=np.zeros_like(G_dd), where=G_dd!=0))
+    M=G_dd/np.cos(phi)
+
+    # ignore zero values
+    with np.errstate(invalid='ignore'):
+        mod_lifetime = np.sqrt(np.maximum(np.divide(1, M, out=np.zeros_like(M), where=M!=0)**2 - 1, 0)) / w
+
+    return G_dd, S_dd, mod_lifetime, phase_lifetime
+
+
+def call_with_shared_data(function, shm_name, shape, dtype, *args, **kwargs):
+    """Process pool entry point: call function(data, *args, **kwargs) on in-memory data held in shared memory.
+
+    The data is read in place from the shared memory block, so the cube is never pickled. Only the result (2D
+    images and coordinates) is sent back to the parent process.
+    """
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        data = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        result = function(data, *args, **kwargs)
+        del data  # release the view before closing the block
+    finally:
+        shm.close()
+    return result
+
+
+def to_shared_memory(data):
+    """Copy an array into a new shared memory block (the caller is responsible for closing and unlinking it)"""
+    shm = shared_memory.SharedMemory(create=True, size=max(data.nbytes, 1))
+    np.ndarray(data.shape, dtype=data.dtype, buffer=shm.buf)[...] = data
+    return shm
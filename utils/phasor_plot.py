@@ -7,16 +7,23 @@ from PySide6.QtCore import Signal, Qt
 
 import matplotlib.pyplot as plt
 from matplotlib import colors
-from matplotlib.patches import Patch
+from matplotlib.artist import Artist
+from matplotlib.patches import Patch, Ellipse, Polygon
 import seaborn as sns
-from matplotlib.widgets import EllipseSelector
+from matplotlib.widgets import EllipseSelector, PolygonSelector
 from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
 from matplotlib.backends.backend_qt5agg import NavigationToolbar2QT as NavigationToolbar2QT
 
 from utils.shared_data import SharedData
 from utils.helper_functions import Helpers
+from utils.phasor_roi import EllipseROI, PolygonROI, PhasorIndex, apply_rois
+from utils.region_stats import roi_fractions
+from utils.phasor_density import (PHASOR_EXTENT, POINT_LIMIT, phasor_points, file_histogram, sum_histograms, density_image,
+                                   histogram_bins, histogram_image, contour_grid, pooled_blocks, pooling_factor, value_image)
 from utils.mainwindow import *
 
+ROI_COLOR = (60 / 255, 162 / 255, 161 / 255)
+
 
 class PhasorPlot(QWidget):
     def __init__(self, main_window):
@@ -27,6 +34,11 @@ class PhasorPlot(QWidget):
         self.w = 2 * math.pi * float(self.shared_info.config["frequency"]) * 1000000
         self.g = None
         self.s = None
+        self.roi_index = None  # pixels of the plotted file grouped by phasor bin, built for the first ROI
+        self.roi_motion = None
+        self.roi_extents = None
+        self.gallery_rois = []  # ROIs drawn on the gallery plot since the ROI button was pressed, applied to all files
+        self.roi_artists = []  # outlines and numbers of the gallery ROIs
         self.xlims = (-0.2, 1.2)  # Set appropriate limits
         self.ylims = (-0.02, 0.8)  # Set appropriate limits
         self.is_individual_connected = False
@@ -35,6 +47,9 @@ class PhasorPlot(QWidget):
         self.canvas_phasor = self.main_window.canvas_phasor
         self.fixed_dpi = self.main_window.fixed_dpi
         self.tau_labels_active = True  # Initial state: on
+        self.density_drawn = False  # points drawn as a density image, they have no legend handles
+        self.condition_files = {}  # file names of the conditions of the condition plot
+        self.condition_histograms = {}  # histograms of the conditions of the condition plot
         self.initUI()  # Initialize the UI here
 
 
@@ -63,6 +78,13 @@ class PhasorPlot(QWidget):
         self.btn_select.setStyleSheet('QPushButton {color: white;}')
         buttonLayout.addWidget(self.btn_select)
 
+        # Dropdown to select the shape of the ROIs
+        self.roi_shape_dropdown = QComboBox()
+        self.roi_shape_dropdown.addItems(["Ellipse", "Polygon"])
+        self.roi_shape_dropdown.setStyleSheet('QComboBox {color: white; background-color: rgb(50, 50, 50);}')
+        self.roi_shape_dropdown.currentIndexChanged.connect(self.update_roi_shape)
+        buttonLayout.addWidget(self.roi_shape_dropdown)
+
         # Create and add the Display dropdown
         self.display_dropdown = QComboBox()
         self.display_dropdown.addItems(["Individual", "Condition"])  # Adding dropdown options
@@ -159,6 +181,9 @@ class PhasorPlot(QWidget):
     def add_plot(self):
         self.figure_phasor.clear()
         self.ax = self.figure_phasor.subplots()
+        self.density_drawn = False
+        # highlighted points belonged to the cleared axes
+        self.highlighted_sample = self.highlighted_condition = None
        
         dark_gray = (18 / 255, 18 / 255, 18 / 255)
 
@@ -283,37 +308,112 @@ class PhasorPlot(QWidget):
 
         if self.selector is None:
             # Recreate the selector to associate it with the current axes
-            self.selector = EllipseSelector(self.ax, self.onselect, useblit=True,
-                                            props={'facecolor': 'none', 'edgecolor': (60 / 255, 162 / 255, 161 / 255), 'alpha': 0.8, 'linewidth': 1},
-                                            interactive=True)
+            self.selector = self.roi_selector()
+            # the ROI is applied while the ellipse is drawn, moved or resized, not only when it is released
+            self.roi_motion = self.canvas_phasor.mpl_connect('motion_notify_event', self.on_roi_motion)
             self.btn_select.setStyleSheet('QPushButton {background-color: rgb(60, 162, 161); color: white;}')
         else:
             self.deactivate_roi()
 
+    def roi_selector(self):
+        """Selector of the chosen ROI shape. On the plot of one file the ROI can be moved and resized, on the gallery
+        plots every ROI drawn is added to the ROIs applied to all files"""
+        if self.roi_shape_dropdown.currentText() == "Polygon":
+            return PolygonSelector(self.ax, self.onselect_polygon, useblit=True, props={'color': ROI_COLOR, 'alpha': 0.8, 'linewidth': 1})
+        return EllipseSelector(self.ax, self.onselect, useblit=True,
+                               props={'facecolor': 'none', 'edgecolor': ROI_COLOR, 'alpha': 0.8, 'linewidth': 1},
+                               interactive=self.g is not None)
+
+    def update_roi_shape(self):
+        """Draw the next ROI with the chosen shape, the ROIs already drawn on a gallery plot are kept"""
+        if self.selector is not None:
+            self.selector.set_active(False)
+            self.selector.set_visible(False)
+            self.selector = self.roi_selector()
+            self.canvas_phasor.draw_idle()
+
     def deactivate_roi(self):
         if self.selector is not None:
             self.selector.set_active(False)
             self.selector.set_visible(False)
             self.selector = None
+            for artist in self.roi_artists:
+                if artist.axes is self.ax:  # not already cleared with the figure
+                    artist.remove()
+            self.gallery_rois, self.roi_artists = [], []
+            self.canvas_phasor.mpl_disconnect(self.roi_motion)
+            self.roi_motion = self.roi_extents = None
             self.btn_select.setStyleSheet('QPushButton {color: white;}')
             self.canvas_phasor.draw_idle()  # Ensure the canvas is refreshed to remove ROI visuals
 
     def onselect(self, eclick, erelease):
-        if self.g is not None and self.s is not None:
-            x1, y1 = eclick.xdata, eclick.ydata
-            x2, y2 = erelease.xdata, erelease.ydata
+        x1, y1 = eclick.xdata, eclick.ydata
+        x2, y2 = erelease.xdata, erelease.ydata
 
-            # Center of the ellipse
-            x0 = (x1 + x2) / 2
-            y0 = (y1 + y2) / 2
+        # Center of the ellipse
+        x0 = (x1 + x2) / 2
+        y0 = (y1 + y2) / 2
 
-            # Calculate semi-major and semi-minor axes lengths
-            a = abs(x2 - x1) / 2
-            b = abs(y2 - y1) / 2
+        # Calculate semi-major and semi-minor axes lengths
+        a = abs(x2 - x1) / 2
+        b = abs(y2 - y1) / 2
 
-            self.inside_ellipse = ((self.g - x0) ** 2 / a ** 2) + ((self.s - y0) ** 2 / b ** 2) <= 1
+        if self.g is not None and self.s is not None:
+            self.select_roi(EllipseROI(x0, y0, a, b))
+        elif a > 0 and b > 0:  # gallery plots: the ROI is applied to all files once drawn
+            self.add_gallery_roi(EllipseROI(x0, y0, a, b), Ellipse((x0, y0), 2 * a, 2 * b), (x0, y0 + b))
+
+    def onselect_polygon(self, vertices):
+        roi = PolygonROI(tuple(vertices))
+        if self.g is not None and self.s is not None:
+            self.select_roi(roi)
+        else:
+            self.add_gallery_roi(roi, Polygon(vertices, closed=True), max(vertices, key=lambda vertex: vertex[1]))
+            self.selector.clear()  # ready for the next polygon
+
+    def add_gallery_roi(self, roi, patch, label_position):
+        """Keep an ROI drawn on a gallery plot, outlined and numbered as its roi_k column, and apply all the ROIs kept
+        to all files"""
+        patch.set(facecolor='none', edgecolor=ROI_COLOR, alpha=0.8, linewidth=1)
+        self.roi_artists.append(self.ax.add_patch(patch))
+        self.gallery_rois.append(roi)
+        self.roi_artists.append(self.ax.annotate(str(len(self.gallery_rois)), label_position, color=ROI_COLOR, fontsize=8,
+                                                 ha='center', va='bottom'))
+        self.select_files(self.gallery_rois)
+        self.canvas_phasor.draw_idle()
 
-            self.helpers.update_data_with_roi(self.inside_ellipse)
+    def on_roi_motion(self, event):
+        # the toolbar pans or zooms while its mode is set, the ellipse is not being drawn
+        if not isinstance(self.selector, EllipseSelector) or event.button is None or self.g is None or self.toolbar.mode:
+            return
+        extents = tuple(self.selector.extents)
+        if extents != self.roi_extents:
+            self.roi_extents = extents
+            xmin, xmax, ymin, ymax = extents
+            self.select_roi(EllipseROI((xmin + xmax) / 2, (ymin + ymax) / 2, (xmax - xmin) / 2, (ymax - ymin) / 2))
+
+    def select_roi(self, roi):
+        """Highlight the pixels of the plotted file inside the ROI on the lifetime map"""
+        if self.roi_index is None:
+            self.roi_index = PhasorIndex(self.g, self.s)
+        self.inside_roi = self.roi_index.select(roi)
+
+        self.helpers.update_data_with_roi(self.inside_roi)
+
+    def select_files(self, rois):
+        """Apply phasor ROIs to all analysed files: masks of their pixels in every ROI (shared_info.roi_masks) and the
+        fraction of the pixels of every file and mask region in each ROI (roi_k columns of the statistics table)"""
+        results = self.shared_info.results_dict
+        if not results:
+            return
+        self.shared_info.roi_masks = apply_rois(results, rois)
+        self.shared_info.df_stats = roi_fractions(self.shared_info.df_stats, results, self.shared_info.roi_masks)
+        self.helpers.update_table_widget()
+
+        # pixels of the selected file in any of the ROIs, on its lifetime map
+        masks = self.shared_info.roi_masks.get(self.shared_info.config["selected_file"])
+        if masks is not None:
+            self.helpers.update_data_with_roi(masks.any(axis=0))
 
     def plot_phasor_coordinates(self, cmap=None, vmin=None, vmax=None):
         self.figure_phasor.clear()  # Clear the figure to remove all axes
@@ -327,6 +427,7 @@ class PhasorPlot(QWidget):
 
         self.g = tau_disp["g"]
         self.s = tau_disp["s"]
+        self.roi_index = None
 
         mask = (self.g != 0) & (self.s != 0)
         g_scat = self.g[mask]
@@ -335,18 +436,70 @@ class PhasorPlot(QWidget):
         tau_cmap = tau_cmap * 1e9  # Example normalization, adjust as needed
         tau_cmap = tau_cmap[mask]
 
-        self.ax.scatter(x=g_scat, y=s_scat, c=tau_cmap, cmap=cmap, vmin=float(self.shared_info.config["lifetime_vmin"]),
-                        vmax=float(self.shared_info.config["lifetime_vmax"]), s=16, linewidth=0.4, alpha=0.5)
+        vmin, vmax = float(self.shared_info.config["lifetime_vmin"]), float(self.shared_info.config["lifetime_vmax"])
+        if g_scat.size > POINT_LIMIT:
+            # too many points for markers, bins coloured by their mean lifetime
+            self.show_density(value_image(g_scat, s_scat, tau_cmap, cmap, vmin, vmax))
+        else:
+            self.ax.scatter(x=g_scat, y=s_scat, c=tau_cmap, cmap=cmap, vmin=vmin, vmax=vmax, s=16, linewidth=0.4, alpha=0.5)
 
         self.canvas_phasor.draw()
 
+    def file_histogram(self, key, result):
+        """Density bin histogram of the phasor points of an analysed file. Computed when the file is first drawn and
+        kept until it is analysed again, every plot type and highlight of the file is drawn from it"""
+        histogram = self.shared_info.phasor_histograms.get(key)
+        if histogram is None:
+            histogram = self.shared_info.phasor_histograms[key] = file_histogram(result['g'], result['s'])
+        return histogram
+
+    def condition_points(self, condition):
+        """g and s of the phasor points of all files of a condition, joined as arrays"""
+        points = [phasor_points(self.plot_data[key]['g'], self.plot_data[key]['s']) for key in self.condition_files[condition]]
+        if not points:
+            return np.empty(0, dtype=np.float32), np.empty(0, dtype=np.float32)
+        return np.concatenate([g for g, _ in points]), np.concatenate([s for _, s in points])
+
+    def draw_points(self, layers, alpha=0.5):
+        """Scatter the points of the (label, histogram, points, colour) layers, points a function returning their g and
+        s, or draw the histograms together as one density image if they hold more than POINT_LIMIT points (a marker per
+        pixel of many files stalls Matplotlib). Returns the list of artists"""
+        if sum(histogram.points for _, histogram, _, _ in layers) <= POINT_LIMIT:
+            artists = []
+            for label, _, points, color in layers:
+                g, s = points()
+                artists.append(self.ax.scatter(x=g, y=s, label=label, color=color, s=16, alpha=alpha, linewidth=0.4))
+            return artists
+        self.density_drawn = True
+        return [self.show_density(density_image([(histogram, color) for _, histogram, _, color in layers], alpha))]
+
+    def show_density(self, image):
+        """Draw an RGBA density image over the phasor plot"""
+        return self.ax.imshow(image, extent=PHASOR_EXTENT, origin='lower', aspect='auto', interpolation='nearest', zorder=1)
+
+    def draw_histograms(self, layers):
+        """2D histograms of the (histogram, bins across its g range) layers with logarithmic colour scales, drawn together
+        as one image (one mesh per file stalls Matplotlib)"""
+        if layers:
+            return self.show_density(histogram_image(layers))
+
+    def draw_contour(self, histogram, color):
+        counts, extent = contour_grid(histogram)
+        return contour_artists(self.ax.contour(counts, extent=extent, linewidths=1, colors=[color]))
+
+    def draw_filled_histogram(self, histogram, n_bins):
+        """Filled contours of a histogram in blocks about as wide as n_bins bins across its g range (highlights)"""
+        counts, extent = pooled_blocks(histogram.dense(), pooling_factor(histogram, n_bins))
+        return contour_artists(self.ax.contourf(np.ma.masked_equal(counts, 0), extent=extent, cmap='jet_r', norm=colors.LogNorm(), alpha=0.75))
+
     def plot_phasor_gallery_individual(self, data_dict):
         self.display_dropdown.setEnabled(True)
         self.scatter_dropdown.setEnabled(True)
         self.figure_phasor.clear()
         self.ax = self.figure_phasor.subplots()
         self.deactivate_roi()
-        self.btn_select.setEnabled(False)
+        self.btn_select.setEnabled(True)  # ROIs drawn on the gallery plots are applied to all files
+        self.g = self.s = self.roi_index = None
 
         # It's essential to call add_plot to ensure initial plot setup is redone
         self.add_plot()
@@ -363,27 +516,23 @@ class PhasorPlot(QWidget):
 
         self.legendWidget.legendItemSelected.connect(self.highlightPlotPoints_individual)
 
+        points, histograms = [], []
         for i, (key, value) in enumerate(data_dict.items()):
-            g = value['g']
-            s = value['s']
-            histo_bins = (math.sqrt(len(g))) / 2
-
-            mask = (g != 0) & (s != 0)
-            g_scat = g[mask]
-            s_scat = s[mask]
-
+            histogram = self.file_histogram(key, value)
             color = tab20_cmap(i % num_colors)
 
             if self.shared_info.phasor_settings["scatter_type"] == "scatter":
-                self.ax.scatter(x=g_scat, y=s_scat, label=key, color=color, s=16, alpha=0.5, linewidth=0.4)
+                # drawn together, as markers or as one density image
+                points.append((key, histogram, lambda value=value: phasor_points(value['g'], value['s']), color))
 
             elif self.shared_info.phasor_settings["scatter_type"] == "contour":
-                counts, xbins, ybins = np.histogram2d(x=g_scat, y=s_scat, bins=50)
-                self.ax.contour(counts.transpose(), extent=[xbins[0], xbins[-1], ybins[0], ybins[-1]], linewidths=1, colors=[color])
+                self.draw_contour(histogram, color)
 
             elif self.shared_info.phasor_settings["scatter_type"] == "histogram":
-                self.ax.hist2d(g_scat, s_scat, bins=int(histo_bins), cmap='jet', norm=colors.LogNorm(), alpha=0.75)
+                histograms.append((histogram, histogram_bins(histogram.pixels)))
 
+        self.draw_points(points)
+        self.draw_histograms(histograms)
         self.ax.set_xlim([-0.005, 1])
         self.ax.set_ylim([0, 0.65])
 
@@ -394,46 +543,44 @@ class PhasorPlot(QWidget):
         self.figure_phasor.clear()
         self.ax = self.figure_phasor.subplots()
         self.deactivate_roi()
-        self.btn_select.setEnabled(False)
+        self.btn_select.setEnabled(True)  # ROIs drawn on the gallery plots are applied to all files
+        self.g = self.s = self.roi_index = None
         self.add_plot()
 
         tab20_cmap = plt.get_cmap('tab20')
         num_colors = tab20_cmap.N
 
         self.plot_data = data_dict
-        unique_conditions = list(set(value['condition'] for value in data_dict.values()))
+        # files of every condition, the points of a condition are never gathered pixel by pixel
+        self.condition_files = {}
+        for key, value in data_dict.items():
+            self.condition_files.setdefault(value['condition'], []).append(key)
+        unique_conditions = list(self.condition_files)
         self.plot_data_colors = {condition: tab20_cmap(i % num_colors) for i, condition in enumerate(unique_conditions)}
 
         labels_colors_qt = [(condition, (color[0] * 255, color[1] * 255, color[2] * 255, int(color[3] * 255))) for condition, color in self.plot_data_colors.items()]
         self.legendWidget.updateLegend(labels_colors_qt, self.shared_info.phasor_settings['plot_type'])
         self.legendWidget.legendItemSelected.connect(self.highlightPlotPoints_condition)
 
-        condition_points = {condition: {'g': [], 's': []} for condition in unique_conditions}
+        # condition histograms are sums of the histograms of their files, kept for the highlights
+        self.condition_histograms = {condition: sum_histograms(self.file_histogram(key, data_dict[key]) for key in keys)
+                                     for condition, keys in self.condition_files.items()}
 
-        for key, value in data_dict.items():
-            g = value['g']
-            s = value['s']
-            condition = value['condition']
-            mask = (g != 0) & (s != 0)
-            condition_points[condition]['g'].extend(g[mask])
-            condition_points[condition]['s'].extend(s[mask])
-
-        for condition, points in condition_points.items():
-            g_scat = np.array(points['g'])
-            s_scat = np.array(points['s'])
+        scatter_points, histograms = [], []
+        for condition, histogram in self.condition_histograms.items():
             color = self.plot_data_colors[condition]
-            histo_bins = int(math.sqrt(len(g_scat)) / 2)
 
             if self.shared_info.phasor_settings["scatter_type"] == "scatter":
-                self.ax.scatter(x=g_scat, y=s_scat, label=condition, color=color, s=16, alpha=0.5, linewidth=0.4)
+                scatter_points.append((condition, histogram, lambda condition=condition: self.condition_points(condition), color))
 
             elif self.shared_info.phasor_settings["scatter_type"] == "contour":
-                counts, xbins, ybins = np.histogram2d(x=g_scat, y=s_scat, bins=50)
-                self.ax.contour(counts.transpose(), extent=[xbins[0], xbins[-1], ybins[0], ybins[-1]], linewidths=1, colors=[color])
+                self.draw_contour(histogram, color)
 
             elif self.shared_info.phasor_settings["scatter_type"] == "histogram":
-                self.ax.hist2d(g_scat, s_scat, bins=histo_bins, cmap='jet', norm=colors.LogNorm(), alpha=0.75)
+                histograms.append((histogram, histogram_bins(histogram.points)))
 
+        self.draw_points(scatter_points)
+        self.draw_histograms(histograms)
         self.ax.set_xlim([-0.005, 1])
         self.ax.set_ylim([0, 0.65])
         self.canvas_phasor.draw()
@@ -441,7 +588,6 @@ class PhasorPlot(QWidget):
     def highlightPlotPoints_individual(self, label):
         self.deactivate_roi()
         self.btn_select.setStyleSheet('QPushButton {color: white;}')
-        self.btn_select.setEnabled(False)
 
         # Remove the previous highlighted sample plot if it exists
         if hasattr(self, 'highlighted_sample') and self.highlighted_sample:
@@ -457,29 +603,21 @@ class PhasorPlot(QWidget):
 
         for i, (key, value) in enumerate(self.plot_data.items()):
             if key == label:
-                g = value['g']
-                s = value['s']
-                histo_bins = (math.sqrt(len(g))) / 2
-
-                mask = (g != 0) & (s != 0)
-                g_scat = g[mask]
-                s_scat = s[mask]
-
+                # drawn from the histogram of the file, the points are only read to draw markers
+                histogram = self.file_histogram(key, value)
                 color = self.plot_data_colors[i][1]  # Use the saved color mapping
 
                 # Highlight by using a higher alpha value or different plot parameters
                 if self.shared_info.phasor_settings["scatter_type"] == "scatter":
-                    self.highlighted_sample = self.ax.scatter(x=g_scat, y=s_scat, label=key, color=color, s=16, alpha=0.75, linewidth=0.4)
+                    self.highlighted_sample = self.draw_points(
+                        [(key, histogram, lambda: phasor_points(value['g'], value['s']), color)], alpha=0.75)
 
                 elif self.shared_info.phasor_settings["scatter_type"] == "contour":
-                    counts, xbins, ybins = np.histogram2d(x=g_scat, y=s_scat, bins=50)
-                    contour_set = self.ax.contour(counts.transpose(), extent=[xbins[0], xbins[-1], ybins[0], ybins[-1]], linewidths=1, colors=[color])
-                    self.highlighted_sample = contour_set.collections  # Store the list of contour sets
+                    self.highlighted_sample = self.draw_contour(histogram, color)
 
                 elif self.shared_info.phasor_settings["scatter_type"] == "histogram":
-                    counts, xbins, ybins = np.histogram2d(x=g_scat, y=s_scat, bins=int(histo_bins))
-                    hist2d = self.ax.contourf(counts.transpose(), extent=[xbins[0], xbins[-1], ybins[0], ybins[-1]], cmap='jet_r', norm=colors.LogNorm(), alpha=0.75)
-                    self.highlighted_sample = hist2d.collections  # Store the QuadMesh
+                    self.highlighted_sample = self.draw_filled_histogram(histogram, histogram_bins(histogram.pixels))
+                break
 
         self.ax.set_xlim([-0.005, 1])
         self.ax.set_ylim([0, 0.65])
@@ -488,7 +626,6 @@ class PhasorPlot(QWidget):
     def highlightPlotPoints_condition(self, label):
         self.deactivate_roi()
         self.btn_select.setStyleSheet('QPushButton {color: white;}')
-        self.btn_select.setEnabled(False)
 
         # Remove the previous highlighted condition plot if it exists
         if hasattr(self, 'highlighted_condition') and self.highlighted_condition:
@@ -502,33 +639,19 @@ class PhasorPlot(QWidget):
                     artist.remove()
             del self.highlighted_condition
 
-        condition_points = {condition: {'g': [], 's': []} for condition in self.plot_data_colors.keys()}
-        for key, value in self.plot_data.items():
-            g = value['g']
-            s = value['s']
-            condition = value['condition']
-            mask = (g != 0) & (s != 0)
-            condition_points[condition]['g'].extend(g[mask])
-            condition_points[condition]['s'].extend(s[mask])
-
-        if label in condition_points:
-            g_scat = np.array(condition_points[label]['g'])
-            s_scat = np.array(condition_points[label]['s'])
+        if label in self.condition_histograms:
+            histogram = self.condition_histograms[label]
             color = self.plot_data_colors[label]
-            histo_bins = int(math.sqrt(len(g_scat)) / 2)
 
             if self.shared_info.phasor_settings["scatter_type"] == "scatter":
-                self.highlighted_condition = self.ax.scatter(x=g_scat, y=s_scat, label=label, color=color, s=16, alpha=0.75, linewidth=0.4)
+                self.highlighted_condition = self.draw_points(
+                    [(label, histogram, lambda: self.condition_points(label), color)], alpha=0.75)
 
             elif self.shared_info.phasor_settings["scatter_type"] == "contour":
-                counts, xbins, ybins = np.histogram2d(x=g_scat, y=s_scat, bins=50)
-                contour_set = self.ax.contour(counts.transpose(), extent=[xbins[0], xbins[-1], ybins[0], ybins[-1]], linewidths=1, colors=[color])
-                self.highlighted_condition = contour_set.collections  # Store the list of contour sets
+                self.highlighted_condition = self.draw_contour(histogram, color)
 
             elif self.shared_info.phasor_settings["scatter_type"] == "histogram":
-                counts, xbins, ybins = np.histogram2d(x=g_scat, y=s_scat, bins=int(histo_bins))
-                hist2d = self.ax.contourf(counts.transpose(), extent=[xbins[0], xbins[-1], ybins[0], ybins[-1]], cmap='jet_r', norm=colors.LogNorm(), alpha=0.75)
-                self.highlighted_condition = hist2d.collections  # Store the QuadMesh
+                self.highlighted_condition = self.draw_filled_histogram(histogram, histogram_bins(histogram.points))
 
         self.ax.set_xlim([-0.005, 1])
         self.ax.set_ylim([0, 0.65])
@@ -545,7 +668,7 @@ class PhasorPlot(QWidget):
             handles = []
             labels = []
 
-            if scatter_type == "contour":
+            if scatter_type == "contour" or (scatter_type == "scatter" and self.density_drawn):
                 if plot_type == "individual":
                     for label, color in self.plot_data_colors:
                         patch = Patch(facecolor=color, edgecolor='dimgray', label=label)
@@ -582,6 +705,11 @@ class PhasorPlot(QWidget):
 
 
 
+def contour_artists(contour_set):
+    """Artists of a contour set to remove it (a contour set is an artist since Matplotlib 3.8)"""
+    return [contour_set] if isinstance(contour_set, Artist) else list(contour_set.collections)
+
+
 class LegendWidget(QListWidget):
     # Define a new signal that emits the selected label's text
     legendItemSelected = Signal(str)
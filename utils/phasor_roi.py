@@ -0,0 +1,174 @@
+"""Regions of interest drawn on the phasor plot, applied to the pixels of the analysed files"""
+from typing import NamedTuple
+
+import numpy as np
+from matplotlib.path import Path
+
+from utils.phasor_density import DENSITY_BINS, PHASOR_EXTENT, bin_index, valid_phasors
+
+# status of a density bin for an ROI: its pixels are all outside the ROI, all inside it, or must be tested one by one
+OUTSIDE, INSIDE, BORDER = 0, 1, 2
+
+
+class EllipseROI(NamedTuple):
+    """Axis-aligned ellipse centred on (x0, y0) with semi-axes a (along g) and b (along s)"""
+    x0: float
+    y0: float
+    a: float
+    b: float
+    binned = False  # the exact test is cheaper than binning the pixels of a file to skip it (see apply_rois)
+
+    def contains(self, g, s):
+        """Boolean array of the points inside the ellipse, ((g - x0) / a)**2 + ((s - y0) / b)**2 <= 1"""
+        if not self.a > 0 or not self.b > 0:
+            return np.zeros(np.shape(g), dtype=bool)
+        return ((g - self.x0) ** 2 / self.a ** 2) + ((s - self.y0) ** 2 / self.b ** 2) <= 1
+
+    def bin_status(self, bins=DENSITY_BINS, extent=PHASOR_EXTENT):
+        """Flat array of the status (OUTSIDE, INSIDE or BORDER) of every density bin"""
+        status = np.full(bins[0] * bins[1], OUTSIDE, dtype=np.int8)
+        if not self.a > 0 or not self.b > 0:
+            return status
+        columns, rows, width, height = _bin_window(self.x0 - self.a, self.x0 + self.a, self.y0 - self.b, self.y0 + self.b,
+                                                   bins, extent)
+        if columns.size and rows.size:
+            # bin edges relative to the centre, in units of the semi-axes (the ellipse becomes the unit circle)
+            left = (extent[0] + columns * width - self.x0) / self.a
+            right = left + width / self.a
+            bottom = (extent[2] + rows * height - self.y0) / self.b
+            top = bottom + height / self.b
+            # nearest and farthest point of every bin from the centre
+            near = (np.clip(0, left, right)[np.newaxis] ** 2 + np.clip(0, bottom, top)[:, np.newaxis] ** 2)
+            far = (np.maximum(left ** 2, right ** 2)[np.newaxis] + np.maximum(bottom ** 2, top ** 2)[:, np.newaxis])
+            # bins inside the ellipse with a margin for rounding, the others it reaches are on its border
+            status[rows[:, np.newaxis] * bins[0] + columns] = np.where(far < 1 - 1e-6, INSIDE,
+                                                                       np.where(near <= 1, BORDER, OUTSIDE))
+        return status
+
+
+class PolygonROI(NamedTuple):
+    """Polygon with the given (g, s) vertices"""
+    vertices: tuple
+    binned = True
+
+    def contains(self, g, s):
+        """Boolean array of the points inside the polygon"""
+        g, s = np.asarray(g), np.asarray(s)
+        points = np.column_stack((g.reshape(-1), s.reshape(-1)))
+        return Path(self.vertices).contains_points(points).reshape(g.shape)
+
+    def bin_status(self, bins=DENSITY_BINS, extent=PHASOR_EXTENT):
+        """Flat array of the status (OUTSIDE, INSIDE or BORDER) of every density bin"""
+        status = np.full(bins[0] * bins[1], OUTSIDE, dtype=np.int8)
+        vertices = np.asarray(self.vertices, dtype=np.float64)
+        if len(vertices) < 3:
+            return status
+        columns, rows, width, height = _bin_window(vertices[:, 0].min(), vertices[:, 0].max(),
+                                                   vertices[:, 1].min(), vertices[:, 1].max(), bins, extent)
+        if not columns.size or not rows.size:
+            return status
+
+        # bin corners of the window inside the polygon
+        x = extent[0] + np.append(columns, columns[-1] + 1) * width
+        y = extent[2] + np.append(rows, rows[-1] + 1) * height
+        corners = Path(vertices).contains_points(np.column_stack((np.tile(x, y.size), np.repeat(y, x.size))))
+        corners = corners.reshape(y.size, x.size)
+        all_corners = corners[:-1, :-1] & corners[:-1, 1:] & corners[1:, :-1] & corners[1:, 1:]
+        any_corner = corners[:-1, :-1] | corners[:-1, 1:] | corners[1:, :-1] | corners[1:, 1:]
+
+        # bins crossed by an edge: bins of points along the edges half a bin apart, and their neighbours
+        closed = np.vstack((vertices, vertices[:1]))
+        steps = np.ceil(np.hypot(*np.diff(closed, axis=0).T) / (min(width, height) / 2)).astype(np.intp) + 1
+        t = np.concatenate([np.linspace(0, 1, n) for n in steps])
+        start = np.repeat(closed[:-1], steps, axis=0)
+        points = start + (np.repeat(closed[1:], steps, axis=0) - start) * t[:, np.newaxis]
+        px = np.floor((points[:, 0] - extent[0]) / width).astype(np.intp) - columns[0]
+        py = np.floor((points[:, 1] - extent[2]) / height).astype(np.intp) - rows[0]
+        keep = (px >= 0) & (px < columns.size) & (py >= 0) & (py < rows.size)
+        crossed = np.zeros((rows.size + 2, columns.size + 2), dtype=bool)
+        crossed[py[keep] + 1, px[keep] + 1] = True
+        edge = np.zeros((rows.size, columns.size), dtype=bool)
+        for dy in range(3):
+            for dx in range(3):
+                edge |= crossed[dy:dy + rows.size, dx:dx + columns.size]
+
+        inside = all_corners & ~edge
+        status[rows[:, np.newaxis] * bins[0] + columns] = np.where(inside, INSIDE,
+                                                                   np.where(any_corner | edge, BORDER, OUTSIDE))
+        return status
+
+
+def _bin_window(xmin, xmax, ymin, ymax, bins, extent):
+    """Columns and rows of the density bins overlapping a g, s bounding box, and the width and height of the bins"""
+    nx, ny = bins
+    width, height = (extent[1] - extent[0]) / nx, (extent[3] - extent[2]) / ny
+    columns = np.arange(max(int((xmin - extent[0]) // width), 0), min(int((xmax - extent[0]) // width) + 1, nx))
+    rows = np.arange(max(int((ymin - extent[2]) // height), 0), min(int((ymax - extent[2]) // height) + 1, ny))
+    return columns, rows, width, height
+
+
+class PhasorIndex:
+    """Pixels of a file grouped by the density bin of their phasor coordinates, so an ROI only tests the pixels of the
+    bins on its border: pixels of bins inside the ROI are selected as a whole and bins outside it are skipped"""
+
+    def __init__(self, g, s, bins=DENSITY_BINS, extent=PHASOR_EXTENT):
+        self.g, self.s = np.asarray(g).reshape(-1), np.asarray(s).reshape(-1)
+        self.bins, self.extent = bins, extent
+        index = bin_index(self.g, self.s, bins, extent)
+        order = np.argsort(index, kind='stable')
+        n_outside = int(np.count_nonzero(index < 0))
+        self.outside = order[:n_outside]  # pixels outside the grid, always tested
+        self.order = order[n_outside:]  # pixels sorted by bin
+        self.starts = np.concatenate(([0], np.cumsum(np.bincount(index[index >= 0], minlength=bins[0] * bins[1]))))
+
+    def select(self, roi):
+        """Boolean array of the pixels inside the ROI (EllipseROI or PolygonROI)"""
+        status = roi.bin_status(self.bins, self.extent)
+        inside = np.zeros(self.g.size, dtype=bool)
+        inside[self._pixels(np.flatnonzero(status == INSIDE))] = True
+        candidates = np.concatenate((self._pixels(np.flatnonzero(status == BORDER)), self.outside))
+        inside[candidates[roi.contains(self.g[candidates], self.s[candidates])]] = True
+        return inside
+
+    def _pixels(self, bins):
+        """Pixels of the given bins"""
+        starts, stops = self.starts[bins], self.starts[bins + 1]
+        counts = stops - starts
+        total = int(counts.sum())
+        if total == 0:
+            return np.empty(0, dtype=np.intp)
+        # ranges starts[i]:stops[i] joined without a Python loop
+        offsets = np.repeat(starts - np.concatenate(([0], np.cumsum(counts)[:-1])), counts)
+        return self.order[offsets + np.arange(total)]
+
+
+def apply_rois(results_dict, rois, bins=DENSITY_BINS, extent=PHASOR_EXTENT):
+    """Masks of the pixels of every file inside each ROI, {file name: (ROIs, pixels) boolean array}. Pixels without
+    phasor coordinates (background) are in none. The bins of binned ROIs (polygons) are classified once for all files,
+    then the pixels of a file are binned once for all of them and only those in the border bins of an ROI are tested
+    against it. Other ROIs (ellipses) are tested on every pixel"""
+    # status of the pixels outside the grid (bin index -1, the last entry) is BORDER: they are always tested
+    statuses = [np.append(roi.bin_status(bins, extent), np.int8(BORDER)) if roi.binned else None for roi in rois]
+    return {name: _file_masks(result['g'], result['s'], rois, statuses, bins, extent)
+            for name, result in results_dict.items()}
+
+
+def _file_masks(g, s, rois, statuses, bins, extent):
+    """(ROIs, pixels) boolean array of the pixels of one file inside each ROI"""
+    g, s = np.asarray(g).reshape(-1), np.asarray(s).reshape(-1)
+    index = None
+    background = ~valid_phasors(g, s)
+    masks = np.zeros((len(rois), g.size), dtype=bool)
+    for mask, roi, status in zip(masks, rois, statuses):
+        if status is None:
+            mask[:] = roi.contains(g, s)
+            mask[background] = False
+            continue
+        if index is None:
+            index = bin_index(g, s, bins, extent)
+        pixel_status = status[index]
+        mask[pixel_status == INSIDE] = True
+        candidates = np.flatnonzero(pixel_status == BORDER)
+        mask[candidates[roi.contains(g[candidates], s[candidates])]] = True
+        mask[background] = False
+    return masks
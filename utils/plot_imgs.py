@@ -14,6 +14,9 @@ import warnings
 warnings.filterwarnings("ignore", category=FutureWarning, message=".*palette.*without assigning.*hue.*is deprecated.*")
 warnings.filterwarnings("ignore", message=".*The figure layout has changed to tight.*")
 
+# galleries of more files draw the thumbnails of opened sessions, larger images show the full maps
+GALLERY_FULL_MAPS = 3
+
 class PlotImages():
 
     def __init__(self, main_window):
@@ -37,55 +40,66 @@ class PlotImages():
         self.canvas_violin = self.main_window.canvas_violin
         self.fileTable = self.main_window.fileTable
         self.dpi = main_window.fixed_dpi 
+        # masked image of a phasor ROI over the lifetime map (as plot_tau_map's masked_image), blitted over a copy of the drawn map
+        self.roi_overlay = None
+        self.roi_background = None
+        self.canvas_tau.mpl_connect('draw_event', self.capture_tau_background)
         
         
 
-    def visualise_image(self, intensity_image, filename):
-        '''Visualise images once loaded'''
+    def visualise_image(self, intensity_image, filename, draw=True):
+        '''Visualise images once loaded (draw=False only adds the file to the table, e.g. while more files are loading)'''
         try:
-            self.figure.clear()
             min_photon_counts = int(self.shared_info.config.get("min_photons", 0))
             max_photon_counts = int(self.shared_info.config.get("max_photons", 0))
             masked_image_min = np.where(intensity_image < min_photon_counts, 0, intensity_image)
             masked_image = np.where(intensity_image > max_photon_counts, 0, masked_image_min)
             self.shared_info.intensity_img_dict[filename] = {'intensity_image': intensity_image, 'mask': masked_image}
-            self.plot_img()
+            self.add_table_row(filename)
+
+            if draw:
+                self.draw_selected_image()
 
-            # Add filename to the table
-            rowPosition = self.fileTable.rowCount()
+        except Exception as e:
+            print(f"Error loading image: {e}")
 
-            if self.fileTable.rowCount() == 0:
-                self.fileTable.setColumnCount(2)  # Adjust to have two columns
-                self.fileTable.setHorizontalHeaderLabels(["File name", "Condition"])
+    def add_table_row(self, filename, checked=True):
+        '''Add a file to the file table (files of opened sessions are added without visualise_image)'''
+        rowPosition = self.fileTable.rowCount()
 
-            # Add checkbox
-            chkBoxItem = QTableWidgetItem(filename)
-            chkBoxItem.setBackground(QColor(40, 40, 40))
-            chkBoxItem.setFlags(Qt.ItemIsUserCheckable | Qt.ItemIsEnabled)
-            chkBoxItem.setCheckState(Qt.Checked)
+        if self.fileTable.rowCount() == 0:
+            self.fileTable.setColumnCount(2)  # Adjust to have two columns
+            self.fileTable.setHorizontalHeaderLabels(["File name", "Condition"])
 
-            # Create condition item (editable)
-            conditionItem = QTableWidgetItem(self.shared_info.raw_data_dict[filename]["condition"])
-            conditionItem.setFlags(Qt.ItemIsSelectable | Qt.ItemIsEnabled | Qt.ItemIsEditable)
+        # Add checkbox
+        chkBoxItem = QTableWidgetItem(filename)
+        chkBoxItem.setBackground(QColor(40, 40, 40))
+        chkBoxItem.setFlags(Qt.ItemIsUserCheckable | Qt.ItemIsEnabled)
+        chkBoxItem.setCheckState(Qt.Checked if checked else Qt.Unchecked)
 
-            # Insert row and set items
-            self.fileTable.insertRow(rowPosition)
-            self.fileTable.setItem(rowPosition, 0, chkBoxItem)
-            self.fileTable.setItem(rowPosition, 1, conditionItem)
+        # Create condition item (editable)
+        conditionItem = QTableWidgetItem(self.shared_info.raw_data_dict[filename]["condition"])
+        conditionItem.setFlags(Qt.ItemIsSelectable | Qt.ItemIsEnabled | Qt.ItemIsEditable)
 
-            # Connect the itemChanged signal
-            self.fileTable.itemChanged.connect(self.update_condition)
+        # Insert row and set items
+        self.fileTable.insertRow(rowPosition)
+        self.fileTable.setItem(rowPosition, 0, chkBoxItem)
+        self.fileTable.setItem(rowPosition, 1, conditionItem)
 
-            # Ensure the canvas is properly updated
-            self.canvas.draw()
-            self.canvas.updateGeometry()
+        # Connect the itemChanged signal
+        self.fileTable.itemChanged.connect(self.update_condition)
 
-            # Update the parent widget layout to ensure proper placement
-            self.canvas.parent().updateGeometry()
-            self.canvas.parent().adjustSize()
+    def draw_selected_image(self):
+        '''Plot the image of the selected file and update the canvas'''
+        self.plot_img()
 
-        except Exception as e:
-            print(f"Error loading image: {e}")
+        # Ensure the canvas is properly updated
+        self.canvas.draw()
+        self.canvas.updateGeometry()
+
+        # Update the parent widget layout to ensure proper placement
+        self.canvas.parent().updateGeometry()
+        self.canvas.parent().adjustSize()
     
     # Define the update_condition method
     def update_condition(self, item):
@@ -179,6 +193,7 @@ class PlotImages():
 
     def plot_tau_map(self, masked_image= None):
         '''Function for plotting lifetime maps'''
+        self.roi_overlay = self.roi_background = None
         self.figure_tau.clear()
         tau = self.shared_info.results_dict.get(self.shared_info.config["selected_file"])[self.shared_info.config["lifetime_map"]]
         x_dim, y_dim = self.shared_info.results_dict.get(self.shared_info.config["selected_file"])['img_shape'][1:] # get x and y dim
@@ -197,7 +212,7 @@ class PlotImages():
         
         # optional: integrate lifetime image with intensity image
         if self.shared_info.config["lifetime_itegrate"] == "True":
-            intenisty = self.shared_info.results_dict.get(self.shared_info.config["selected_file"])["sample_data"].sum(0)
+            intenisty = self.shared_info.results_dict.get(self.shared_info.config["selected_file"])["intensity"]
             ax.imshow(intenisty, cmap='gray', vmin=0, vmax=int(intenisty[intenisty!=0].max()-intenisty[intenisty!=0].mean()),  alpha = 0.6)
         else:
             pass
@@ -211,16 +226,21 @@ class PlotImages():
         cbar =self.figure_tau.colorbar(img_plot, cax=cax, orientation='vertical',)
         cbar.ax.tick_params(colors='white', labelsize=8)
 
-        if masked_image is not None: # Define a custom colormap for the masked image
-            colors = [(0, 0, 0, 1),  
-                    (0, 0, 0, 0)] 
-            cmap = LinearSegmentedColormap.from_list("custom_black", colors, N=2)
+        # Define a custom colormap for the masked image
+        colors = [(0, 0, 0, 1),  
+                (0, 0, 0, 0)] 
+        cmap = LinearSegmentedColormap.from_list("custom_black", colors, N=2)
 
+        if masked_image is not None:
             masked_image_prepared = np.reshape(masked_image, (x_dim, y_dim))
             
             # Display the masked_image with the custom colormap
             ax.imshow(masked_image_prepared, cmap=cmap, alpha=0.8)
 
+        # masked image of a phasor ROI, shown the same way (drawn by blitting only)
+        self.roi_tau = np.nan_to_num(tau_img)
+        self.roi_overlay = ax.imshow(np.zeros((x_dim, y_dim)), cmap=cmap, alpha=0.8, animated=True, visible=False)
+
 
         self.canvas_tau.draw()
         self.canvas_tau.figure.tight_layout()
@@ -228,6 +248,45 @@ class PlotImages():
     
     
 
+    def capture_tau_background(self, event):
+        '''Keep a copy of the drawn lifetime map (without the ROI layer) to blit the ROI layer over, and draw the layer'''
+        if self.roi_overlay is None:
+            return
+        ax = self.roi_overlay.axes
+        self.roi_background = (self.canvas_tau.copy_from_bbox(ax.bbox), ax.bbox.bounds)
+        if self.roi_overlay.get_visible():
+            ax.draw_artist(self.roi_overlay)
+
+    def show_roi(self, inside):
+        '''Highlight the pixels of the lifetime map inside a phasor ROI (boolean array of the pixels inside it) with the
+        masked image of plot_tau_map. Only the ROI layer is drawn, over the copy of the map, instead of drawing the whole
+        figure again'''
+        if self.roi_overlay is None:
+            return
+        masked_image = np.where(np.reshape(inside, self.roi_tau.shape), self.roi_tau, 0)
+        self.roi_overlay.set_data(masked_image)
+        self.roi_overlay.set_clim(masked_image.min(), masked_image.max())  # scaled to the masked image as imshow does
+        self.roi_overlay.set_visible(True)
+
+        ax = self.roi_overlay.axes
+        if self.roi_background is None or self.roi_background[1] != ax.bbox.bounds:
+            self.canvas_tau.draw()  # not drawn yet or the layout changed, the draw event copies the map again
+        else:
+            self.canvas_tau.restore_region(self.roi_background[0])
+            ax.draw_artist(self.roi_overlay)
+            self.canvas_tau.blit(ax.bbox)
+
+    def gallery_map(self, data_dict, key, name, thumbnails=True):
+        '''Intensity image or lifetime map (ns) of a file for the galleries. Files of an opened session that were not
+        analysed again are drawn from their thumbnails, their full maps are only read when the file is selected'''
+        thumbnail = self.shared_info.thumbnails.get(key, {}).get(name) if thumbnails else None
+        if thumbnail is not None:
+            return thumbnail.astype(np.float32)
+        if name == "intensity":
+            return data_dict[key][name]
+        x_dim, y_dim = data_dict[key]['img_shape'][1:] # get x and y dim
+        return np.reshape(data_dict[key][name] * 1e9, (x_dim, y_dim))
+
     def gallery_imgs(self, data_dict):
         self.main_window.gallery_layout_grid.setRowStretch(1, 1)
         self.main_window.gallery_layout_grid.setColumnStretch(1, 1)
@@ -266,10 +325,7 @@ class PlotImages():
             row = i // cols
             col = i % cols
             ax_gal = self.figure_gallery.add_subplot(gs[row, col])
-            tau = data_dict[key][self.shared_info.config["lifetime_map"]]
-            x_dim, y_dim = data_dict[key]['img_shape'][1:] # get x and y dim
-
-            tau_img = np.reshape(tau * 1e9, (x_dim, y_dim))
+            tau_img = self.gallery_map(data_dict, key, self.shared_info.config["lifetime_map"], thumbnails=n > GALLERY_FULL_MAPS)
             tau_img[tau_img == 0] = np.nan  # Handle NaNs
 
             im = ax_gal.imshow(tau_img, cmap='gist_rainbow_r',
@@ -278,7 +334,7 @@ class PlotImages():
 
             # optional: integrate lifetime image with intensity image
             if self.shared_info.config["lifetime_itegrate"] == "True":
-                intenisty = data_dict[key]["sample_data"].sum(0)
+                intenisty = self.gallery_map(data_dict, key, "intensity", thumbnails=n > GALLERY_FULL_MAPS)
                 ax_gal.imshow(intenisty, cmap='gray', vmin=0,
                             vmax=int(intenisty[intenisty != 0].max() - intenisty[intenisty != 0].mean()),
                             alpha=0.5)
@@ -350,7 +406,7 @@ class PlotImages():
             ax_int = self.figure_gallery_I.add_subplot(gs[row, col])
             
             # Access the correct intensity data
-            intensity = data_dict[key]["sample_data"].sum(0)  # Adjust as necessary
+            intensity = self.gallery_map(data_dict, key, "intensity", thumbnails=n > GALLERY_FULL_MAPS)
 
             im = ax_int.imshow(intensity, cmap='gray', aspect='equal',
                             vmin=self.shared_info.config["vmin_int"], vmax=self.shared_info.config["vmax_int"])
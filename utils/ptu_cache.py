@@ -0,0 +1,83 @@
+"""On-disk cache of decoded .ptu image histograms, so files opened again are memory mapped instead of decoding their
+photon records"""
+import os
+import json
+import hashlib
+import threading
+
+import numpy as np
+
+from utils.flim_dataset import FlimDataset
+from utils.phasor_cache import evict_lru
+from utils.file_readers import ptu_header
+
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".flimpa", "ptu_cache")
+# increase when the decoding changes, so histograms of older versions are not reused
+CACHE_VERSION = 1
+_headers_lock = threading.Lock()
+
+
+class PtuCache:
+    """(T, X, Y) histograms of .ptu files as .npy files in a cache directory, keyed by the file (path, size and
+    modification time), channel and time binning. The least recently used histograms are removed once the directory
+    grows larger than max_bytes.
+
+    The header values that ptufile calculates by scanning the records (image shape, delay-time bins) are remembered
+    as well, so files opened again are not read beyond their header.
+    """
+
+    def __init__(self, cache_dir=CACHE_DIR, max_bytes=8 * 2**30):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+        self._headers_path = os.path.join(cache_dir, "headers.json")
+        try:
+            with open(self._headers_path) as f:
+                self._headers = json.load(f)
+        except (OSError, ValueError):
+            self._headers = {}
+
+    def _file_id(self, file_name):
+        stat = os.stat(file_name)
+        return f"{CACHE_VERSION}|{os.path.abspath(file_name)}|{stat.st_size}|{stat.st_mtime_ns}"
+
+    def _path(self, file_name, channel, time_binning):
+        file_id = f"{self._file_id(file_name)}|{int(channel)}|{int(time_binning)}"
+        return os.path.join(self.cache_dir, hashlib.blake2b(file_id.encode(), digest_size=20).hexdigest() + ".npy")
+
+    def header(self, ptu):
+        """Shape and delay-time bins of an open PtuFile (see ptu_header)"""
+        file_id = self._file_id(ptu.filepath)
+        header = self._headers.get(file_id)
+        if header is None:
+            # read outside the lock (it may scan the records), the loader threads add headers at the same time
+            header = ptu_header(ptu)
+            with _headers_lock:
+                self._headers[file_id] = header
+                tmp_path = self._headers_path + f".{os.getpid()}.tmp"
+                with open(tmp_path, 'w') as f:
+                    json.dump(self._headers, f)
+                os.replace(tmp_path, self._headers_path)
+        return header
+
+    def get(self, file_name, channel, time_binning):
+        """Memory-mapped dataset of the cached histogram, or None"""
+        path = self._path(file_name, channel, time_binning)
+        try:
+            histogram = np.load(path, mmap_mode='r')
+        except (OSError, ValueError):
+            return None
+        os.utime(path)  # mark as recently used
+        return FlimDataset.from_file(path, histogram.offset, histogram.dtype, histogram.shape, time_axis=0)
+
+    def put(self, file_name, channel, time_binning, histogram):
+        """Store a (T, X, Y) histogram and return it as a memory-mapped dataset of the cache file"""
+        path = self._path(file_name, channel, time_binning)
+        tmp_path = path[:-len(".npy")] + f".{os.getpid()}.{threading.get_ident()}.tmp.npy"
+        out = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=histogram.dtype, shape=histogram.shape)
+        out[...] = histogram
+        out.flush()
+        del out
+        os.replace(tmp_path, path)
+        evict_lru(self.cache_dir, self.max_bytes, ".npy", keep=(path,))
+        return self.get(file_name, channel, time_binning)
@@ -2,7 +2,7 @@ from PySide6.QtCore import QThread, Signal
 
 class AnalysisThread(QThread):
     progressUpdated = Signal(int, str)
-    analysisFinished = Signal(dict)
+    analysisFinished = Signal(object)  # the results table, not copied into a dict
     
     def __init__(self, lifetime_data, parent=None):
         super().__init__(parent)
@@ -0,0 +1,173 @@
+"""Lifetime statistics of the analysed files, per manual mask region"""
+import numpy as np
+import pandas as pd
+
+from utils.phasor_density import valid_phasors
+
+LIFETIME_MAPS = ('M', 'phi', 'average')
+# statistics of each region kept in the table besides the mean, for every lifetime map
+PERCENTILES = (25, 75)
+DETAIL_STATS = ('median', 'std') + tuple(f'p{q}' for q in PERCENTILES)
+# phasor statistics of each region: photon-weighted centroid, dispersion around it and photon count
+PHASOR_STATS = ('g_centroid', 's_centroid', 'phasor_dispersion', 'photons')
+
+
+def lifetime_stats(results_dict, detail=False):
+    """Lifetime (ns) statistics per file and mask region as a DataFrame, with the detailed and phasor statistics columns
+    if detail is set"""
+    lifetime_means_dict = []
+    for sample_name, sample_data in results_dict.items():
+        # rows kept from the statistics stage of the analysis, if they are up to date
+        rows = sample_data.get('stats')
+        lifetime_means_dict.extend(rows if rows is not None else file_stats(sample_name, sample_data, detail))
+
+    # Convert the list of dictionaries directly into a DataFrame
+    return pd.DataFrame(lifetime_means_dict)
+
+
+def file_stats(sample_name, sample_data, detail=False):
+    """Rows of the lifetime statistics table for one file, one row per mask region. With detail set, the rows also hold
+    the pixel count, DETAIL_STATS of every lifetime map and PHASOR_STATS of the region"""
+    maps = {name: sample_data[name] for name in LIFETIME_MAPS}
+    labels, n_regions = region_labels(sample_data['mask'], maps['M'].size)
+    region_stats = region_statistics(labels, n_regions, maps, percentiles=PERCENTILES if detail else None)
+    if detail:
+        phasor_stats = region_phasor_statistics(labels, n_regions, sample_data['g'], sample_data['s'],
+                                                sample_data['intensity'])
+    file_means = {name: round(np.asarray(tau_map[tau_map > 0] * 1e9).mean(dtype=np.float64), 3)
+                  for name, tau_map in maps.items()}
+
+    rows = []
+    condition = sample_data['condition']
+    for region_index in range(n_regions):
+        row = {
+            'sample': sample_name,
+            'condition': condition,
+            'region': region_index + 1,  # Adjust based on your region numbering
+        }
+        for name in LIFETIME_MAPS:
+            row[name] = _ns(region_stats[name]['mean'][region_index])
+            row[f'{name}_mean'] = file_means[name]
+        if detail:
+            row['pixels'] = int(region_stats['average']['count'][region_index])
+            for name in LIFETIME_MAPS:
+                for stat in DETAIL_STATS:
+                    row[f'{name}_{stat}'] = _ns(region_stats[name][stat][region_index])
+            for stat in PHASOR_STATS:
+                row[stat] = round(float(phasor_stats[stat][region_index]), 5)
+        rows.append(row)
+    return rows
+
+
+def _ns(value):
+    """Lifetime (s) in ns rounded to 3 decimal places"""
+    return round(float(value) * 1e9, 3)
+
+
+def region_labels(mask, size):
+    """Flattened region label (1 to n, 0 for the background) of each pixel and the number of regions n.
+    Mask values are numbered in increasing order, without a mask all pixels are one region"""
+    if mask is None:
+        return np.ones(size, dtype=np.intp), 1
+    mask = np.asarray(mask).reshape(-1)
+    values = mask.astype(np.intp)
+    if values.size and values.min() >= 0 and values.max() <= values.size and np.array_equal(values, mask):
+        # integer labels (the usual segmentation masks) are numbered with a lookup table instead of a sort
+        region = np.bincount(values) > 0
+        region[0] = False
+    else:
+        region, values = np.unique(mask, return_inverse=True)
+        region = region != 0
+    lookup = np.cumsum(region) * region
+    return lookup[values.reshape(-1)], int(region.sum())
+
+
+def region_statistics(labels, n_regions, maps, percentiles=PERCENTILES):
+    """Count, mean, std, median and percentiles of the positive values of each map in every region, from the
+    flattened region labels (see region_labels). Regions are reduced together: sums with np.bincount and order
+    statistics from one sort of the values by (region, value). percentiles None leaves out the order statistics.
+    Returns {map name: {statistic: array of n_regions}}, statistics of regions without positive values are nan"""
+    statistics = {}
+    for name, tau_map in maps.items():
+        tau_map = np.asarray(tau_map).reshape(-1)
+        valid = (labels != 0) & (tau_map > 0)
+        region, values = labels[valid] - 1, tau_map[valid].astype(np.float64)
+
+        count = np.bincount(region, minlength=n_regions)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = np.bincount(region, weights=values, minlength=n_regions) / count
+            deviation = values - mean[region]
+            std = np.sqrt(np.bincount(region, weights=deviation * deviation, minlength=n_regions) / count)
+
+        stats = {'count': count, 'mean': mean, 'std': std}
+        statistics[name] = stats
+        if percentiles is None:
+            continue
+
+        # values sorted within each region, regions one after the other (stable sort of the value order by region)
+        order = np.argsort(values)
+        ordered = values[order[np.argsort(region[order], kind='stable')]]
+        starts = np.concatenate(([0], np.cumsum(count)[:-1]))
+        for key, q in [('median', 50)] + [(f'p{q}', q) for q in percentiles]:
+            stats[key] = _segment_percentile(ordered, starts, count, q)
+    return statistics
+
+
+def region_phasor_statistics(labels, n_regions, g, s, intensity):
+    """Photon-weighted phasor centroid (g, s), dispersion (photon-weighted rms distance from the centroid) and photon
+    count of every region, over the pixels with photons and phasor coordinates. Reduced with np.bincount as
+    region_statistics. Returns {statistic: array of n_regions}, the centroid and dispersion of regions without photons
+    are nan"""
+    g, s = np.asarray(g).reshape(-1), np.asarray(s).reshape(-1)
+    photons = np.asarray(intensity).reshape(-1)
+    valid = (labels != 0) & (photons > 0) & valid_phasors(g, s)
+    region, weights = labels[valid] - 1, photons[valid].astype(np.float64)
+    g, s = g[valid], s[valid]
+
+    total = np.bincount(region, weights=weights, minlength=n_regions)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        g_centroid = np.bincount(region, weights=weights * g, minlength=n_regions) / total
+        s_centroid = np.bincount(region, weights=weights * s, minlength=n_regions) / total
+        distance = (g - g_centroid[region]) ** 2 + (s - s_centroid[region]) ** 2
+        dispersion = np.sqrt(np.bincount(region, weights=weights * distance, minlength=n_regions) / total)
+    return {'g_centroid': g_centroid, 's_centroid': s_centroid, 'phasor_dispersion': dispersion, 'photons': total}
+
+
+def roi_fractions(df_stats, results_dict, masks):
+    """Statistics table with a column roi_k per phasor ROI: fraction of the pixels with phasor coordinates of every file
+    and region inside ROI k, from the masks of phasor_roi.apply_rois (counted with np.bincount as region_statistics).
+    Columns of previous ROIs are replaced, rows of files without masks are left empty"""
+    if not isinstance(df_stats, pd.DataFrame) or df_stats.empty:
+        return df_stats
+    rows = []
+    for sample_name, file_masks in masks.items():
+        sample_data = results_dict[sample_name]
+        labels, n_regions = region_labels(sample_data['mask'], file_masks.shape[1])
+        g, s = np.asarray(sample_data['g']).reshape(-1), np.asarray(sample_data['s']).reshape(-1)
+        valid = (labels != 0) & valid_phasors(g, s)
+        region = labels[valid] - 1
+        pixels = np.bincount(region, minlength=n_regions)
+        row = {'sample': sample_name, 'region': np.arange(1, n_regions + 1)}
+        for roi_index, mask in enumerate(file_masks):
+            with np.errstate(invalid='ignore', divide='ignore'):
+                fraction = np.bincount(region, weights=mask[valid], minlength=n_regions) / pixels
+            row[f'roi_{roi_index + 1}'] = np.round(fraction, 5)
+        rows.append(pd.DataFrame(row))
+
+    table = df_stats.drop(columns=[column for column in df_stats.columns if column.startswith('roi_')])
+    if not rows:
+        return table
+    return table.merge(pd.concat(rows, ignore_index=True), on=['sample', 'region'], how='left')
+
+
+def _segment_percentile(ordered, starts, count, q):
+    """Percentile q of each segment of sorted values (linear interpolation, as np.percentile), nan if empty"""
+    result = np.full(count.shape, np.nan)
+    filled = count > 0
+    position = (count[filled] - 1) * (q / 100)
+    lower = np.floor(position).astype(np.intp)
+    upper = np.minimum(lower + 1, count[filled] - 1)
+    low = ordered[starts[filled] + lower]
+    high = ordered[starts[filled] + upper]
+    result[filled] = low + (high - low) * (position - lower)
+    return result
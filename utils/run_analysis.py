@@ -20,9 +20,9 @@ class Analysis:
             msg_box = QMessageBox(self.main_window)  # Use main_window as the parent
             msg_box.setIcon(QMessageBox.Question)
             msg_box.setWindowTitle("Recalculate Analysis")
-            msg_box.setText("Would you like to keep the current analysis or recalculate everything?")
+            msg_box.setText("Would you like to update the analysis where files or settings changed, or recalculate everything?")
             msg_box.setEscapeButton(QMessageBox.Ok)
-            keep_button = msg_box.addButton("Keep Current", QMessageBox.YesRole)
+            keep_button = msg_box.addButton("Update Changes", QMessageBox.YesRole)
             recalculate_button = msg_box.addButton("Recalculate Everything", QMessageBox.NoRole)
 
             # Show the message box and get the user's response
@@ -30,7 +30,10 @@ class Analysis:
 
             if msg_box.clickedButton() == recalculate_button:
                 # If the user chooses to recalculate, clear self.results_dict
-                self.shared_info.results_dict = {}
+                # otherwise only the analysis stages affected by changed settings are recalculated
+                self.shared_info.results_dict.clear()
+                self.shared_info.thumbnails.clear()
+                self.shared_info.phasor_histograms.clear()
                 self.shared_info.df_stats = {}
 
         # Check if reference file and raw data are provided
@@ -87,7 +90,9 @@ class Analysis:
 
     def on_analysis_finished(self, results_dict):
         self.progress_dialog.close()  # Close the progress dialog when done
-        self.shared_info.results_dict = results_dict
+        # the results are updated in place (None if the analysis failed)
+        if results_dict is not None:
+            self.shared_info.results_dict = results_dict
         try:
             self.main_window.analysis_finished()  # Call the main window's analysis_finished method
         except:
@@ -29,7 +29,7 @@ def save_tau(output_dir, progress_dialog,  lifetime_type, results_dict, config):
         for filename in results_dict.keys():
             print("filename:", filename)
             # Ensure the data arrays have the same x and y dimensions as the sample data
-            x_dim, y_dim = results_dict[filename]['sample_data'].shape[1], results_dict[filename]['sample_data'].shape[2]
+            x_dim, y_dim = results_dict[filename]['intensity'].shape
             
             # Reshape the lifetime data to match the dimensions of the sample data
             lifetime_data = results_dict[filename][lifetime_type].reshape((x_dim, y_dim)) * 10**9
@@ -56,7 +56,7 @@ def save_tau(output_dir, progress_dialog,  lifetime_type, results_dict, config):
                 
                 # Optional: integrate lifetime image with intensity image
                 if config["lifetime_itegrate"] == "True":
-                    intensity = results_dict[filename]["sample_data"].sum(0)
+                    intensity = results_dict[filename]["intensity"]
                     ax.imshow(intensity, cmap='gray', vmin=0, vmax=int(intensity[intensity != 0].max() - intensity[intensity != 0].mean()), alpha=0.5)
                 
                 ax.patch.set_facecolor((0, 0, 0, 1.0))
@@ -143,7 +143,7 @@ def save_gallery_view(output_dir, progress_dialog, file_name, data_dict, config)
             im = ax_gal.imshow(tau_img, cmap='gist_rainbow_r', aspect='equal',
                             vmin=float(config["lifetime_vmin"]),
                             vmax=float(config["lifetime_vmax"]))
-            intensity = data_dict[key]["sample_data"].sum(0)
+            intensity = data_dict[key]["intensity"]
             # optional: integrate lifetime image with intensity image
             if config.get("lifetime_itegrate") == "True":
                 ax_gal.imshow(intensity, cmap='gray', vmin=0,
@@ -281,7 +281,7 @@ def save_gallery_int_view(output_dir, progress_dialog, file_name, data_dict, con
             col = i % cols
             ax_gal = fig.add_subplot(gs[row, col])
         # Access the correct intensity data
-            intensity = data_dict[key]["sample_data"].sum(0)  # Adjust as necessary
+            intensity = data_dict[key]["intensity"]  # Adjust as necessary
 
             im = ax_gal.imshow(intensity, cmap='gray', aspect='equal',
                             vmin=config["vmin_int"], vmax=config["vmax_int"])
@@ -0,0 +1,550 @@
+"""Session state kept on disk: the results, intensity images and in-memory raw data of the imported files are stored
+in one HDF5 file, with only the most recently used entries held in memory. Sessions are saved to (and opened from)
+files of the same format"""
+import io
+import os
+import json
+import uuid
+import atexit
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+from collections.abc import MutableMapping
+
+import h5py
+import numpy as np
+import pandas as pd
+
+from utils.flim_dataset import FlimDataset
+from utils.file_result import derived_map, has_derived_map
+from utils.errors import FileLoadingError
+
+SESSION_DIR = os.path.join(os.path.expanduser("~"), ".flimpa", "sessions")
+# entries of each table held in memory (e.g. the selected file and the files drawn with it)
+CACHE_ENTRIES = 4
+# compression of the integer images of the results, raw data cubes are written uncompressed as that is several times
+# faster (they are written while files are imported)
+_COMPRESSION = dict(compression="gzip", compression_opts=1, shuffle=True)
+# dataset of the file names of a table, in insertion order
+_NAMES = "__names__"
+# maximum size (pixels per side) of the gallery thumbnails of saved sessions
+THUMBNAIL_SIZE = 128
+SESSION_VERSION = 1
+# config values of the computer running FLIMPA rather than of the analysis, they are not restored from session files
+_LOCAL_CONFIG = ("workers", "memory_budget", "phasor_cache", "cache_size", "ptu_cache", "ptu_cache_size",
+                 "session_store", "session_cache_files")
+
+
+class SessionStore:
+    """HDF5 file of per-file entries, in tables (groups) such as "results" and "intensity", and of the raw data cubes
+    that are not memory mapped from their own files.
+
+    Without a path the session is a temporary file, removed when the store is closed (or the program exits), empty or
+    a copy of the session file source. Temporary files left by a program that was killed are removed by
+    remove_stale_sessions.
+    """
+
+    def __init__(self, path=None, cache_entries=CACHE_ENTRIES, mode='a', source=None):
+        self.temporary = path is None
+        if self.temporary:
+            os.makedirs(SESSION_DIR, exist_ok=True)
+            # the process id in the name tells remove_stale_sessions whether the file is still in use
+            fd, path = tempfile.mkstemp(prefix=f"{os.getpid()}-", suffix=".h5", dir=SESSION_DIR)
+            os.close(fd)
+            mode = 'w'
+            if source is not None:
+                try:
+                    shutil.copyfile(source, path)
+                except OSError:
+                    os.remove(path)
+                    raise
+                mode = 'r+'
+        self.path = path
+        self.cache_entries = cache_entries
+        self.lock = threading.RLock()  # the analysis thread writes results while the GUI reads them
+        try:
+            self.file = h5py.File(path, mode)
+        except Exception:
+            if self.temporary:
+                os.remove(path)
+            raise
+        self._tables = {}
+        atexit.register(self.close)
+
+    def table(self, name):
+        """Dictionary-like table of entries (dictionaries of arrays and plain values), created if needed"""
+        if name not in self._tables:
+            with self.lock:
+                group = self.file.require_group(name)
+            self._tables[name] = StoreTable(self, group)
+        return self._tables[name]
+
+    def put_dataset(self, name, data, group="cubes"):
+        """Store an in-memory (T, X, Y) dataset as a chunked dataset of the session file and return it as a FlimDataset
+        reading its rows from there. Without a name, the dataset gets a unique one (e.g. for files stored while they are
+        imported, before their name in the file table is known)"""
+        array = np.asarray(data)
+        with self.lock:
+            cubes = self.file.require_group(group)
+            name = name or uuid.uuid4().hex
+            if name in cubes:
+                del cubes[name]
+            cube = cubes.create_dataset(name, data=array, chunks=(array.shape[0], 1, array.shape[2]))
+            return FlimDataset(cube, data.file_name, intensity=data.intensity())
+
+    def remove_dataset(self, data):
+        """Remove the dataset of the session file a FlimDataset reads from, other datasets are left alone"""
+        source = getattr(data, "source", None)
+        with self.lock:
+            if isinstance(source, h5py.Dataset) and source.file == self.file:
+                del self.file[source.name]
+
+    def flush(self):
+        """Write the entries held in memory to the session file"""
+        with self.lock:
+            for table in self._tables.values():
+                table.flush()
+            self.file.flush()
+
+    def save_as(self, path):
+        """Copy the session file to path and return the copy opened as a store (this store if path is its file)"""
+        with self.lock:
+            self.flush()
+            if os.path.abspath(path) == os.path.abspath(self.path):
+                return self
+            shutil.copyfile(self.path, path)
+        return SessionStore(path, self.cache_entries)
+
+    def close(self):
+        with self.lock:
+            if not self.file:
+                return
+            if not self.temporary:
+                self.flush()
+            self.file.close()
+            if self.temporary:
+                try:
+                    os.remove(self.path)
+                except OSError:
+                    pass
+        atexit.unregister(self.close)
+
+
+def remove_stale_sessions(session_dir=None):
+    """Remove the temporary session files of programs that are no longer running (e.g. killed or crashed)"""
+    session_dir = session_dir or SESSION_DIR
+    try:
+        names = os.listdir(session_dir)
+    except OSError:
+        return
+    for name in names:
+        pid = name.split("-", 1)[0]
+        if not name.endswith(".h5") or (pid.isdigit() and _process_running(int(pid))):
+            continue
+        try:
+            os.remove(os.path.join(session_dir, name))
+        except OSError:
+            pass  # e.g. open in a running program on Windows
+
+
+def _process_running(pid):
+    if pid == os.getpid():
+        return True
+    if os.name == "nt":
+        # os.kill terminates the process on Windows, the files of running programs can not be removed there anyway
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        return True  # running under another user
+    return True
+
+
+def save_session(shared, path):
+    """Write the session of shared (SharedData) to path: config, raw data, results, intensity images, statistics table
+    and gallery thumbnails. Raw data memory mapped from its own file is referenced by file, other raw data is stored"""
+    live = shared.session
+    if live is not None:
+        store = live.save_as(path)
+    else:
+        store = SessionStore(path, int(shared.config["session_cache_files"]), mode='w')
+        for name, entries in (("results", shared.results_dict), ("intensity", shared.intensity_img_dict)):
+            table = store.table(name)
+            for filename, entry in entries.items():
+                table[filename] = dict(entry)
+    try:
+        with store.lock:
+            raw = store.table("raw")
+            raw.clear()
+            for filename, file_info in shared.raw_data_dict.items():
+                raw[filename] = dict(file_info, data=_data_source(store, "cubes", filename, file_info["data"],
+                                                                  file_info.get("file_path")))
+
+            references = store.table("references")
+            references.clear()
+            for filename, ref_info in shared.ref_files_dict.items():
+                file_path = shared.raw_data_dict.get(filename, {}).get("file_path")
+                references[filename] = dict(ref_info, ref_data=_data_source(store, "reference_cubes", filename,
+                                                                            ref_info["ref_data"], file_path))
+            for name in set(store.file.get("reference_cubes", {})) - set(shared.ref_files_dict):
+                del store.file["reference_cubes"][name]
+
+            thumbnails = store.table("thumbnails")
+            thumbnails.clear()
+            for filename, result in shared.results_dict.items():
+                thumbnails[filename] = shared.thumbnails.get(filename) or result_thumbnails(result)
+
+            df_stats = shared.df_stats
+            store.table("session")["state"] = {
+                "version": SESSION_VERSION,
+                "config": shared.config,
+                "phasor_settings": shared.phasor_settings,
+                "ptu_channel": shared.ptu_channel,
+                "ptu_time_binning": shared.ptu_time_binning,
+                "df_stats": df_stats.to_json(orient="split", double_precision=15) if isinstance(df_stats, pd.DataFrame) else None,
+            }
+            store.flush()
+    finally:
+        if store is not live:
+            store.close()
+
+
+def load_session(shared, path):
+    """Open a session file written by save_session as the session of shared (SharedData), the previous session is
+    closed. The session is a temporary copy of the file, which only changes when the session is saved again. Only the
+    file list, settings, statistics table and gallery thumbnails are read here, the results and intensity images are
+    read from the copy when they are used (changes are written to it).
+    Returns the names of the files whose raw data file was not found (they are not analysed)"""
+    live = shared.session
+    store = SessionStore(cache_entries=int(shared.config["session_cache_files"]), source=path)
+    try:
+        if "session" not in store.file:
+            raise FileLoadingError(f"'{os.path.basename(path)}' is not a FLIMPA session file.")
+        state = store.table("session")["state"]
+        raw_data_dict, missing = {}, []
+        for filename, entry in store.table("raw").items():
+            file_info = dict(entry)
+            file_info["data"] = _open_source(store, file_info["data"])
+            if file_info["data"] is None:
+                missing.append(filename)
+                file_info["analyse"] = "no"
+            raw_data_dict[filename] = file_info
+        ref_files_dict = {}
+        for filename, entry in store.table("references").items():
+            ref_data = _open_source(store, entry["ref_data"])
+            if ref_data is not None:
+                # in this order, the values are unpacked by the reference correction
+                ref_files_dict[filename] = {"ref_data": ref_data, "t_series": entry["t_series"], "bins_ref": entry["bins_ref"]}
+        thumbnails = {filename: dict(entry) for filename, entry in store.table("thumbnails").items()}
+    except Exception:
+        store.close()
+        raise
+    if live is not None:
+        live.close()
+
+    shared.session = store
+    shared.results_dict = store.table("results")
+    shared.intensity_img_dict = store.table("intensity")
+    shared.raw_data_dict = raw_data_dict
+    shared.ref_files_dict = ref_files_dict
+    shared.thumbnails = thumbnails
+    shared.phasor_histograms = {}
+    shared.roi_masks = {}
+    shared.config.update({key: value for key, value in state["config"].items() if key not in _LOCAL_CONFIG})
+    shared.phasor_settings = state["phasor_settings"]
+    shared.ptu_channel = state["ptu_channel"]
+    shared.ptu_time_binning = state["ptu_time_binning"]
+    shared.df_stats = pd.read_json(io.StringIO(state["df_stats"]), orient="split", precise_float=True) if state["df_stats"] else {}
+    return missing
+
+
+def _data_source(store, group, name, data, file_path):
+    """Where the raw data of a file is read from when the session is opened, data that is not memory mapped from the
+    raw data file itself (e.g. decoded .ptu files, .ptu cache files that may be removed) is stored in the session"""
+    if not isinstance(data, FlimDataset):
+        # IRFs are plain arrays
+        data = store.put_dataset(name, FlimDataset(np.asarray(data)), group)
+        return {"cube": data.source.name, "array": True}
+    if data.is_memmap and file_path and os.path.abspath(data.file_name) == os.path.abspath(file_path):
+        return {"file_name": data.file_name, "layout": data.layout}
+    if not isinstance(data.source, h5py.Dataset):
+        data = store.put_dataset(name, data, group)
+    # datasets of the session being saved have the same name in its copy
+    return {"cube": data.source.name, "file_name": data.file_name}
+
+
+def _open_source(store, source):
+    if "layout" in source:
+        if not os.path.exists(source["file_name"]):
+            return None
+        return FlimDataset.from_file(source["file_name"], *source["layout"])
+    cube = store.file[source["cube"]]
+    if source.get("array"):
+        return cube[()]
+    return FlimDataset(cube, source["file_name"])
+
+
+def result_thumbnails(result):
+    """Reduced intensity image and lifetime maps (ns, float16) of the results of a file, drawn in the galleries of
+    opened sessions instead of the full maps"""
+    shape = tuple(result["img_shape"][1:])
+    thumbnails = {"intensity": thumbnail(result["intensity"])}
+    for name in ("M", "phi", "average"):
+        thumbnails[name] = (thumbnail(np.reshape(result[name], shape), background=True) * 1e9).astype(np.float16)
+    return thumbnails
+
+
+def thumbnail(image, size=THUMBNAIL_SIZE, background=False):
+    """Image reduced to at most size pixels per side by averaging blocks of pixels (without the zero background
+    pixels of lifetime maps if background is True)"""
+    image = np.asarray(image, dtype=np.float32)
+    factor = -(-max(image.shape) // size)
+    if factor <= 1:
+        return image
+    x_dim, y_dim = (-(-n // factor) * factor for n in image.shape)
+    valid = np.zeros((x_dim, y_dim), dtype=bool)
+    valid[:image.shape[0], :image.shape[1]] = np.isfinite(image) & ((image != 0) if background else True)
+    padded = np.zeros((x_dim, y_dim), dtype=np.float32)
+    padded[:image.shape[0], :image.shape[1]] = np.where(valid[:image.shape[0], :image.shape[1]], image, 0)
+    blocks = (x_dim // factor, factor, y_dim // factor, factor)
+    total = padded.reshape(blocks).sum(axis=(1, 3))
+    count = valid.reshape(blocks).sum(axis=(1, 3))
+    return np.divide(total, count, out=np.zeros_like(total), where=count > 0)
+
+
+class StoreTable(MutableMapping):
+    """Entries of a session table by file name, in insertion order. Entries read or written last are kept in memory
+    (least recently used are written to the session file and dropped first). Arrays of stored entries are only read
+    when they are used, and only the values that were set are written back."""
+
+    def __init__(self, store, group):
+        self._store = store
+        self._group = group
+        self._names = _read_json(group[_NAMES]) if _NAMES in group else []
+        self._front = OrderedDict()  # file name -> _Entry, most recently used last
+
+    def __getitem__(self, name):
+        with self._store.lock:
+            entry = self._front.get(name)
+            if entry is not None:
+                self._front.move_to_end(name)
+                return entry
+            if name not in self._names:
+                raise KeyError(name)
+            entry = _Entry(self, name, group=self._group[name])
+            self._keep(name, entry)
+            return entry
+
+    def __setitem__(self, name, value):
+        with self._store.lock:
+            entry = _Entry(self, name, values=value)
+            if name not in self._names:
+                self._names.append(name)
+                self._save_names()
+            self._front.pop(name, None)
+            self._keep(name, entry)
+
+    def __delitem__(self, name):
+        with self._store.lock:
+            if name not in self._names:
+                raise KeyError(name)
+            self._names.remove(name)
+            self._save_names()
+            self._front.pop(name, None)
+            if name in self._group:
+                del self._group[name]
+
+    def __iter__(self):
+        return iter(list(self._names))
+
+    def __len__(self):
+        return len(self._names)
+
+    def __contains__(self, name):
+        return name in self._names
+
+    def setdefault(self, name, default=None):
+        # return the stored entry, so changes made to it are written back
+        if name not in self:
+            self[name] = {} if default is None else default
+        return self[name]
+
+    def clear(self):
+        with self._store.lock:
+            self._front.clear()
+            for name in list(self._group):
+                del self._group[name]
+            self._names = []
+            self._save_names()
+
+    def flush(self):
+        """Write the changed entries held in memory, keeping them in memory"""
+        with self._store.lock:
+            for name, entry in self._front.items():
+                self._write(name, entry)
+
+    def _keep(self, name, entry):
+        self._front[name] = entry
+        while len(self._front) > self._store.cache_entries:
+            old_name, old_entry = self._front.popitem(last=False)
+            self._write(old_name, old_entry)
+
+    def _attach(self, name, entry):
+        """Bring an entry changed after it was dropped from memory back, so the change is written"""
+        with self._store.lock:
+            if name in self._names and self._front.get(name) is not entry:
+                self._front.pop(name, None)
+                self._keep(name, entry)
+            else:
+                self._front.move_to_end(name)
+
+    def _write(self, name, entry):
+        if not entry.changed and not entry.removed and not entry.replace:
+            return
+        if entry.replace and name in self._group:
+            del self._group[name]
+        group = self._group.require_group(name)
+        for key in entry.removed:
+            _remove_value(group, key)
+        for key in entry.changed:
+            _write_value(group, key, entry[key])
+        entry.written(group)
+
+    def _save_names(self):
+        _write_value(self._group, _NAMES, self._names)
+
+
+class _Entry(MutableMapping):
+    """Dictionary of one file in a session table. Plain values are read with the entry, arrays when they are first
+    used, derived maps (see utils/file_result.py) are calculated when they are read. The keys set or removed since the
+    entry was last written are recorded"""
+
+    def __init__(self, table, name, values=None, group=None):
+        self._table = table
+        self._name = name
+        self._values = {}
+        self._stored = {}  # key -> HDF5 item not read yet
+        self.removed = set()
+        if group is None:
+            self._values.update(values or {})
+            self.changed = set(self._values)
+            self.replace = True  # the stored entry (if any) is replaced as a whole
+        else:
+            self.written(group)
+            for key, item in group.items():
+                if isinstance(item, h5py.Dataset) and item.attrs.get("type") == "json":
+                    self._values[key] = _read_json(self._stored.pop(key))
+
+    def __getitem__(self, key):
+        if key not in self._values:
+            if key not in self._stored:
+                return derived_map(self, key)  # KeyError if missing
+            item = self._stored.pop(key)
+            self._values[key] = _read_value(item)
+        return self._values[key]
+
+    def __setitem__(self, key, value):
+        self._values[key] = value
+        self._stored.pop(key, None)
+        self.changed.add(key)
+        self.removed.discard(key)
+        self._table._attach(self._name, self)
+
+    def __delitem__(self, key):
+        if key in self._values:
+            del self._values[key]
+        else:
+            del self._stored[key]
+        self.changed.discard(key)
+        self.removed.add(key)
+        self._table._attach(self._name, self)
+
+    def __iter__(self):
+        return iter(list(self._values) + [key for key in self._stored if key not in self._values])
+
+    def __len__(self):
+        return len(set(self._values) | set(self._stored))
+
+    def __contains__(self, key):
+        return key in self._values or key in self._stored or has_derived_map(self, key)
+
+    def __repr__(self):
+        return f"<session entry {self._name!r}: {sorted(self)}>"
+
+    def written(self, group):
+        """Mark the entry as written to (or read from) its group of the session file"""
+        self._stored = {key: item for key, item in group.items() if key not in self._values}
+        self.changed = set()
+        self.removed = set()
+        self.replace = False
+
+
+def _write_value(group, key, value):
+    """Arrays (and tuples or lists of arrays) are stored as datasets, other values as JSON strings (HDF5 attributes
+    are limited to 64 kB, too small for e.g. the statistics rows of many regions)"""
+    _remove_value(group, key)
+    if isinstance(value, np.ndarray):
+        _write_array(group, key, value)
+    elif isinstance(value, (tuple, list)) and value and all(isinstance(item, np.ndarray) for item in value):
+        items = group.create_group(key)
+        items.attrs["type"] = type(value).__name__
+        for i, item in enumerate(value):
+            _write_array(items, str(i), item)
+    else:
+        text = group.create_dataset(key, data=json.dumps(_to_json(value), default=_json_default), dtype=h5py.string_dtype())
+        text.attrs["type"] = "json"
+
+
+def _remove_value(group, key):
+    if key in group:
+        del group[key]
+
+
+def _read_json(dataset):
+    return _from_json(json.loads(dataset.asstr()[()]))
+
+
+def _write_array(group, key, array):
+    # integer and boolean images (counts, masks) compress well, floating point maps hardly at all (noise in the
+    # lower bits), they are written uncompressed as that is several times faster
+    compress = array.ndim and array.size and array.dtype.kind in 'biu'
+    group.create_dataset(key, data=array, **(_COMPRESSION if compress else {}))
+
+
+def _read_value(item):
+    if isinstance(item, h5py.Group):
+        arrays = [item[str(i)][()] for i in range(len(item))]
+        return tuple(arrays) if item.attrs.get("type") == "tuple" else arrays
+    if item.attrs.get("type") == "json":
+        return _read_json(item)
+    return item[()]
+
+
+def _to_json(value):
+    # tuples (e.g. image dimensions) are tagged, so they are not read back as lists
+    if isinstance(value, tuple):
+        return {"__tuple__": [_to_json(item) for item in value]}
+    if isinstance(value, list):
+        return [_to_json(item) for item in value]
+    if isinstance(value, dict):
+        return {key: _to_json(item) for key, item in value.items()}
+    return value
+
+
+def _from_json(value):
+    if isinstance(value, dict):
+        if set(value) == {"__tuple__"}:
+            return tuple(_from_json(item) for item in value["__tuple__"])
+        return {key: _from_json(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_from_json(item) for item in value]
+    return value
+
+
+def _json_default(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError(f"{type(value).__name__} can not be stored in a session")
@@ -1,5 +1,7 @@
 import yaml
 
+from utils.session_store import SessionStore, remove_stale_sessions
+
 class SharedData:
     _instance = None
 
@@ -18,9 +20,13 @@ class SharedData:
         """
         self.ref_files_dict = {}  # Dictionary to store reference files
         self.config = self.load_config()  # Load configuration from embedded YAML content
-        self.raw_data_dict = {}  # Dictionary to store raw data
-        self.intensity_img_dict = {}  # Dictionary to store intensity images
-        self.results_dict = {}  # Dictionary to store results
+        self.raw_data_dict = {}  # Dictionary to store raw data (in-memory cubes are kept in the session file)
+        self.session = self.open_session()  # Session file holding the results and intensity images on disk
+        self.intensity_img_dict = self.session.table("intensity") if self.session else {}  # Intensity images
+        self.results_dict = self.session.table("results") if self.session else {}  # Results
+        self.thumbnails = {}  # Gallery thumbnails of the results of an opened session (removed once a file is analysed again)
+        self.phasor_histograms = {}  # Phasor plot histograms of the results (removed once a file is analysed again)
+        self.roi_masks = {}  # Pixels of every file in the phasor ROIs of the gallery plots (cleared with the statistics table)
         self.df_stats = {}  # Dictionary to store statistical data
         self.ptu_channel = {}  # Dictionary to store PTU file channels
         self.ptu_time_binning = {}  # Dictionary to store PTU time binning selection
@@ -31,6 +37,19 @@ class SharedData:
         }
         self.last_active_tab= {} # Dictionary to store the last tab selected in the GUI
 
+    def open_session(self):
+        """
+        Open a temporary session file, or return None (results are kept in memory) if it is switched off or can not be created.
+        """
+        remove_stale_sessions()
+        if self.config["session_store"] == "False":
+            return None
+        try:
+            return SessionStore(cache_entries=int(self.config["session_cache_files"]))
+        except OSError as e:
+            print(f"session file could not be created, results are kept in memory: {e}")
+            return None
+
     def load_config(self):
         """
         Load the configuration from the embedded YAML content.
@@ -42,6 +61,14 @@ class SharedData:
         max_photons: 1000000 # threshold for maximum photon counts for the FLIM image
 
         bins: "3x3" # binning value for data. Can only be any odd number or 256.
+        workers: 1 # number of processes analysing files in parallel (1 analyses the files one after the other)
+        memory_budget: 256 # approximate memory (MB) used to calculate the phasor coordinates of one file (per process)
+        phasor_cache: "False" # keep the phasor coordinates of analysed files on disk, unchanged files are not recalculated
+        cache_size: 2048 # maximum size (MB) of the phasor cache, least recently used files are removed first
+        ptu_cache: "False" # keep decoded .ptu histograms on disk, files opened again are not decoded
+        ptu_cache_size: 8192 # maximum size (MB) of the .ptu histogram cache, least recently used files are removed first
+        session_store: "False" # keep the results, intensity images and in-memory raw data of the session on disk
+        session_cache_files: 4 # files of the session held in memory (most recently used)
 
         ref_file: "None"
         ref_lifetime: 4
@@ -65,6 +92,7 @@ class SharedData:
         lifetime_itegrate: "False"
 
         tau_violin: "average"
+        detail_stats: "False" # add the pixel count, median, std, quartiles, phasor centroid, dispersion and photon count of each region to the lifetime values
         """
 
         # Load and parse the YAML content into a Python dictionary
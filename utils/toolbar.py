@@ -1,4 +1,6 @@
 import os
+import time
+import uuid
 from PySide6.QtWidgets import (QStatusBar, QMenuBar, QFileDialog, QInputDialog, QFileDialog, QLineEdit, QLabel,QPushButton,
                                QProgressDialog, QApplication, QMessageBox, QComboBox, QVBoxLayout, QDialogButtonBox, QDialog)
 from PySide6.QtGui import QDoubleValidator
@@ -6,13 +8,21 @@ from PySide6.QtGui import QDoubleValidator
 from PySide6.QtCore import Qt, QTimer
 import numpy as np
 from pathlib import Path
-from utils.lifetime_cal import LifetimeData
+from ptufile import PtuFile
+from utils.lifetime_cal import LifetimeData, ALL_CHANNELS
+from utils.file_readers import sdt_channel_count
+from utils.file_loader import PrefetchLoader, load_file
+from utils.session_store import save_session, load_session
 from utils.mainwindow import *
 from utils.shared_data import SharedData
 from utils import save_data 
 from utils.plot_imgs import PlotImages
 from utils.errors import DataProcessingError
 
+# interval (ms) at which files decoded in the background are added to the GUI
+LOADER_POLL_MS = 50
+# minimum interval (s) between drawing the intensity images of newly loaded files, each draw takes a fraction of a second
+LOADER_DRAW_INTERVAL = 1.0
 
 class ToolBarComponents:
     def __init__(self, main_window, app):
@@ -20,6 +30,7 @@ class ToolBarComponents:
         self.app = app
         self.shared_info = SharedData()
         self.plotImages = PlotImages(self.main_window)
+        self.loading = None  # files being loaded in the background
         self.setup_menu()
         self.setup_statusbar()
 
@@ -49,6 +60,8 @@ class ToolBarComponents:
         import_masks_cond = file_menu.addAction("Import raw data by condition with manual masks")
         import_masks_cond.triggered.connect(self.load_masks_cond)
         file_menu.addSeparator()
+        open_session = file_menu.addAction("Open session")
+        open_session.triggered.connect(self.open_session_file)
 
         # quit application
         #quit_action = file_menu.addAction("Quit")
@@ -81,6 +94,9 @@ class ToolBarComponents:
         file_menu.addSeparator()
         export_cv = file_menu.addAction("Export lifetime values table")
         export_cv.triggered.connect(self.save_csv)
+        file_menu.addSeparator()
+        save_session_action = file_menu.addAction("Save session")
+        save_session_action.triggered.connect(self.save_session_file)
         
     def setup_statusbar(self):
         self.main_window.setStatusBar(QStatusBar(self.main_window))
@@ -167,56 +183,7 @@ class ToolBarComponents:
         self.shared_info.ptu_channel = None
         self.shared_info.ptu_time_binning = None # option for binning time dimetion in ptu files for faster data analysis
 
-        # Create a progress dialog
-        progress_dialog = QProgressDialog("Loading files...", "", 0, len(fnames), self.main_window)
-        progress_dialog.setWindowModality(Qt.WindowModal)
-        progress_dialog.setMinimumDuration(0)
-
-        # Disable the close button and remove the cancel button
-        progress_dialog.setCancelButton(None)
-        #progress_dialog.setWindowFlag(Qt.WindowCloseButtonHint, False)
-
-        bin_width = None  # Initialize bin_width variable to store the user input
-
-        try:
-            for i, fname in enumerate(fnames):  # Iterate through the selected files
-                if fname:
-                    # Update the progress dialog
-                    progress_dialog.setValue(i)
-                    progress_dialog.setLabelText(f"Loading file {i+1} of {len(fnames)}")
-                    QApplication.processEvents()  # Process events to keep the UI responsive
-
-                    # Check if the file is a .tif or .tiff and if bin_width is already set
-                    if fname.lower().endswith(('.tif', '.tiff')) and bin_width is None:
-                        # Prompt the user for bin_width only once
-                        bin_width, ok = self.get_float_input()
-                        if not ok or bin_width is None:
-                            break  # If the user cancels or no valid input, exit
-
-                    # Assuming you have a mechanism to process and display each file
-                    data, t_series = LifetimeData(self.main_window, self.app).load_raw_data(fname, bin_width,  sample_count = i)
-
-                    filename = Path(fname).stem
-                    # check if entry is duplicate and if so rename it
-                    filename = self.handle_duplicates(filename)
-
-                    self.shared_info.raw_data_dict[filename] = {"data": data, "t_series": t_series, "condition": self.data_condition, "masked_data": None, 
-                                                                "mask_arr": None, "analyse": "yes"}
-                    self.shared_info.config["selected_file"] = filename
-                    self.plotImages.visualise_image(intensity_image=data.sum(axis=0), filename=filename)
-
-                    self.main_window.activateWindow()  # Regain focus after files are loaded
-                    self.main_window.raise_()  # Bring the window to the front
-
-                    # Check if the user has canceled the operation
-                    if progress_dialog.wasCanceled():
-                        break
-
-            progress_dialog.setValue(len(fnames))  # Ensure the progress dialog is complete
-        except Exception as e:
-            progress_dialog.close()  # Close the progress dialog if an error occurs
-            raise  # Re-raise the exception to be handled elsewhere if needed
-
+        self.import_files(fnames, "Loading files...", self.data_condition)
         self.data_condition = "None"
         return fnames
 
@@ -234,59 +201,133 @@ class ToolBarComponents:
 
         print([Path(x).stem for x in fnames], masks_dir)
 
+        self.import_files(fnames, "Loading mask files...", self.data_condition, masks_dir=masks_dir)
+        self.data_condition = "None"
+        return fnames
+
+    def import_files(self, fnames, label, condition, masks_dir=None, data_type="sample"):
+        """Load files in the background: they are decoded on the loader threads, a few files ahead, while the files
+        already decoded are added and displayed here (on a timer), so the window stays responsive and loading can be cancelled"""
+        lifetime_data = LifetimeData(self.main_window, self.app)
+
+        bin_width = None  # Initialize bin_width variable to store the user input
+        if any(fname.lower().endswith(('.tif', '.tiff')) for fname in fnames):
+            # Prompt the user for bin_width only once
+            bin_width, ok = self.get_float_input()
+            if not ok or bin_width is None:
+                return  # If the user cancels or no valid input, exit
+
+        # channel and .ptu options are chosen before loading starts, from the first .ptu (or multi-block .sdt) file
+        ptu_files = [fname for fname in fnames if fname.endswith('.ptu')]
+        sdt_files = [fname for fname in fnames if fname.endswith('.sdt')]
+        try:
+            if ptu_files:
+                with PtuFile(ptu_files[0]) as ptu:
+                    lifetime_data.select_ptu_options(ptu, data_type)
+            if sdt_files and self.shared_info.ptu_channel is None and sdt_channel_count(sdt_files[0]) > 1:
+                lifetime_data.select_channel(sdt_channel_count(sdt_files[0]), data_type)
+        except Exception as e:
+            lifetime_data.show_loading_error((ptu_files or sdt_files)[0], e)
+            return
+        channel = None if self.shared_info.ptu_channel == ALL_CHANNELS else self.shared_info.ptu_channel or 0
+        ptu_time_binning = self.shared_info.ptu_time_binning or 1
+        ptu_cache = lifetime_data.ptu_cache() if ptu_files else None
+
         # Create a progress dialog
-        progress_dialog = QProgressDialog("Loading mask files...", "", 0, len(fnames), self.main_window)
+        progress_dialog = QProgressDialog(label, "Cancel", 0, len(fnames), self.main_window)
         progress_dialog.setWindowModality(Qt.WindowModal)
         progress_dialog.setMinimumDuration(0)
+        progress_dialog.setValue(0)
+        progress_dialog.canceled.connect(self.stop_loading)
+
+        # decoded sample data is moved to the session file on the loader threads, reference data is kept in memory
+        session = self.shared_info.session if data_type != "reference" else None
+        loader = PrefetchLoader(lambda fname: load_file(fname, bin_width, channel, ptu_time_binning, masks_dir, ptu_cache,
+                                                        session), fnames)
+        timer = QTimer(self.main_window)
+        timer.timeout.connect(self.add_loaded_files)
+        self.loading = {"loader": loader, "timer": timer, "progress_dialog": progress_dialog,
+                        "condition": condition, "data_type": data_type, "total": len(fnames),
+                        "pending_draw": False, "drawn": 0.0}
+        timer.start(LOADER_POLL_MS)
+
+    def add_loaded_files(self):
+        """Add the files decoded so far to the raw data and display them, in the order they were selected"""
+        loading = self.loading
+        if loading is None:
+            return
+        # stopped while adding files, message boxes run their own event loop
+        loading["timer"].stop()
+        lifetime_data = LifetimeData(self.main_window, self.app)
+
+        added = False
+        for i, fname, future in loading["loader"].ready():
+            try:
+                channels, t_series, mask_arr = future.result()
+                data = channels[0][1]
+                lifetime_data.check_xy_dimensions(data.shape[1], data.shape[2], loading["data_type"], sample_count = i)
+            except Exception as e:
+                self.stop_loading()
+                lifetime_data.show_loading_error(fname, e)
+                return
+            if self.loading is not loading:
+                return  # cancelled while a message was shown
 
-        # Disable the close button and remove the cancel button
-        progress_dialog.setCancelButton(None)
-        #progress_dialog.setWindowFlag(Qt.WindowCloseButtonHint, False)
-        bin_width = None  # Initialize bin_width variable to store the user input
+            added = True
+            for channel, data in channels:
+                # files with several channels are added as one file per channel
+                suffix = f"_ch{channel}" if len(channels) > 1 else ""
+                self.add_file(fname, data, t_series, mask_arr, loading["condition"], loading["data_type"], suffix)
 
-        try:
-            for i, fname in enumerate(fnames):  # Iterate through the selected files
-                if fname:
-                    # Update the progress dialog
-                    progress_dialog.setValue(i)
-                    progress_dialog.setLabelText(f"Loading file {i+1} of {len(fnames)}")
-                    QApplication.processEvents()  # Process events to keep the UI responsive
-
-                    # Check if the file is a .tif or .tiff and if bin_width is already set
-                    if fname.lower().endswith(('.tif', '.tiff')) and bin_width is None:
-                        # Prompt the user for bin_width only once
-                        bin_width, ok = self.get_float_input()
-                        if not ok or bin_width is None:
-                            break  # If the user cancels or no valid input, exit
-                        
-                    # Assuming you have a mechanism to process and display each file
-                    data, t_series = LifetimeData(self.main_window, self.app).load_raw_data(fname, bin_width, sample_count = i)
-                    
-                    filename_original = Path(fname).stem
-                    masked_data, mask_arr = LifetimeData(self.main_window, self.app).mask_data(masks_dir, filename_original, data)
-                    
-                    # Check if entry is duplicate and if so rename it
-                    filename = self.handle_duplicates(filename_original)
-
-                    self.shared_info.raw_data_dict[filename] = {"data": data, "t_series": t_series, "condition": self.data_condition, "masked_data": masked_data, 
-                                                                "mask_arr": mask_arr, "analyse": "yes"}
-                    self.shared_info.config["selected_file"] = filename
-                    self.plotImages.visualise_image(intensity_image=data.sum(axis=0), filename=filename)
-                    
-                    self.main_window.activateWindow()  # Regain focus after files are loaded
-                    self.main_window.raise_()  # Bring the window to the front
-
-                    # Check if the user has canceled the operation
-                    if progress_dialog.wasCanceled():
-                        break
-
-            progress_dialog.setValue(len(fnames))  # Ensure the progress dialog is complete
-        except Exception as e:
-            progress_dialog.close()  # Close the progress dialog if an error occurs
-            raise  # Re-raise the exception to be handled elsewhere if needed
-        
-        self.data_condition = "None"
-        return fnames
+            # Update the progress dialog
+            loading["progress_dialog"].setValue(i + 1)
+            loading["progress_dialog"].setLabelText(f"Loading file {min(i+2, loading['total'])} of {loading['total']}")
+
+        if self.loading is not loading:
+            return
+        # the image of the last file added is drawn, at most once per draw interval while files are loading
+        if added:
+            loading["pending_draw"] = True
+        if loading["pending_draw"] and (loading["loader"].done or time.monotonic() - loading["drawn"] > LOADER_DRAW_INTERVAL):
+            self.plotImages.draw_selected_image()
+            loading["pending_draw"], loading["drawn"] = False, time.monotonic()
+
+        if loading["loader"].done:
+            self.stop_loading()
+            self.main_window.activateWindow()  # Regain focus after files are loaded
+            self.main_window.raise_()  # Bring the window to the front
+        else:
+            loading["timer"].start(LOADER_POLL_MS)
+
+    def add_file(self, fname, data, t_series, mask_arr, condition, data_type, suffix=""):
+        """Add a loaded file (channel) to the raw data (and to the reference files) and to the file table"""
+        if data_type == "reference":
+            filename = f'{Path(fname).stem}_ref'
+            # updated reference bins based on time channels of reference file
+            self.shared_info.ref_files_dict[filename] = {"ref_data":data, "t_series":t_series, "bins_ref": data.shape[0] }
+            self.main_window.parameters_data.update_ref_file(list(self.shared_info.ref_files_dict.keys()))
+            analyse = "no"
+        else:
+            # check if entry is duplicate and if so rename it
+            filename = self.handle_duplicates(Path(fname).stem + suffix)
+            analyse = "yes"
+
+        # data_id identifies the imported data in the stage signatures, also when a saved session is opened again
+        self.shared_info.raw_data_dict[filename] = {"data": data, "t_series": t_series, "condition": condition, "file_path": fname,
+                                                    "mask_arr": mask_arr, "analyse": analyse, "data_id": uuid.uuid4().hex}
+        # only set the reference file as "selected file" if no other file has been loaded
+        if data_type != "reference" or self.shared_info.config["selected_file"] == "None":
+            self.shared_info.config["selected_file"] = filename
+        self.plotImages.visualise_image(intensity_image=data.intensity(), filename=filename, draw=False)
+
+    def stop_loading(self):
+        """Stop loading (cancel button, error or all files loaded), files already added are kept"""
+        loading, self.loading = self.loading, None
+        if loading is None:
+            return
+        loading["loader"].cancel()
+        loading["timer"].stop()
+        loading["progress_dialog"].close()
         
 
     def load_masks_cond(self):
@@ -311,56 +352,12 @@ class ToolBarComponents:
 
     def load_ref_file(self):
         fname, _ = QFileDialog.getOpenFileName(self.main_window," Selet a reference file to open")
+        if not fname:
+            return
         self.shared_info.ptu_channel = None # set ptu channels info to None as the data may be stored in a different channel
         self.shared_info.ptu_time_binning = None # option for binning time dimetion in ptu files for faster data analysis
 
-        bin_width = None
-        # Create a progress dialog
-        progress_dialog = QProgressDialog("Loading reference file...", "", 0, 1, self.main_window)
-        progress_dialog.setWindowModality(Qt.WindowModal)
-        progress_dialog.setMinimumDuration(0)
-
-        # Disable the close button and remove the cancel button
-        progress_dialog.setCancelButton(None)
-        #progress_dialog.setWindowFlag(Qt.WindowCloseButtonHint, False)
-
-        bin_width = None  # Initialize bin_width variable to store the user input
-
-        try:
-            
-            progress_dialog.setValue(0)
-            QApplication.processEvents()  # Process events to keep the UI responsive
-
-            if fname.lower().endswith(('.tif', '.tiff')) and bin_width is None:
-                # Prompt the user for bin_width only once
-                bin_width, ok = self.get_float_input()
-                if not ok or bin_width is None:
-                    return  # If the user cancels or no val
-        
-            ref_data,t_series = LifetimeData(self.main_window, self.app).load_raw_data(fname, bin_width, data_type="reference", sample_count = 0)
-            
-            filename = f'{Path(fname).stem}_ref'
-            # updated reference bins based on time channels of reference file
-            self.shared_info.ref_files_dict[filename] = {"ref_data":ref_data, "t_series":t_series, "bins_ref": ref_data.shape[0] }  # Assuming you want to store the full path
-            self.main_window.parameters_data.update_ref_file(list(self.shared_info.ref_files_dict.keys()))
-            self.shared_info.raw_data_dict[filename] = {"data": ref_data, "t_series": t_series, "condition": "reference", "masked_data": None, 
-                                                                    "mask_arr": None, "analyse": "no"}
-            # only set the reference file as "selected file" if no other file has been loaded
-            if self.shared_info.config["selected_file"] == "None":
-                self.shared_info.config["selected_file"] = filename
-            self.plotImages.visualise_image(intensity_image=ref_data.sum(axis=0), filename=filename)
-            
-
-            self.main_window.activateWindow()  # Regain focus after files are loaded
-            self.main_window.raise_()  # Bring the window to the front
-
-
-            progress_dialog.setValue(1)  # Ensure the progress dialog is complete
-        except Exception as e:
-            progress_dialog.close()  # Close the progress dialog if an error occurs
-            raise  # Re-raise the exception to be handled elsewhere if needed
-
-        
+        self.import_files([fname], "Loading reference file...", "reference", data_type="reference")
 
     def load_irf_file(self):
         fname, _ = QFileDialog.getOpenFileName(self.main_window," Selet a reference file to open")
@@ -631,6 +628,68 @@ class ToolBarComponents:
         else:
             return
 
+    def save_session_file(self):
+        """Save the imported files, settings, results and statistics table to a session file"""
+        if not self.shared_info.raw_data_dict:
+            self.save_error_message("Error", "No data has been loaded, there is no session to save.")
+            return
+
+        file_path, _ = QFileDialog.getSaveFileName(self.main_window, "Save session", "", "FLIMPA session (*.h5)")
+        if not file_path:
+            return
+        if not file_path.endswith(".h5"):
+            file_path += ".h5"
+
+        progress_dialog = QProgressDialog("Saving session...", "", 0, 0, self.main_window)
+        progress_dialog.setWindowTitle("Saving Session")
+        progress_dialog.setWindowModality(Qt.WindowModal)
+        progress_dialog.setMinimumDuration(0)
+        progress_dialog.setCancelButton(None)
+        progress_dialog.show()
+        QApplication.processEvents()
+        try:
+            save_session(self.shared_info, file_path)
+        except Exception as e:
+            self.save_error_message("Error", f"The session could not be saved: {e}")
+        finally:
+            progress_dialog.close()
+
+    def open_session_file(self):
+        """Open a saved session in place of the current one. Only the file list, settings, statistics table and gallery
+        thumbnails are read, the results and intensity images of a file are read from a temporary copy of the session file
+        when it is selected (the file only changes when the session is saved)"""
+        file_path, _ = QFileDialog.getOpenFileName(self.main_window, "Open session", "", "FLIMPA session (*.h5)")
+        if not file_path:
+            return
+        self.stop_loading()
+        try:
+            missing = load_session(self.shared_info, file_path)
+        except Exception as e:
+            self.save_error_message("Error", f"The session could not be opened: {e}")
+            return
+
+        # refilling the reference combobox selects its first file, the reference of the session is set again
+        config = dict(self.shared_info.config)
+        self.main_window.parameters_data.update_ref_file(list(self.shared_info.ref_files_dict.keys()))
+        self.shared_info.config.update(config)
+        self.main_window.parameters_data.refresh_parameters()
+        for param_id in ("lifetime_vmin", "lifetime_vmax", "lifetime_map", "lifetime_itegrate", "vmin_int", "vmax_int", "tau_violin"):
+            self.main_window.tab_settings.sync_widgets(param_id, str(self.shared_info.config[param_id]))
+
+        self.main_window.fileTable.setRowCount(0)
+        for filename, file_info in self.shared_info.raw_data_dict.items():
+            self.plotImages.add_table_row(filename, checked=file_info["analyse"] == "yes")
+        if self.shared_info.config["selected_file"] not in self.shared_info.intensity_img_dict:
+            self.shared_info.config["selected_file"] = next(reversed(self.shared_info.raw_data_dict), "None")
+        if self.shared_info.config["selected_file"] in self.shared_info.intensity_img_dict:
+            self.plotImages.draw_selected_image()
+        if self.shared_info.results_dict:
+            self.main_window.analysis_finished()
+
+        if missing:
+            self.save_error_message("Missing raw data", "The raw data of these files was not found, their results are shown "
+                                    "but they can not be analysed again:\n" + "\n".join(missing))
+
 
 
 class ConditionInputDialog(QDialog):